@@ -1,8 +1,14 @@
+import hmac
 import os
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, stream_template
 from functools import wraps
 from dotenv import load_dotenv
 from database import Database
+from matching import MatchingSystem
+from vector_store import VectorStore
+import metrics
+from sql_tracer import SQLTracer, read_slow_log
 
 load_dotenv()
 
@@ -13,8 +19,34 @@ app.secret_key = os.getenv('ADMIN_SECRET_KEY', 'change_this_secret_key_in_produc
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', 'admin')
 DB_PATH = os.getenv('DATABASE_PATH', 'psymatch.db')
-
-db = Database(DB_PATH)
+FEATURE_FLAG_CACHE_TTL = float(os.getenv('FEATURE_FLAG_CACHE_TTL', '2'))
+MATCH_RANKING_MODE = os.getenv('MATCH_RANKING_MODE', 'materialized')
+MATCH_TOP_K = int(os.getenv('MATCH_TOP_K', '50'))
+VECTOR_STORE_PATH = os.getenv('VECTOR_STORE_PATH', '')
+METRICS_PATH = os.getenv('METRICS_PATH', 'metrics_bot.json')
+# Доступ к /metrics для сборщика: Bearer-токен и/или адреса, с которых можно без токена
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = {ip.strip() for ip in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()}
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '100'))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', 'slow_queries.log')
+SLOW_QUERY_LOG_PARAMS = os.getenv('SLOW_QUERY_LOG_PARAMS', '0') == '1'
+USERS_PAGE_SIZE = int(os.getenv('ADMIN_USERS_PAGE_SIZE', '50'))
+
+# Фильтр активности списка пользователей: (last_active не раньше, last_active раньше) относительно сейчас
+ACTIVITY_FILTERS = {
+    '24h': (timedelta(days=1), None),
+    '7d': (timedelta(days=7), None),
+    '30d': (timedelta(days=30), None),
+    'inactive30d': (None, timedelta(days=30)),
+}
+
+tracer = SQLTracer(slow_threshold_ms=SLOW_QUERY_MS, log_path=SLOW_QUERY_LOG,
+                   log_params=SLOW_QUERY_LOG_PARAMS) if SLOW_QUERY_MS > 0 else None
+db = metrics.instrument_database(Database(DB_PATH, flag_cache_ttl=FEATURE_FLAG_CACHE_TTL, tracer=tracer))
+matching_system = MatchingSystem(
+    db, ranking_mode=MATCH_RANKING_MODE, top_k=MATCH_TOP_K,
+    vector_store=VectorStore(VECTOR_STORE_PATH) if VECTOR_STORE_PATH else None
+)
 
 
 def login_required(f):
@@ -74,12 +106,56 @@ def toggle_flag(flag_name):
     return redirect(url_for('index'))
 
 
+def _users_filters(args) -> dict:
+    """Фильтры списка пользователей из параметров запроса (неизвестные значения игнорируются)"""
+    now = datetime.now(timezone.utc)
+    active_after, active_before = ACTIVITY_FILTERS.get(args.get('activity', ''), (None, None))
+    return {
+        'sort': args.get('sort') if args.get('sort') in ('registration', 'activity', 'id') else 'registration',
+        'user_type': args.get('type') if args.get('type') in ('patient', 'psychologist') else None,
+        'blocked': {'blocked': True, 'active': False}.get(args.get('status', '')),
+        'active_after': (now - active_after).strftime('%Y-%m-%d %H:%M:%S') if active_after else None,
+        'active_before': (now - active_before).strftime('%Y-%m-%d %H:%M:%S') if active_before else None,
+        'search': args.get('q', '').strip() or None,
+    }
+
+
 @app.route('/users')
 @login_required
 def users():
-    """Страница со списком пользователей"""
-    users_list = db.get_all_users_with_stats()
-    return render_template('users.html', users=users_list)
+    """Страница со списком пользователей: keyset-пагинация, фильтры и поиск, потоковый рендер"""
+    filters = _users_filters(request.args)
+    direction = 'prev' if request.args.get('dir') == 'prev' else 'next'
+    after = None
+    if request.args.get('id', '').isdigit():
+        key = request.args.get('key', '')
+        if filters['sort'] == 'id':
+            key = int(request.args['id'])
+        after = (key, int(request.args['id']))
+    
+    # Одна лишняя строка показывает, есть ли страница дальше в направлении листания
+    rows = db.get_users_page(after, direction, USERS_PAGE_SIZE + 1, **filters)
+    has_more = len(rows) > USERS_PAGE_SIZE
+    if direction == 'next':
+        rows = rows[:USERS_PAGE_SIZE]
+        has_prev, has_next = after is not None, has_more
+    else:
+        rows = rows[-USERS_PAGE_SIZE:]
+        has_prev, has_next = has_more, True
+    
+    # Параметры фильтров сохраняются в ссылках на соседние страницы
+    params = {name: request.args[name] for name in ('type', 'status', 'activity', 'q', 'sort')
+              if request.args.get(name)}
+    prev_url = next_url = None
+    if rows and has_prev:
+        prev_url = url_for('users', dir='prev', key=rows[0]['cursor'][0], id=rows[0]['user_id'], **params)
+    if rows and has_next:
+        next_url = url_for('users', key=rows[-1]['cursor'][0], id=rows[-1]['user_id'], **params)
+    
+    return Response(stream_template(
+        'users.html', users=rows, args=request.args, prev_url=prev_url, next_url=next_url,
+        first_url=url_for('users', **params) if after is not None else None
+    ))
 
 
 @app.route('/user/<int:user_id>')
@@ -96,11 +172,7 @@ def user_detail(user_id):
     else:
         profile = db.get_patient_info(user_id)
     
-    stats = {
-        'likes_sent': len(db.get_connection().execute('SELECT * FROM likes WHERE from_user_id = ?', (user_id,)).fetchall()),
-        'likes_received': len(db.get_connection().execute('SELECT * FROM likes WHERE to_user_id = ?', (user_id,)).fetchall()),
-        'mutual_matches': len(db.get_connection().execute('SELECT * FROM likes WHERE (from_user_id = ? OR to_user_id = ?) AND is_mutual = 1', (user_id, user_id)).fetchall()) // 2
-    }
+    stats = db.get_user_activity_summary(user_id)
     
     is_blocked = db.is_user_blocked(user_id)
     
@@ -112,6 +184,10 @@ def user_detail(user_id):
 def block_user(user_id):
     """Заблокировать пользователя"""
     db.block_user(user_id)
+    # Убираем заблокированного из выдачи совместимости; ANN-индекс и кэш векторов бота
+    # обновит его MatchMaintenanceWorker по очереди match_updates
+    matching_system.update_user(user_id)
+    db.queue_match_update(user_id)
     flash(f'Пользователь {user_id} заблокирован', 'success')
     return redirect(url_for('user_detail', user_id=user_id))
 
@@ -121,10 +197,56 @@ def block_user(user_id):
 def unblock_user(user_id):
     """Разблокировать пользователя"""
     db.unblock_user(user_id)
+    matching_system.update_user(user_id)
+    db.queue_match_update(user_id)
     flash(f'Пользователь {user_id} разблокирован', 'success')
     return redirect(url_for('user_detail', user_id=user_id))
 
 
+def collect_metrics():
+    """Снимки метрик админки (в памяти) и бота (файл METRICS_PATH): {процесс: снимок}, время снимка бота"""
+    snapshots = {'admin': metrics.registry.snapshot()}
+    bot_snapshot = metrics.load_snapshot(METRICS_PATH)
+    bot_updated_at = None
+    if bot_snapshot:
+        snapshots[bot_snapshot.get('process', 'bot')] = bot_snapshot['metrics']
+        bot_updated_at = datetime.fromtimestamp(bot_snapshot['updated_at']).strftime('%Y-%m-%d %H:%M:%S')
+    return snapshots, bot_updated_at
+
+
+def metrics_access_allowed() -> bool:
+    """/metrics: вошедший админ, верный Bearer-токен METRICS_TOKEN или адрес из METRICS_ALLOWED_IPS"""
+    if 'logged_in' in session or request.remote_addr in METRICS_ALLOWED_IPS:
+        return True
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return (bool(METRICS_TOKEN) and scheme.lower() == 'bearer'
+            and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()))
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus (для сборщика метрик, см. metrics_access_allowed)"""
+    if not metrics_access_allowed():
+        return Response('Unauthorized\n', status=401, mimetype='text/plain',
+                        headers={'WWW-Authenticate': 'Bearer'})
+    snapshots, _ = collect_metrics()
+    return Response(metrics.to_prometheus(snapshots), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/performance')
+@login_required
+def performance():
+    """Страница производительности: задержки обработчиков бота, запросов к БД и медленные SQL-запросы"""
+    snapshots, bot_updated_at = collect_metrics()
+    sections = {process: metrics.summary(snapshot) for process, snapshot in snapshots.items()}
+    # Журнал медленных запросов общий для бота и админки, агрегаты по отпечаткам — только этого процесса
+    slow_queries = read_slow_log(SLOW_QUERY_LOG) if tracer else []
+    query_stats = tracer.stats(20) if tracer else []
+    return render_template('performance.html', sections=sections, bot_updated_at=bot_updated_at,
+                           slow_queries=slow_queries, query_stats=query_stats,
+                           slow_threshold_ms=SLOW_QUERY_MS)
+
+
 if __name__ == '__main__':
     # В продакшене используйте gunicorn или другой WSGI-сервер
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -0,0 +1,222 @@
+import logging
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from matching import top_k_order
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    """Нормирует строки матрицы (нулевые строки остаются нулевыми)"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+class IVFIndex:
+    """
+    Приближенный поиск ближайших по косинусу векторов (IVF): векторы психологов
+    нормируются и раскладываются по n_lists кластерам сферического k-means,
+    запрос просматривает только n_probe ближайших кластеров.
+
+    Индекс строится по одной размерности анкеты (самой частой среди векторов);
+    векторы другой размерности в него не попадают, как и в точном расчете они
+    получают 0% совместимости. add()/remove() работают инкрементально: новые векторы
+    приписываются к ближайшему центроиду, удаленные помечаются и вычищаются
+    при накоплении. Центроиды обновляются только полной перестройкой build().
+    """
+
+    def __init__(self, n_lists: int = 0, n_probe: int = 8, iterations: int = 10, seed: int = 0):
+        # n_lists=0 — число кластеров подбирается как sqrt(числа векторов)
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.iterations = iterations
+        self.seed = seed
+        self.dim: Optional[int] = None
+        self._centroids = np.empty((0, 0), dtype=np.float32)
+        self._ids = np.empty(0, dtype=np.int64)
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._alive = np.empty(0, dtype=bool)
+        self._size = 0
+        self._positions: Dict[int, int] = {}
+        self._lists: List[List[int]] = []
+        self._list_cache: Dict[int, np.ndarray] = {}
+        self._lock = threading.RLock()
+
+    @property
+    def is_built(self) -> bool:
+        return self.dim is not None
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._positions
+
+    def build(self, ids: Sequence[int], vectors: Sequence[Sequence[float]]):
+        """Полная перестройка: k-means по всем векторам основной размерности"""
+        vectors = [np.asarray(vector, dtype=np.float32) for vector in vectors]
+        ids = np.asarray(ids, dtype=np.int64)
+        dim = Counter(len(vector) for vector in vectors).most_common(1)[0][0] if vectors else None
+        keep = [i for i, vector in enumerate(vectors) if len(vector) == dim]
+        matrix = (_normalize(np.stack([vectors[i] for i in keep])) if keep
+                  else np.empty((0, dim or 0), dtype=np.float32))
+
+        with self._lock:
+            self.dim = dim
+            self._ids = ids[keep]
+            self._vectors = matrix
+            self._alive = np.ones(len(keep), dtype=bool)
+            self._size = len(keep)
+            self._positions = {user_id: row for row, user_id in enumerate(self._ids.tolist())}
+            self._centroids = self._kmeans(matrix)
+            assignments = self._assign(matrix)
+            self._lists = [[] for _ in range(len(self._centroids))]
+            for row, list_id in enumerate(assignments.tolist()):
+                self._lists[list_id].append(row)
+            self._list_cache = {}
+
+        logger.info(f"IVF index built: {len(keep)} vectors, {len(self._centroids)} lists, dim {dim}")
+
+    def _kmeans(self, matrix: np.ndarray) -> np.ndarray:
+        """Сферический k-means: центроиды — нормированные средние кластеров"""
+        if len(matrix) == 0:
+            return np.empty((0, matrix.shape[1]), dtype=np.float32)
+        n_lists = self.n_lists or int(np.sqrt(len(matrix)))
+        n_lists = max(1, min(n_lists, len(matrix)))
+
+        rng = np.random.default_rng(self.seed)
+        centroids = matrix[rng.choice(len(matrix), n_lists, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignments = np.argmax(matrix @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, matrix)
+            counts = np.bincount(assignments, minlength=n_lists)
+            # Пустой кластер получает случайную точку, чтобы не терять списки
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = matrix[rng.choice(len(matrix), len(empty))]
+            centroids = _normalize(sums)
+        return centroids.astype(np.float32)
+
+    def _assign(self, matrix: np.ndarray) -> np.ndarray:
+        if len(self._centroids) == 0:
+            return np.zeros(len(matrix), dtype=np.int64)
+        return np.argmax(matrix @ self._centroids.T, axis=1)
+
+    def add(self, user_id: int, vector: Sequence[float]) -> bool:
+        """Добавить или заменить вектор. False — размерность не совпала с индексом"""
+        vector = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        with self._lock:
+            self.remove(user_id)
+            if not self.is_built:
+                self.build([user_id], vector)
+                return True
+            if vector.shape[1] != self.dim:
+                return False
+            if not len(self._centroids):
+                self._centroids = _normalize(vector)
+                self._lists = [[]]
+
+            if self._size == len(self._ids):
+                capacity = max(16, 2 * len(self._ids))
+                self._ids = np.resize(self._ids, capacity)
+                self._alive = np.concatenate([self._alive, np.zeros(capacity - len(self._alive), dtype=bool)])
+                vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+                vectors[:self._size] = self._vectors[:self._size]
+                self._vectors = vectors
+
+            row = self._size
+            self._size += 1
+            normalized = _normalize(vector)
+            self._ids[row] = user_id
+            self._vectors[row] = normalized[0]
+            self._alive[row] = True
+            self._positions[user_id] = row
+            list_id = int(self._assign(normalized)[0])
+            self._lists[list_id].append(row)
+            self._list_cache.pop(list_id, None)
+            return True
+
+    def remove(self, user_id: int) -> bool:
+        with self._lock:
+            row = self._positions.pop(user_id, None)
+            if row is None:
+                return False
+            self._alive[row] = False
+            # Удаленные строки вычищаются из списков, когда их становится больше живых
+            if self._size - len(self._positions) > max(len(self._positions), 64):
+                self._compact()
+            return True
+
+    def _compact(self):
+        rows = np.array(sorted(self._positions.values()), dtype=np.int64)
+        old_to_new = {old: new for new, old in enumerate(rows.tolist())}
+        self._ids = self._ids[rows]
+        self._vectors = self._vectors[rows]
+        self._alive = np.ones(len(rows), dtype=bool)
+        self._size = len(rows)
+        self._positions = {user_id: row for row, user_id in enumerate(self._ids.tolist())}
+        self._lists = [[old_to_new[row] for row in rows_list if row in old_to_new] for rows_list in self._lists]
+        self._list_cache = {}
+
+    def _list_rows(self, list_id: int) -> np.ndarray:
+        rows = self._list_cache.get(list_id)
+        if rows is None:
+            rows = np.array(self._lists[list_id], dtype=np.int64)
+            self._list_cache[list_id] = rows
+        return rows
+
+    def search(self, query: Sequence[float], k: int,
+               n_probe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(id, косинусы) до k ближайших векторов по убыванию косинуса"""
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        empty = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        with self._lock:
+            if not self._positions or query.shape[0] != self.dim or k <= 0:
+                return empty
+            query_norm = np.linalg.norm(query)
+            if query_norm == 0:
+                return empty
+            query = query / query_norm
+
+            n_probe = min(n_probe or self.n_probe, len(self._centroids))
+            probes = np.argpartition(-(self._centroids @ query), n_probe - 1)[:n_probe]
+            rows = np.concatenate([self._list_rows(list_id) for list_id in probes.tolist()])
+            rows = rows[self._alive[rows]]
+            ids = self._ids[rows]
+            cosine = (self._vectors[rows] @ query).astype(np.float64)
+
+        order = top_k_order(ids, cosine, k)
+        return ids[order], cosine[order]
+
+
+def recall_at_k(matching_system, index: IVFIndex, patient_ids: Iterable[int], k: int = 10,
+                n_probe: Optional[int] = None) -> float:
+    """
+    Доля эталонного top-K, найденная индексом, в среднем по пациентам. Эталон —
+    calculate_match_percentage по векторам test_results, а не векторный расчет:
+    так recall ловит и расхождения самого индекса с исходной формулой.
+    Проценты округлены до десятых, поэтому найденный психолог с тем же процентом,
+    что и K-й в эталоне, тоже считается попаданием.
+    """
+    psychologists = matching_system.db.get_test_results('psychologist')
+    psychologist_ids = np.array([user_id for user_id, _ in psychologists], dtype=np.int64)
+    recalls = []
+    for patient_id in patient_ids:
+        patient_vector = matching_system.db.get_test_result(patient_id)
+        if patient_vector is None:
+            continue
+        reference = {user_id: matching_system.calculate_match_percentage(patient_vector, vector)
+                     for user_id, vector in psychologists}
+        scores = np.array([reference[user_id] for user_id in psychologist_ids.tolist()], dtype=np.float64)
+        exact = psychologist_ids[top_k_order(psychologist_ids, scores, k)].tolist()
+        if not exact:
+            continue
+        threshold = reference[exact[-1]]
+        found, _ = index.search(matching_system.db.get_test_vector(patient_id), k, n_probe)
+        hits = sum(1 for user_id in found.tolist() if reference.get(user_id, -1.0) >= threshold)
+        recalls.append(min(hits, len(exact)) / len(exact))
+    return float(np.mean(recalls)) if recalls else 1.0
@@ -0,0 +1,71 @@
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDatabase:
+    """
+    Асинхронный фасад над Database для обработчиков бота.
+
+    Все записи выполняются в одном выделенном потоке-писателе (SQLite все равно
+    допускает одного писателя), чтения — в пуле потоков. У каждого потока свое
+    постоянное соединение Database, поэтому event loop никогда не ждет SQLite.
+    Любой публичный метод Database доступен как awaitable: `await adb.get_user(1)`.
+    """
+
+    READ_PREFIXES = ('get_', 'is_', 'count_')
+    EXCLUDED_METHODS = {'get_connection', 'transaction', 'close', 'init_db'}
+
+    def __init__(self, db: Database, reader_threads: int = 4):
+        self.db = db
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads, thread_name_prefix='db-reader')
+
+    @classmethod
+    def is_read_method(cls, name: str) -> bool:
+        return name.startswith(cls.READ_PREFIXES)
+
+    async def _run(self, executor: ThreadPoolExecutor, func: Callable, *args, **kwargs) -> Any:
+        # Контекст копируется, чтобы contextvars (трассировка, бюджеты) доходили до потока БД
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(executor, call)
+
+    async def run_read(self, func: Callable, *args, **kwargs) -> Any:
+        """Выполнить произвольную читающую функцию в пуле читателей"""
+        return await self._run(self._readers, func, *args, **kwargs)
+
+    async def run_write(self, func: Callable, *args, **kwargs) -> Any:
+        """Выполнить произвольную пишущую функцию (например, пересчет совместимости) в потоке-писателе"""
+        return await self._run(self._writer, func, *args, **kwargs)
+
+    def __getattr__(self, name: str):
+        if name.startswith('_') or name in self.EXCLUDED_METHODS:
+            raise AttributeError(name)
+
+        method = getattr(self.db, name)
+        if not callable(method):
+            raise AttributeError(name)
+
+        run = self.run_read if self.is_read_method(name) else self.run_write
+
+        @functools.wraps(method)
+        async def async_method(*args, **kwargs):
+            return await run(method, *args, **kwargs)
+
+        # Кэшируем обертку, чтобы __getattr__ вызывался для метода один раз
+        setattr(self, name, async_method)
+        return async_method
+
+    def close(self):
+        """Дождаться завершения запросов и остановить потоки"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        logger.info("AsyncDatabase closed")
@@ -0,0 +1,268 @@
+import abc
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def utc_timestamp() -> str:
+    """Текущее время в формате CURRENT_TIMESTAMP SQLite (UTC)"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class PeriodicFlusher(abc.ABC):
+    """
+    Фоновая asyncio-задача, которая вызывает flush() раз в flush_interval секунд
+    или раньше, если буфер попросил об этом через _request_flush().
+    stop() останавливает задачу и выполняет финальный flush().
+    """
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name=type(self).__name__)
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception(f"{type(self).__name__}: flush failed")
+
+    def _request_flush(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    @abc.abstractmethod
+    async def flush(self):
+        """Записать накопленное; вызывается по таймеру, по _request_flush() и из stop()"""
+
+
+class ActionLogBuffer(PeriodicFlusher):
+    """
+    Буфер событий user_actions. События копятся в памяти и пишутся пачками через
+    Database.log_actions (executemany, одна транзакция) по размеру или по времени.
+
+    Очередь ограничена max_queue. При переполнении действует overflow:
+      - 'drop_oldest' — вытесняется самое старое событие;
+      - 'drop_newest' — новое событие отбрасывается;
+      - 'block'       — put() сначала дожидается сброса буфера (backpressure).
+    Отброшенные события считаются в self.dropped.
+
+    Пачка, которую не удалось записать, возвращается в начало очереди и уйдет
+    следующим сбросом (self.failed считает такие события). Если очередь за это время
+    переполнилась, лишнее вытесняется по той же политике: 'drop_oldest' отбрасывает
+    самые старые события, 'drop_newest' и 'block' — самые новые.
+    """
+
+    OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, adb, batch_size: int = 200, flush_interval: float = 1.0,
+                 max_queue: int = 10000, overflow: str = 'drop_oldest'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        super().__init__(flush_interval)
+        self.adb = adb
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self._queue = deque()
+        self._flush_lock = asyncio.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def add(self, user_id: int, action_type: str, action_data: Optional[str] = None) -> bool:
+        """Добавить событие без ожидания. Возвращает False, если событие отброшено"""
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            if self.overflow == 'drop_oldest':
+                self._queue.popleft()
+            else:
+                return False
+
+        self._queue.append((user_id, action_type, action_data, utc_timestamp()))
+        if len(self._queue) >= self.batch_size:
+            self._request_flush()
+        return True
+
+    async def put(self, user_id: int, action_type: str, action_data: Optional[str] = None) -> bool:
+        """Добавить событие; при политике 'block' и полной очереди сначала сбросить буфер"""
+        if self.overflow == 'block' and len(self._queue) >= self.max_queue:
+            await self.flush()
+            if len(self._queue) >= self.max_queue:
+                self.dropped += 1
+                return False
+        return self.add(user_id, action_type, action_data)
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._queue:
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                try:
+                    await self.adb.log_actions(batch)
+                except Exception:
+                    logger.exception(f"Failed to write {len(batch)} user actions")
+                    self.failed += len(batch)
+                    self._requeue(batch)
+                    return
+                self.written += len(batch)
+
+    def _requeue(self, batch):
+        """Вернуть незаписанную пачку в начало очереди в пределах max_queue"""
+        self._queue.extendleft(reversed(batch))
+        overflow = len(self._queue) - self.max_queue
+        if overflow <= 0:
+            return
+        self.dropped += overflow
+        for _ in range(overflow):
+            if self.overflow == 'drop_oldest':
+                self._queue.popleft()
+            else:
+                self._queue.pop()
+
+    def counters(self) -> Dict[str, int]:
+        return {
+            'pending': len(self._queue),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+class LastActiveTracker(PeriodicFlusher):
+    """
+    Отложенная запись users.last_active. touch() только запоминает время в памяти
+    (повторные касания одного пользователя схлопываются), а раз в flush_interval
+    секунд все касания пишутся одним пакетным UPDATE. Счетчики активности за 24 часа
+    отстают от реальности не больше чем на flush_interval.
+    """
+
+    def __init__(self, adb, flush_interval: float = 5.0):
+        super().__init__(flush_interval)
+        self.adb = adb
+        self._touched: Dict[int, str] = {}
+        self._flush_lock = asyncio.Lock()
+        self.written = 0
+
+    def touch(self, user_id: int):
+        self._touched[user_id] = utc_timestamp()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._touched:
+                return
+            batch, self._touched = self._touched, {}
+            try:
+                await self.adb.update_last_active_bulk(list(batch.items()))
+            except Exception:
+                logger.exception(f"Failed to write last_active for {len(batch)} users")
+                # Возвращаем касания в буфер, не затирая более свежие
+                for user_id, timestamp in batch.items():
+                    self._touched.setdefault(user_id, timestamp)
+                return
+            self.written += len(batch)
+
+    def counters(self) -> Dict[str, int]:
+        return {'pending': len(self._touched), 'written': self.written}
+
+
+class MatchMaintenanceWorker(PeriodicFlusher):
+    """
+    Фоновое обслуживание таблицы matches: раз в flush_interval секунд пересчитывает
+    пользователей, отмеченных MatchingSystem.mark_dirty или поставленных в очередь
+    Database.queue_match_update (админка), а раз в reconcile_interval
+    секунд запускает сверку порциями (0 — без сверки). Пересчет выполняется в
+    потоке-писателе AsyncDatabase, расчет порций сверки — в потоках-читателях.
+    """
+
+    def __init__(self, adb, matching_system, flush_interval: float = 5.0,
+                 reconcile_interval: float = 3600.0):
+        super().__init__(flush_interval)
+        self.adb = adb
+        self.matching_system = matching_system
+        self.reconcile_interval = reconcile_interval
+        self._last_reconcile = time.monotonic()
+
+    async def flush(self):
+        # Очередь match_updates могут пополнять другие процессы, поэтому проверяется каждый раз
+        await self.adb.run_write(self.matching_system.update_dirty)
+
+        if self.reconcile_interval > 0 and time.monotonic() - self._last_reconcile >= self.reconcile_interval:
+            self._last_reconcile = time.monotonic()
+            await self.reconcile()
+
+    async def reconcile(self, chunk_size: int = 500) -> Dict[str, int]:
+        """
+        Сверка порциями: расчет порции в потоке-читателе, запись ее расхождений — отдельной
+        короткой задачей потока-писателя, поэтому записи бота ждут не дольше одной порции
+        """
+        matching_system = self.matching_system
+        plan = await self.adb.run_read(matching_system.prepare_reconcile)
+        result = {'inserted': 0, 'updated': 0, 'deleted': 0}
+        try:
+            for chunk in plan.chunks(chunk_size):
+                diff = await self.adb.run_read(matching_system.reconcile_diff, plan, chunk)
+                result['deleted'] += await self.adb.run_write(matching_system.apply_reconcile_diff, diff)
+                result['inserted'] += diff.inserted
+                result['updated'] += diff.updated
+        finally:
+            matching_system.finish_reconcile(result)
+        return result
+
+
+class StatisticsMaintenance(PeriodicFlusher):
+    """
+    Раз в flush_interval секунд удаляет из activity_buckets корзины, вышедшие из
+    24-часового окна get_statistics (Database.prune_activity_buckets), чтобы таблица
+    не росла на одну корзину в час на каждый показатель.
+    """
+
+    def __init__(self, adb, flush_interval: float = 3600.0):
+        super().__init__(flush_interval)
+        self.adb = adb
+        self.pruned = 0
+
+    async def flush(self):
+        self.pruned += await self.adb.prune_activity_buckets()
+
+
+class MetricsDumper(PeriodicFlusher):
+    """
+    Раз в flush_interval секунд записывает снимок метрик процесса в файл,
+    откуда его читает админка (/metrics и страница производительности).
+    """
+
+    def __init__(self, metrics_registry, path: str, process: str = 'bot', flush_interval: float = 10.0):
+        super().__init__(flush_interval)
+        self.metrics_registry = metrics_registry
+        self.path = path
+        self.process = process
+
+    async def flush(self):
+        await asyncio.to_thread(self.metrics_registry.dump, self.path, self.process)
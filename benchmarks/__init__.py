@@ -0,0 +1,5 @@
+"""
+Нагрузочные замеры PsyMatch: генератор синтетических данных (generator),
+замеры горячих путей на нескольких масштабах (suite) и сравнение с базовым
+прогоном (compare). Запуск: python -m benchmarks --help
+"""
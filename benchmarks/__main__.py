@@ -0,0 +1,68 @@
+"""
+Запуск замеров:
+
+    python -m benchmarks --scales small,medium --output bench_results.json
+    python -m benchmarks --scales small --baseline benchmarks/baseline.json
+
+С --baseline печатается сравнение, и при регрессии код выхода 1.
+--save-baseline записывает результат как новый базовый прогон.
+"""
+
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.compare import compare, format_report, load_results, save_results
+from benchmarks.suite import SCALES, run_benchmarks
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Нагрузочные замеры PsyMatch на синтетических данных')
+    parser.add_argument('--scales', default='small', help=f"масштабы через запятую: {', '.join(SCALES)}")
+    parser.add_argument('--repeat', type=int, default=20, help='число повторов каждого замера')
+    parser.add_argument('--seed', type=int, default=42, help='seed генератора данных')
+    parser.add_argument('--only', default='', help='только эти замеры (через запятую)')
+    parser.add_argument('--output', default='bench_results.json', help='куда записать результаты (JSON)')
+    parser.add_argument('--baseline', help='базовый прогон для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.25, help='допустимое замедление медианы (доля)')
+    parser.add_argument('--save-baseline', action='store_true', help='записать результаты в --baseline')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    scales = [scale.strip() for scale in args.scales.split(',') if scale.strip()]
+    unknown = [scale for scale in scales if scale not in SCALES]
+    if unknown:
+        parser.error(f"unknown scales: {', '.join(unknown)}")
+
+    only = [name.strip() for name in args.only.split(',') if name.strip()]
+    results = run_benchmarks(scales, seed=args.seed, repeat=args.repeat, only=only)
+    save_results(results, args.output)
+    print(f"📝 Результаты записаны в {args.output}")
+
+    if args.baseline and args.save_baseline:
+        save_results(results, args.baseline)
+        print(f"📌 Базовый прогон обновлен: {args.baseline}")
+        return 0
+
+    if args.baseline:
+        rows = compare(results, load_results(args.baseline), threshold=args.threshold)
+        print(format_report(rows))
+        if any(row['regression'] for row in rows):
+            print("❌ Есть регрессии относительно базового прогона")
+            return 1
+        print("✅ Регрессий нет")
+    else:
+        for scale, scale_results in results['scales'].items():
+            print(f"\n== {scale}: {scale_results['setup']}")
+            for name, timings in scale_results['benchmarks'].items():
+                print(f"  {name:<40} median {timings['median_ms']:>9.3f} ms   p95 {timings['p95_ms']:>9.3f} ms")
+            for name, value in scale_results.get('quality', {}).items():
+                print(f"  {name:<40} {value:>9.4f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""
+Сравнение результатов замеров с сохраненным базовым прогоном.
+"""
+
+import json
+from typing import Dict, List
+
+# Замеры быстрее этого порога не считаются регрессией: шум таймера больше разницы
+MIN_SIGNIFICANT_MS = 1.0
+
+
+def load_results(path: str) -> Dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_results(results: Dict, path: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+def compare(results: Dict, baseline: Dict, threshold: float = 0.25,
+            metric: str = 'median_ms') -> List[Dict]:
+    """
+    Сравнить медианы с базовым прогоном. Возвращает строки по всем общим замерам:
+    scale, benchmark, baseline, current, change (доля) и regression — замедление
+    больше threshold (и больше MIN_SIGNIFICANT_MS в абсолютных значениях).
+    """
+    rows = []
+    for scale, scale_results in results['scales'].items():
+        baseline_scale = baseline.get('scales', {}).get(scale)
+        if not baseline_scale:
+            continue
+        for name, timings in scale_results['benchmarks'].items():
+            baseline_timings = baseline_scale['benchmarks'].get(name)
+            if not baseline_timings:
+                continue
+            before, after = baseline_timings[metric], timings[metric]
+            change = (after - before) / before if before > 0 else 0.0
+            rows.append({
+                'scale': scale,
+                'benchmark': name,
+                'baseline': before,
+                'current': after,
+                'change': round(change, 3),
+                'regression': change > threshold and after - before > MIN_SIGNIFICANT_MS,
+            })
+    return rows
+
+
+def format_report(rows: List[Dict]) -> str:
+    lines = [f"{'scale':<8} {'benchmark':<40} {'baseline':>10} {'current':>10} {'change':>8}"]
+    for row in rows:
+        mark = '  ❌ REGRESSION' if row['regression'] else ''
+        lines.append(
+            f"{row['scale']:<8} {row['benchmark']:<40} {row['baseline']:>10.3f} "
+            f"{row['current']:>10.3f} {row['change']:>+8.1%}{mark}"
+        )
+    return '\n'.join(lines)
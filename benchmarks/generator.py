@@ -0,0 +1,223 @@
+"""
+Детерминированный генератор синтетических данных для нагрузочных замеров.
+
+Данные пишутся напрямую пакетными executemany внутри Database.transaction(),
+минуя построчные методы Database: миллионы user_actions загружаются за секунды.
+Один и тот же seed дает одну и ту же БД; время (регистрация, активность, лайки,
+события) отсчитывается от now, чтобы выборки «за 24 часа» были непустыми.
+"""
+
+import json
+import logging
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from vectors import pack_vector
+
+logger = logging.getLogger(__name__)
+
+QUESTIONS_PATH = Path(__file__).parent.parent / 'test_questions.json'
+
+FIRST_NAMES = ['Анна', 'Дмитрий', 'Мария', 'Иван', 'Елена', 'Сергей', 'Ольга', 'Алексей', 'Наталья', 'Павел']
+LAST_NAMES = ['Иванова', 'Петров', 'Смирнова', 'Кузнецов', 'Попова', 'Соколов', 'Лебедева', 'Морозов']
+APPROACHES = ['КПТ', 'Гештальт', 'Психоанализ', 'Схема-терапия', 'АСТ', 'Системная семейная терапия']
+REQUESTS = ['Тревога', 'Депрессия', 'Отношения', 'Самооценка', 'Выгорание', 'Утрата', 'Панические атаки']
+PRICES = ['1000-2000', '2000-3000', '3000-5000', '5000+']
+
+# Типы событий user_actions с частотами, близкими к реальному логу бота
+ACTION_TYPES = [
+    ('card_viewed', 0.45), ('test_answer', 0.2), ('browse_start', 0.1), ('like_sent', 0.08),
+    ('view_likes', 0.06), ('test_completed', 0.03), ('match_created', 0.02),
+    ('patient_request_entered', 0.02), ('view_stats', 0.02), ('profile_deleted', 0.02),
+]
+
+
+@dataclass
+class Scale:
+    """Размер синтетического набора данных"""
+    psychologists: int
+    patients: int
+    likes_per_patient: float = 5.0
+    mutual_rate: float = 0.2
+    actions: int = 100_000
+
+
+def load_weights() -> np.ndarray:
+    """Матрица весов анкеты (вопросы × измерения) из test_questions.json"""
+    with open(QUESTIONS_PATH, 'r', encoding='utf-8') as f:
+        questions = json.load(f)
+    return np.array([question['weights'] for question in questions], dtype=np.float64)
+
+
+def values_vectors(rng: np.random.Generator, count: int, weights: np.ndarray) -> np.ndarray:
+    """Векторы ценностей для случайных ответов 0..4 (как PsychologicalTest.calculate_values_vector)"""
+    answers = rng.integers(0, 5, size=(count, weights.shape[0]))
+    vectors = answers @ weights
+    max_values = np.abs(vectors).max(axis=1, keepdims=True)
+    return np.divide(vectors, max_values, out=vectors.copy(), where=max_values > 0)
+
+
+def _timestamp(now: datetime, seconds_ago: float) -> str:
+    return (now - timedelta(seconds=float(seconds_ago))).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class SyntheticDataGenerator:
+    """
+    Заполняет Database синтетическими психологами, пациентами, результатами теста,
+    лайками (часть взаимных) и событиями user_actions.
+    Психологи получают id 1..N, пациенты — N+1..N+M.
+    """
+
+    def __init__(self, db, seed: int = 42, now: Optional[datetime] = None, chunk_size: int = 50_000):
+        self.db = db
+        self.seed = seed
+        self.now = now or datetime.now(timezone.utc)
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(seed)
+
+    def generate(self, scale: Scale) -> Dict[str, int]:
+        """Сгенерировать полный набор данных. Возвращает число строк по таблицам"""
+        psychologist_ids = list(range(1, scale.psychologists + 1))
+        patient_ids = list(range(scale.psychologists + 1, scale.psychologists + scale.patients + 1))
+
+        counts = {
+            'users': self._insert_users(psychologist_ids, patient_ids),
+            'test_results': self._insert_test_results(psychologist_ids + patient_ids),
+            'likes': self._insert_likes(patient_ids, psychologist_ids, scale),
+            'user_actions': self._insert_actions(psychologist_ids + patient_ids, scale.actions),
+        }
+        logger.info(f"Synthetic data generated (seed {self.seed}): {counts}")
+        return counts
+
+    def _executemany(self, query: str, rows: Iterator[Tuple]) -> int:
+        """executemany по chunk_size строк, каждый кусок — своя транзакция"""
+        total = 0
+        chunk: List[Tuple] = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                with self.db.transaction() as cursor:
+                    cursor.executemany(query, chunk)
+                total += len(chunk)
+                chunk = []
+        if chunk:
+            with self.db.transaction() as cursor:
+                cursor.executemany(query, chunk)
+            total += len(chunk)
+        return total
+
+    def _insert_users(self, psychologist_ids: List[int], patient_ids: List[int]) -> int:
+        rng = self.rng
+        all_ids = psychologist_ids + patient_ids
+        registered = rng.uniform(0, 365 * 86400, len(all_ids))
+        active = np.minimum(registered, rng.exponential(2 * 86400, len(all_ids)))
+
+        users = [
+            (user_id, f'user{user_id}', 'psychologist' if user_id <= len(psychologist_ids) else 'patient',
+             _timestamp(self.now, registered[i]), _timestamp(self.now, active[i]))
+            for i, user_id in enumerate(all_ids)
+        ]
+        count = self._executemany('''
+            INSERT INTO users (user_id, username, user_type, registration_date, last_active, test_completed)
+            VALUES (?, ?, ?, ?, ?, 1)
+        ''', iter(users))
+
+        def psychologist_profiles():
+            for user_id in psychologist_ids:
+                yield (
+                    user_id,
+                    f'{FIRST_NAMES[rng.integers(len(FIRST_NAMES))]} {LAST_NAMES[rng.integers(len(LAST_NAMES))]}',
+                    f'photo_{user_id}', ['Женский', 'Мужской'][rng.integers(2)], int(rng.integers(25, 65)),
+                    'Факультет психологии', 'Синтетический профиль для замеров производительности',
+                    APPROACHES[rng.integers(len(APPROACHES))],
+                    ', '.join(rng.choice(REQUESTS, 3, replace=False)),
+                    PRICES[rng.integers(len(PRICES))], f'{rng.integers(1, 30)} лет', f'@psych{user_id}',
+                )
+
+        self._executemany('''
+            INSERT INTO psychologist_profiles
+            (user_id, name, photo_file_id, gender, age, education, about_me,
+             approach, work_requests, price, experience, contact)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', psychologist_profiles())
+        self._executemany('''
+            INSERT INTO patient_profiles (user_id, main_request, contact)
+            VALUES (?, ?, ?)
+        ''', ((user_id, REQUESTS[rng.integers(len(REQUESTS))], f'@patient{user_id}') for user_id in patient_ids))
+        return count
+
+    def _insert_test_results(self, user_ids: List[int]) -> int:
+        vectors = values_vectors(self.rng, len(user_ids), load_weights())
+
+        def rows():
+            for user_id, vector in zip(user_ids, vectors):
+                blob, norm, dim = pack_vector(vector)
+                yield user_id, json.dumps(vector.tolist()), blob, norm, dim
+
+        return self._executemany('''
+            INSERT INTO test_results (user_id, values_vector, vector_blob, vector_norm, vector_dim)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows())
+
+    def _insert_likes(self, patient_ids: List[int], psychologist_ids: List[int], scale: Scale) -> int:
+        """Лайки пациентов психологам (число на пациента ~ Пуассон) и часть ответных лайков"""
+        rng = self.rng
+        rows = []
+        for patient_id in patient_ids:
+            count = min(int(rng.poisson(scale.likes_per_patient)), len(psychologist_ids))
+            if not count:
+                continue
+            # Популярные психологи (малые id) получают больше лайков
+            targets = np.unique(np.minimum(
+                rng.zipf(1.3, count * 2), len(psychologist_ids)
+            ))[:count]
+            for psychologist_id in targets.tolist():
+                seconds_ago = rng.uniform(0, 30 * 86400)
+                mutual = int(rng.random() < scale.mutual_rate)
+                rows.append((seconds_ago, patient_id, psychologist_id, mutual))
+                if mutual:
+                    rows.append((seconds_ago * rng.uniform(0, 1), psychologist_id, patient_id, 1))
+
+        # id лайков растут вместе с датой, как при настоящей записи
+        rows.sort(key=lambda row: -row[0])
+        return self._executemany('''
+            INSERT INTO likes (from_user_id, to_user_id, liked_date, is_mutual)
+            VALUES (?, ?, ?, ?)
+        ''', ((from_id, to_id, _timestamp(self.now, seconds_ago), mutual)
+              for seconds_ago, from_id, to_id, mutual in rows))
+
+    def _insert_actions(self, user_ids: List[int], count: int) -> int:
+        """count событий user_actions в хронологическом порядке за последние 30 дней"""
+        types = [action_type for action_type, _ in ACTION_TYPES]
+        probabilities = np.array([weight for _, weight in ACTION_TYPES])
+        probabilities /= probabilities.sum()
+        user_ids = np.asarray(user_ids)
+
+        def rows():
+            done = 0
+            while done < count:
+                size = min(self.chunk_size, count - done)
+                users = user_ids[self.rng.integers(0, len(user_ids), size)]
+                kinds = self.rng.choice(len(types), size, p=probabilities)
+                seconds_ago = 30 * 86400 * (1 - (done + np.arange(size)) / count)
+                for user_id, kind, ago in zip(users.tolist(), kinds.tolist(), seconds_ago.tolist()):
+                    yield user_id, types[kind], None, _timestamp(self.now, ago)
+                done += size
+
+        return self._executemany('''
+            INSERT INTO user_actions (user_id, action_type, action_data, timestamp)
+            VALUES (?, ?, ?, ?)
+        ''', rows())
+
+
+def generate(db, scale: Scale, seed: int = 42, now: Optional[datetime] = None) -> Dict[str, int]:
+    """Заполнить db синтетическими данными заданного масштаба"""
+    return SyntheticDataGenerator(db, seed=seed, now=now).generate(scale)
+
+
+def scale_to_dict(scale: Scale) -> Dict:
+    return asdict(scale)
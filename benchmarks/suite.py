@@ -0,0 +1,168 @@
+"""
+Замеры горячих путей Database и MatchingSystem на синтетических данных нескольких масштабов.
+
+Для каждого масштаба создается временная БД, заполняется generator.generate,
+после чего каждый замер выполняется repeat раз на разных пользователях.
+Кроме времени, для IVF-индекса считается recall@K против calculate_match_percentage.
+Результат — словарь, который __main__ сохраняет в JSON.
+"""
+
+import os
+import platform
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from ann_index import IVFIndex, recall_at_k
+from benchmarks.generator import Scale, generate, scale_to_dict
+from database import Database
+from matching import MatchingSystem
+
+SCALES: Dict[str, Scale] = {
+    'tiny': Scale(psychologists=20, patients=100, actions=2_000),
+    'small': Scale(psychologists=200, patients=2_000, actions=100_000),
+    'medium': Scale(psychologists=1_000, patients=10_000, actions=1_000_000),
+    'large': Scale(psychologists=5_000, patients=50_000, actions=3_000_000),
+}
+# recall@K индекса: K и числа просматриваемых кластеров
+RECALL_K = 10
+RECALL_PROBES = (1, 2, 4, 8)
+
+
+def _timings(func: Callable[[int], object], repeat: int) -> Dict[str, float]:
+    """Время repeat вызовов func(i) в миллисекундах: min, медиана, p95"""
+    samples = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(i)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        'min_ms': round(samples[0], 3),
+        'median_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'runs': repeat,
+    }
+
+
+class BenchmarkRun:
+    """Подготовленная БД одного масштаба и набор замеров над ней"""
+
+    def __init__(self, scale: Scale, seed: int = 42, repeat: int = 20):
+        self.scale = scale
+        self.seed = seed
+        self.repeat = repeat
+        self.rng = np.random.default_rng(seed)
+        self.directory = tempfile.mkdtemp(prefix='psymatch-bench-')
+        self.db = Database(os.path.join(self.directory, 'bench.db'))
+        self.matching_system = MatchingSystem(self.db)
+        self.topk_system = MatchingSystem(self.db, ranking_mode='topk', top_k=RECALL_K)
+        self.ann_index = IVFIndex()
+        self.ann_system = MatchingSystem(self.db, ranking_mode='topk', top_k=RECALL_K,
+                                         ann_index=self.ann_index)
+
+    def setup(self) -> Dict[str, float]:
+        started = time.perf_counter()
+        rows = generate(self.db, self.scale, seed=self.seed)
+        self.db.set_feature_flag('psychological_test_and_matching', True)
+        self.patient_ids = (self.scale.psychologists + 1
+                            + self.rng.choice(self.scale.patients, self.repeat,
+                                              replace=self.repeat > self.scale.patients)).tolist()
+        self.psychologist_ids = (1 + self.rng.choice(self.scale.psychologists, self.repeat,
+                                                     replace=self.repeat > self.scale.psychologists)).tolist()
+        # Совместимость нужна только пациентам, на которых идут замеры чтения
+        for patient_id in self.patient_ids:
+            self.matching_system.calculate_all_matches_for_patient(patient_id)
+        return {'generate_s': round(time.perf_counter() - started, 2), **rows}
+
+    def _new_like_pairs(self, taken: Iterable[tuple] = ()) -> List[tuple]:
+        """Пары пациент → психолог, которых еще нет в likes (и нет среди taken)"""
+        existing = set(tuple(row) for row in self.db.get_connection().execute(
+            'SELECT from_user_id, to_user_id FROM likes'
+        ))
+        existing.update(taken)
+        pairs = []
+        for i in range(self.repeat):
+            patient_id = self.patient_ids[i]
+            psychologist_id = self.scale.psychologists
+            while (patient_id, psychologist_id) in existing or (patient_id, psychologist_id) in pairs:
+                psychologist_id -= 1
+            pairs.append((patient_id, psychologist_id))
+        return pairs
+
+    def benchmarks(self) -> Dict[str, Callable[[int], object]]:
+        like_pairs = self._new_like_pairs()
+        enriched_like_pairs = self._new_like_pairs(taken=like_pairs)
+        return {
+            'calculate_all_matches_for_patient':
+                lambda i: self.matching_system.calculate_all_matches_for_patient(self.patient_ids[i]),
+            'calculate_all_matches_for_psychologist':
+                lambda i: self.matching_system.calculate_all_matches_for_psychologist(self.psychologist_ids[i]),
+            'get_psychologists_for_patient':
+                lambda i: self.db.get_psychologists_for_patient(self.patient_ids[i]),
+            'get_psychologists_page':
+                lambda i: self.db.get_psychologists_page(self.patient_ids[i], limit=2),
+            'create_like': lambda i: self.db.create_like(*like_pairs[i]),
+            # Путь лайка бота: лайк, профили обоих и совместимость одной транзакцией
+            'create_like_enriched': lambda i: self.db.create_like_enriched(*enriched_like_pairs[i]),
+            'top_k_for_patient': lambda i: self.topk_system.top_k_for_patient(self.patient_ids[i]),
+            'top_k_for_patient_ann': lambda i: self.ann_system.top_k_for_patient(self.patient_ids[i]),
+            'get_statistics': lambda i: self.db.get_statistics(),
+            'get_all_users_with_stats': lambda i: self.db.get_all_users_with_stats(),
+        }
+
+    def quality(self) -> Dict[str, float]:
+        """recall@K IVF-индекса на пациентах замеров для каждого n_probe из RECALL_PROBES"""
+        self.ann_system.build_ann_index()
+        return {
+            f'ann_recall_at_{RECALL_K}_probe_{n_probe}':
+                round(recall_at_k(self.matching_system, self.ann_index, self.patient_ids,
+                                  k=RECALL_K, n_probe=n_probe), 4)
+            for n_probe in RECALL_PROBES
+        }
+
+    def run(self, only: Optional[Iterable[str]] = None) -> Dict:
+        setup = self.setup()
+        only = set(only) if only else None
+        results = {}
+        for name, func in self.benchmarks().items():
+            if only is None or name in only:
+                results[name] = _timings(func, self.repeat)
+        quality = self.quality() if only is None or 'ann_recall' in only else {}
+        return {'scale': scale_to_dict(self.scale), 'setup': setup, 'benchmarks': results,
+                'quality': quality}
+
+    def close(self):
+        self.db.close()
+        for name in os.listdir(self.directory):
+            os.unlink(os.path.join(self.directory, name))
+        os.rmdir(self.directory)
+
+
+def run_benchmarks(scales: Iterable[str], seed: int = 42, repeat: int = 20,
+                   only: Optional[Iterable[str]] = None) -> Dict:
+    """Прогнать замеры на перечисленных масштабах из SCALES"""
+    results = {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'seed': seed,
+            'repeat': repeat,
+        },
+        'scales': {},
+    }
+    for name in scales:
+        run = BenchmarkRun(SCALES[name], seed=seed, repeat=repeat)
+        try:
+            results['scales'][name] = run.run(only)
+        finally:
+            run.close()
+    return results
@@ -1,18 +1,34 @@
 import os
 import json
+import asyncio
+import inspect
 import logging
 from datetime import datetime
 from typing import Dict, Optional
 from dotenv import load_dotenv
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaPhoto
+)
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
     ConversationHandler, ContextTypes, filters
 )
 
 from database import Database
+from async_database import AsyncDatabase
+from background import (ActionLogBuffer, LastActiveTracker, MatchMaintenanceWorker, MetricsDumper,
+                        StatisticsMaintenance)
 from matching import MatchingSystem, PsychologicalTest
+from ann_index import IVFIndex
+from vector_store import VectorStore
+import metrics
+import query_budget
+from metrics import instrument_database
+from sql_tracer import SQLTracer
+from outbound import INTERACTIVE, NOTIFICATION, OutboundQueue, RenderCoalescer
+from render_cache import RenderCache
 
 load_dotenv()
 
@@ -29,24 +45,58 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()]
 DB_PATH = os.getenv('DATABASE_PATH', 'psymatch.db')
-
-with open('messages.json', 'r', encoding='utf-8') as f:
+FEATURE_FLAG_CACHE_TTL = float(os.getenv('FEATURE_FLAG_CACHE_TTL', '2'))
+MATCH_RECONCILE_INTERVAL = float(os.getenv('MATCH_RECONCILE_INTERVAL', '3600'))
+MATCH_RANKING_MODE = os.getenv('MATCH_RANKING_MODE', 'materialized')
+MATCH_TOP_K = int(os.getenv('MATCH_TOP_K', '50'))
+MATCH_ANN_INDEX = os.getenv('MATCH_ANN_INDEX', '0') == '1'
+MATCH_ANN_PROBES = int(os.getenv('MATCH_ANN_PROBES', '8'))
+VECTOR_STORE_PATH = os.getenv('VECTOR_STORE_PATH', '')
+METRICS_PATH = os.getenv('METRICS_PATH', 'metrics_bot.json')
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', '10'))
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '100'))
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', 'slow_queries.log')
+SLOW_QUERY_LOG_PARAMS = os.getenv('SLOW_QUERY_LOG_PARAMS', '0') == '1'
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+# Сколько последних сообщений с карточками пользователя помнит бот (фото и курсор в каждом)
+CARD_MESSAGES_LIMIT = 20
+
+MESSAGES_PATH = 'messages.json'
+
+with open(MESSAGES_PATH, 'r', encoding='utf-8') as f:
     MESSAGES = json.load(f)
 
 with open('test_questions.json', 'r', encoding='utf-8') as f:
     TEST_QUESTIONS = json.load(f)
 
-db = Database(DB_PATH)
-matching_system = MatchingSystem(db)
+tracer = SQLTracer(slow_threshold_ms=SLOW_QUERY_MS, log_path=SLOW_QUERY_LOG,
+                   log_params=SLOW_QUERY_LOG_PARAMS) if SLOW_QUERY_MS > 0 else None
+db = instrument_database(Database(DB_PATH, flag_cache_ttl=FEATURE_FLAG_CACHE_TTL, tracer=tracer))
+adb = AsyncDatabase(db)
+action_log = ActionLogBuffer(adb)
+last_active = LastActiveTracker(adb)
+matching_system = MatchingSystem(
+    db, ranking_mode=MATCH_RANKING_MODE, top_k=MATCH_TOP_K,
+    ann_index=IVFIndex(n_probe=MATCH_ANN_PROBES) if MATCH_ANN_INDEX else None,
+    vector_store=VectorStore(VECTOR_STORE_PATH) if VECTOR_STORE_PATH else None
+)
+metrics.registry.instrument_methods(matching_system, 'matching')
+match_maintenance = MatchMaintenanceWorker(adb, matching_system, reconcile_interval=MATCH_RECONCILE_INTERVAL)
+statistics_maintenance = StatisticsMaintenance(adb)
+metrics_dumper = MetricsDumper(metrics.registry, METRICS_PATH, flush_interval=METRICS_DUMP_INTERVAL)
+outbound = OutboundQueue(global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE)
+card_renders = RenderCoalescer()
 psychological_test = PsychologicalTest(TEST_QUESTIONS)
+render_cache = RenderCache(MESSAGES, TEST_QUESTIONS)
 
 CHOOSING_ROLE, PATIENT_REQUEST, PATIENT_CONTACT = range(3)
 PSYCH_PHOTO, PSYCH_NAME, PSYCH_GENDER, PSYCH_AGE, PSYCH_EDUCATION, PSYCH_ABOUT, PSYCH_APPROACH, PSYCH_REQUESTS, PSYCH_PRICE, PSYCH_EXPERIENCE, PSYCH_CONTACT = range(3, 14)
 TEST_IN_PROGRESS = 14
 
 
-def log_user_action(user_id: int, action_type: str, action_data: Optional[str] = None):
-    db.log_action(user_id, action_type, action_data)
+async def log_user_action(user_id: int, action_type: str, action_data: Optional[str] = None):
+    await action_log.put(user_id, action_type, action_data)
     logger.info(f"User {user_id} - {action_type}: {action_data}")
 
 
@@ -54,14 +104,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     
     # Проверка блокировки
-    if db.is_user_blocked(user.id):
+    if await adb.is_user_blocked(user.id):
         await update.message.reply_text("❌ Ваш аккаунт заблокирован. Обратитесь к администратору.")
         return ConversationHandler.END
     
-    db.update_last_active(user.id)
-    log_user_action(user.id, "command_start")
+    last_active.touch(user.id)
+    await log_user_action(user.id, "command_start")
     
-    existing_user = db.get_user(user.id)
+    existing_user = await adb.get_user(user.id)
     if existing_user:
         if existing_user['test_completed']:
             await show_main_menu(update, context)
@@ -81,14 +131,15 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Удаление профиля пользователя и начало заново"""
     user_id = update.effective_user.id
     
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     if not user:
         await update.message.reply_text("Вы еще не зарегистрированы. Используйте /start")
         return
     
     # Удаляем профиль пользователя
-    db.delete_user_profile(user_id)
-    log_user_action(user_id, "profile_deleted")
+    await adb.delete_user_profile(user_id)
+    await adb.run_write(matching_system.forget_user, user_id)
+    await log_user_action(user_id, "profile_deleted")
     
     keyboard = [
         [InlineKeyboardButton(MESSAGES['role_patient'], callback_data='role_patient')],
@@ -110,8 +161,8 @@ async def role_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     role = query.data.split('_')[1]
     
-    db.create_user(user.id, user.username, role)
-    log_user_action(user.id, "role_selected", role)
+    await adb.create_user(user.id, user.username, role)
+    await log_user_action(user.id, "role_selected", role)
     
     context.user_data['role'] = role
     context.user_data['profile_data'] = {}
@@ -126,10 +177,10 @@ async def role_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def patient_request_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     context.user_data['profile_data']['request'] = update.message.text
-    log_user_action(user_id, "patient_request_entered", update.message.text[:50])
+    await log_user_action(user_id, "patient_request_entered", update.message.text[:50])
     
     await update.message.reply_text(MESSAGES['registration_patient_contact'])
     return PATIENT_CONTACT
@@ -137,16 +188,18 @@ async def patient_request_received(update: Update, context: ContextTypes.DEFAULT
 
 async def patient_contact_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     contact = update.message.text
     request = context.user_data['profile_data']['request']
     
-    db.save_patient_profile(user_id, request, contact)
-    log_user_action(user_id, "patient_profile_completed")
+    await adb.save_patient_profile(user_id, request, contact)
+    # Роль могла смениться после /restart: строки пользователя сверяются фоновым пересчетом
+    matching_system.mark_dirty(user_id)
+    await log_user_action(user_id, "patient_profile_completed")
     
     # Проверяем фича-флаг для теста
-    if db.get_feature_flag('psychological_test_and_matching'):
+    if await adb.get_feature_flag('psychological_test_and_matching'):
         await start_psychological_test(update, context)
         return TEST_IN_PROGRESS
     else:
@@ -157,7 +210,7 @@ async def patient_contact_received(update: Update, context: ContextTypes.DEFAULT
 
 async def psychologist_photo_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     if not update.message.photo:
         await update.message.reply_text(MESSAGES['error_photo_required'])
@@ -165,7 +218,7 @@ async def psychologist_photo_received(update: Update, context: ContextTypes.DEFA
     
     photo = update.message.photo[-1]
     context.user_data['profile_data']['photo_file_id'] = photo.file_id
-    log_user_action(user_id, "psychologist_photo_uploaded")
+    await log_user_action(user_id, "psychologist_photo_uploaded")
     
     await update.message.reply_text(MESSAGES['registration_psychologist_name'])
     return PSYCH_NAME
@@ -173,10 +226,10 @@ async def psychologist_photo_received(update: Update, context: ContextTypes.DEFA
 
 async def psychologist_name_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     context.user_data['profile_data']['name'] = update.message.text
-    log_user_action(user_id, "psychologist_name_entered")
+    await log_user_action(user_id, "psychologist_name_entered")
     
     keyboard = [
         [InlineKeyboardButton("Мужской", callback_data='gender_male')],
@@ -193,14 +246,14 @@ async def psychologist_gender_received(update: Update, context: ContextTypes.DEF
     await query.answer()
     
     user_id = query.from_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     gender_map = {
         'gender_male': 'Мужской',
         'gender_female': 'Женский'
     }
     context.user_data['profile_data']['gender'] = gender_map.get(query.data, 'Не указано')
-    log_user_action(user_id, "psychologist_gender_entered")
+    await log_user_action(user_id, "psychologist_gender_entered")
     
     await query.edit_message_text(MESSAGES['registration_psychologist_age'])
     return PSYCH_AGE
@@ -208,7 +261,7 @@ async def psychologist_gender_received(update: Update, context: ContextTypes.DEF
 
 async def psychologist_age_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     try:
         age = int(update.message.text)
@@ -220,7 +273,7 @@ async def psychologist_age_received(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("Пожалуйста, укажите возраст числом:")
         return PSYCH_AGE
     
-    log_user_action(user_id, "psychologist_age_entered")
+    await log_user_action(user_id, "psychologist_age_entered")
     
     await update.message.reply_text(MESSAGES['registration_psychologist_education'])
     return PSYCH_EDUCATION
@@ -228,10 +281,10 @@ async def psychologist_age_received(update: Update, context: ContextTypes.DEFAUL
 
 async def psychologist_education_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     context.user_data['profile_data']['education'] = update.message.text
-    log_user_action(user_id, "psychologist_education_entered")
+    await log_user_action(user_id, "psychologist_education_entered")
     
     await update.message.reply_text(MESSAGES['registration_psychologist_about'])
     return PSYCH_ABOUT
@@ -239,10 +292,10 @@ async def psychologist_education_received(update: Update, context: ContextTypes.
 
 async def psychologist_about_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     context.user_data['profile_data']['about_me'] = update.message.text
-    log_user_action(user_id, "psychologist_about_entered")
+    await log_user_action(user_id, "psychologist_about_entered")
     
     keyboard = [
         [InlineKeyboardButton("Когнитивно-поведенческая терапия (КПТ)", callback_data='approach_cbt')],
@@ -265,7 +318,7 @@ async def psychologist_approach_received(update: Update, context: ContextTypes.D
     await query.answer()
     
     user_id = query.from_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     approach_map = {
         'approach_cbt': 'Когнитивно-поведенческая терапия (КПТ)',
@@ -278,7 +331,7 @@ async def psychologist_approach_received(update: Update, context: ContextTypes.D
         'approach_other': 'Другое'
     }
     context.user_data['profile_data']['approach'] = approach_map.get(query.data, 'Не указано')
-    log_user_action(user_id, "psychologist_approach_entered")
+    await log_user_action(user_id, "psychologist_approach_entered")
     
     await query.edit_message_text(MESSAGES['registration_psychologist_requests'])
     return PSYCH_REQUESTS
@@ -286,10 +339,10 @@ async def psychologist_approach_received(update: Update, context: ContextTypes.D
 
 async def psychologist_requests_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     context.user_data['profile_data']['work_requests'] = update.message.text
-    log_user_action(user_id, "psychologist_requests_entered")
+    await log_user_action(user_id, "psychologist_requests_entered")
     
     keyboard = [
         [InlineKeyboardButton("Бесплатная первая консультация", callback_data='price_free')],
@@ -309,7 +362,7 @@ async def psychologist_price_received(update: Update, context: ContextTypes.DEFA
     await query.answer()
     
     user_id = query.from_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     price_map = {
         'price_free': 'Бесплатная первая консультация',
@@ -319,7 +372,7 @@ async def psychologist_price_received(update: Update, context: ContextTypes.DEFA
         'price_individual': 'Обсуждается индивидуально'
     }
     context.user_data['profile_data']['price'] = price_map.get(query.data, 'Не указано')
-    log_user_action(user_id, "psychologist_price_entered")
+    await log_user_action(user_id, "psychologist_price_entered")
     
     await query.edit_message_text(MESSAGES['registration_psychologist_experience'])
     return PSYCH_EXPERIENCE
@@ -327,10 +380,10 @@ async def psychologist_price_received(update: Update, context: ContextTypes.DEFA
 
 async def psychologist_experience_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     context.user_data['profile_data']['experience'] = update.message.text
-    log_user_action(user_id, "psychologist_experience_entered")
+    await log_user_action(user_id, "psychologist_experience_entered")
     
     await update.message.reply_text(MESSAGES['registration_psychologist_contact'])
     return PSYCH_CONTACT
@@ -338,11 +391,11 @@ async def psychologist_experience_received(update: Update, context: ContextTypes
 
 async def psychologist_contact_received(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     profile_data = context.user_data['profile_data']
     
-    db.save_psychologist_profile(
+    await adb.save_psychologist_profile(
         user_id,
         profile_data['name'],
         profile_data['photo_file_id'],
@@ -356,10 +409,13 @@ async def psychologist_contact_received(update: Update, context: ContextTypes.DE
         work_requests=profile_data.get('work_requests'),
         price=profile_data.get('price')
     )
-    log_user_action(user_id, "psychologist_profile_completed")
+    # Новая profile_version и так дает новый ключ; старые подписи освобождаем сразу
+    render_cache.invalidate(user_id)
+    matching_system.mark_dirty(user_id)
+    await log_user_action(user_id, "psychologist_profile_completed")
     
     # Проверяем фича-флаг для теста
-    if db.get_feature_flag('psychological_test_and_matching'):
+    if await adb.get_feature_flag('psychological_test_and_matching'):
         await start_psychological_test(update, context)
         return TEST_IN_PROGRESS
     else:
@@ -382,24 +438,14 @@ async def start_psychological_test(update: Update, context: ContextTypes.DEFAULT
 
 
 async def send_test_question(update: Update, context: ContextTypes.DEFAULT_TYPE, question_index: int):
-    question_data = psychological_test.get_question(question_index)
+    # Текст и клавиатура вопросов собраны заранее (render_cache.py)
+    question = render_cache.question(question_index)
     
-    if not question_data:
+    if not question:
         await complete_test(update, context)
         return
     
-    total = psychological_test.get_total_questions()
-    question_text = MESSAGES['test_question_template'].format(
-        current=question_index + 1,
-        total=total,
-        question=question_data['question']
-    )
-    
-    keyboard = []
-    for i, option in enumerate(question_data['options']):
-        keyboard.append([InlineKeyboardButton(option, callback_data=f'test_answer_{question_index}_{i}')])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    question_text, reply_markup = question
     
     if update.callback_query:
         await update.callback_query.edit_message_text(question_text, reply_markup=reply_markup)
@@ -412,14 +458,14 @@ async def test_answer_received(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
     
     user_id = query.from_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     _, _, question_idx, answer_idx = query.data.split('_')
     question_idx = int(question_idx)
     answer_idx = int(answer_idx)
     
     context.user_data['test_answers'][question_idx] = answer_idx
-    log_user_action(user_id, "test_answer", f"Q{question_idx}:A{answer_idx}")
+    await log_user_action(user_id, "test_answer", f"Q{question_idx}:A{answer_idx}")
     
     next_question = question_idx + 1
     context.user_data['test_current_question'] = next_question
@@ -436,17 +482,22 @@ async def complete_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answers = context.user_data.get('test_answers', {})
     values_vector = psychological_test.calculate_values_vector(answers)
     
-    db.save_test_result(user_id, values_vector)
-    log_user_action(user_id, "test_completed")
+    await adb.save_test_result(user_id, values_vector)
+    await log_user_action(user_id, "test_completed")
     
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     user_type = user['user_type']
     
+    # Пациенту совместимость нужна сразу (дальше каталог): пересчет его строк в потоке-писателе БД.
+    # Строки психолога (по всем пациентам) пересчитывает фоновый MatchMaintenanceWorker
+    if user_type == 'patient':
+        await adb.run_write(matching_system.update_user, user_id)
+    else:
+        matching_system.mark_dirty(user_id)
+    
     if user_type == 'patient':
-        matching_system.calculate_all_matches_for_patient(user_id)
         message = MESSAGES['test_completed'] + '\n\n' + MESSAGES['test_completed_patient']
     else:
-        matching_system.calculate_all_matches_for_psychologist(user_id)
         message = MESSAGES['test_completed'] + '\n\n' + MESSAGES['test_completed_psychologist']
     
     if update.callback_query:
@@ -468,7 +519,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_main_menu_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await update.message.reply_text(MESSAGES['error_not_registered'])
@@ -490,7 +541,7 @@ async def show_main_menu_message(update: Update, context: ContextTypes.DEFAULT_T
 
 async def show_main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.callback_query.from_user.id
-    user = db.get_user(user_id)
+    user = await adb.get_user(user_id)
     
     if not user:
         await update.callback_query.message.reply_text(MESSAGES['error_not_registered'])
@@ -512,112 +563,135 @@ async def show_main_menu_callback(update: Update, context: ContextTypes.DEFAULT_
 
 async def browse_psychologists(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
-    log_user_action(user_id, "browse_start")
+    last_active.touch(user_id)
+    await log_user_action(user_id, "browse_start")
     
-    psychologists = db.get_psychologists_for_patient(user_id)
+    # В режиме topk лучшие психологи пациента считаются в момент открытия каталога
+    if matching_system.ranking_mode == 'topk' and await adb.get_feature_flag('psychological_test_and_matching'):
+        await adb.run_write(matching_system.refresh_top_k, user_id)
     
-    if not psychologists:
-        await update.message.reply_text(MESSAGES['no_more_psychologists'])
-        return
-    
-    context.user_data['psychologists'] = psychologists
-    db.update_card_index(user_id, 0)
-    
-    await show_psychologist_card(update, context, 0)
+    # Список не кэшируется в user_data: у каждого сообщения с карточкой хранится только ее курсор
+    await show_psychologist_card(update, context, 'first')
 
 
-async def show_psychologist_card(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
+async def show_psychologist_card(update: Update, context: ContextTypes.DEFAULT_TYPE, direction: str):
+    """
+    Показать карточку психолога. direction: 'first' — первая карточка,
+    'next'/'prev' — соседняя с курсором карточки в сообщении, где нажата кнопка (у каждого
+    сообщения с карточкой свой курсор). Из БД берется окно из двух строк: сама карточка
+    и признак наличия следующей (или предыдущей).
+    """
     user_id = update.effective_user.id
-    psychologists = context.user_data.get('psychologists', [])
+    message_state = (card_message_state(context, update.callback_query.message.message_id)
+                     if update.callback_query else {})
+    # Сообщение без курсора (например, отправленное до перезапуска бота) листается с начала
+    state = message_state.get('cursor')
+    
+    if direction == 'first' or not state:
+        rows = await adb.get_psychologists_page(user_id, limit=2)
+        psychologist = rows[0] if rows else None
+        index, has_prev, has_next = 0, False, len(rows) > 1
+    elif direction == 'next':
+        rows = await adb.get_psychologists_page(user_id, tuple(state['key']), 'next', limit=2)
+        psychologist = rows[0] if rows else None
+        index, has_prev, has_next = state['index'] + 1, True, len(rows) > 1
+    else:
+        rows = await adb.get_psychologists_page(user_id, tuple(state['key']), 'prev', limit=2)
+        psychologist = rows[-1] if rows else None
+        index, has_prev, has_next = max(state['index'] - 1, 0), len(rows) > 1, True
     
-    if not psychologists or index >= len(psychologists):
-        await update.message.reply_text(MESSAGES['no_more_psychologists'])
+    if not psychologist:
+        await update.effective_message.reply_text(MESSAGES['no_more_psychologists'])
         return
     
-    if index < 0:
-        index = 0
-    
-    psychologist = psychologists[index]
-    db.update_card_index(user_id, index)
+    cursor = {'key': list(psychologist['cursor']), 'index': index}
+    message_state['cursor'] = cursor
+    await adb.update_card_index(user_id, index)
     
     # Используем правильный шаблон в зависимости от наличия совместимости
-    matching_enabled = db.get_feature_flag('psychological_test_and_matching')
+    matching_enabled = await adb.get_feature_flag('psychological_test_and_matching')
     
+    # Подпись и клавиатура берутся из кэша: подпись по (психолог, profile_version, вариант),
+    # процент совместимости подставляется при показе
     if matching_enabled and psychologist.get('match_percentage') is not None:
-        log_user_action(user_id, "card_viewed", f"Index:{index},Psychologist:{psychologist['user_id']},Match:{psychologist['match_percentage']}")
-        card_text = MESSAGES['card_psychologist_template'].format(
-            name=psychologist['name'],
-            gender=psychologist.get('gender', 'Не указано'),
-            age=psychologist.get('age', 'Не указано'),
-            education=psychologist['education'],
-            about_me=psychologist.get('about_me', 'Не указано'),
-            approach=psychologist.get('approach', 'Не указано'),
-            work_requests=psychologist.get('work_requests', 'Не указано'),
-            price=psychologist.get('price', 'Не указано'),
-            experience=psychologist['experience'],
-            match=psychologist['match_percentage']
-        )
-    else:
-        log_user_action(user_id, "card_viewed", f"Index:{index},Psychologist:{psychologist['user_id']}")
-        card_text = MESSAGES['card_psychologist_template_no_match'].format(
-            name=psychologist['name'],
-            gender=psychologist.get('gender', 'Не указано'),
-            age=psychologist.get('age', 'Не указано'),
-            education=psychologist['education'],
-            about_me=psychologist.get('about_me', 'Не указано'),
-            approach=psychologist.get('approach', 'Не указано'),
-            work_requests=psychologist.get('work_requests', 'Не указано'),
-            price=psychologist.get('price', 'Не указано'),
-            experience=psychologist['experience']
-        )
-    
-    keyboard = []
-    nav_buttons = []
-    
-    if index > 0:
-        nav_buttons.append(InlineKeyboardButton(MESSAGES['button_prev'], callback_data=f'card_prev_{index}'))
-    
-    if index < len(psychologists) - 1:
-        nav_buttons.append(InlineKeyboardButton(MESSAGES['button_next'], callback_data=f'card_next_{index}'))
-    
-    if nav_buttons:
-        keyboard.append(nav_buttons)
-    
-    if not psychologist['already_liked']:
-        keyboard.append([InlineKeyboardButton(MESSAGES['button_like'], callback_data=f'like_{psychologist["user_id"]}')])
+        await log_user_action(user_id, "card_viewed", f"Index:{index},Psychologist:{psychologist['user_id']},Match:{psychologist['match_percentage']}")
+        card_text = render_cache.caption(psychologist, 'match', match=psychologist['match_percentage'])
     else:
-        keyboard.append([InlineKeyboardButton('✅ Уже лайкнут', callback_data='already_liked')])
+        await log_user_action(user_id, "card_viewed", f"Index:{index},Psychologist:{psychologist['user_id']}")
+        card_text = render_cache.caption(psychologist, 'no_match')
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = render_cache.card_keyboard(psychologist['user_id'], psychologist['already_liked'],
+                                              has_prev, has_next)
     
     if update.callback_query:
-        await update.callback_query.message.delete()
+        # Листание редактирует карточку на месте. Отрисовка идет в фоне: при быстрых
+        # нажатиях в одном сообщении рисуется только последняя карточка
+        card_renders.submit((user_id, update.callback_query.message.message_id), render_psychologist_card,
+                            update, context, psychologist['photo_file_id'], card_text, reply_markup)
+        return
     
-    await update.effective_message.reply_photo(
+    sent = await update.effective_message.reply_photo(
         photo=psychologist['photo_file_id'],
         caption=card_text,
         reply_markup=reply_markup
     )
+    if sent is not None:
+        card_message_state(context, sent.message_id).update(photo=psychologist['photo_file_id'], cursor=cursor)
+
+
+def card_message_state(context: ContextTypes.DEFAULT_TYPE, message_id: int) -> Dict:
+    """
+    Состояние карточки в конкретном сообщении (показанное фото, курсор листания). У пользователя
+    может быть несколько сообщений с карточками; хранятся последние CARD_MESSAGES_LIMIT
+    """
+    cards = context.user_data.setdefault('card_messages', {})
+    state = cards.pop(message_id, None) or {}
+    cards[message_id] = state
+    while len(cards) > CARD_MESSAGES_LIMIT:
+        del cards[next(iter(cards))]
+    return state
+
+
+async def render_psychologist_card(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                   photo: str, caption: str, reply_markup: InlineKeyboardMarkup):
+    """
+    Заменить карточку в сообщении с кнопками: одним edit_message_caption, если в этом
+    сообщении известно то же фото, иначе одним edit_message_media. Если сообщение нельзя
+    отредактировать (слишком старое, не фото), карточка отправляется заново, как раньше.
+    """
+    query = update.callback_query
+    state = card_message_state(context, query.message.message_id)
+    try:
+        if state.get('photo') == photo:
+            await query.edit_message_caption(caption=caption, reply_markup=reply_markup)
+        else:
+            await query.edit_message_media(InputMediaPhoto(photo, caption=caption), reply_markup=reply_markup)
+        state['photo'] = photo
+        return
+    except BadRequest as e:
+        if 'not modified' in str(e).lower():
+            return
+        logger.info(f"Card edit failed, sending a new card: {e}")
+    
+    try:
+        await query.message.delete()
+    except TelegramError:
+        pass
+    sent = await query.message.reply_photo(photo=photo, caption=caption, reply_markup=reply_markup)
+    if sent is not None:
+        # Новое сообщение продолжает листание с того же курсора
+        card_message_state(context, sent.message_id).update(state, photo=photo)
 
 
 async def card_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
-    data_parts = query.data.split('_')
-    direction = data_parts[1]
-    current_index = int(data_parts[2])
+    direction = query.data.split('_')[1]
     
-    if direction == 'next':
-        new_index = current_index + 1
-    else:
-        new_index = current_index - 1
-    
-    await show_psychologist_card(update, context, new_index)
+    # Ответ на нажатие не ждет выборки карточки
+    await asyncio.gather(query.answer(), show_psychologist_card(update, context, 'next' if direction == 'next' else 'prev'))
 
 
 async def like_psychologist(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -625,52 +699,42 @@ async def like_psychologist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     user_id = query.from_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     target_id = int(query.data.split('_')[1])
     
-    created, is_mutual = db.create_like(user_id, target_id)
+    # Лайк, роли, оба профиля и совместимость — одним вызовом в одной транзакции
+    like = await adb.create_like_enriched(user_id, target_id)
     
-    if not created:
+    if not like['created']:
         await query.message.reply_text("Вы уже лайкнули этого пользователя")
         return
     
-    user = db.get_user(user_id)
-    
-    # Определяем роли
-    if user['user_type'] == 'patient':
-        # Пациент лайкает психолога
-        patient_id = user_id
-        psychologist_id = target_id
-        patient_info = db.get_patient_info(patient_id)
-        psychologist_info = db.get_psychologist_info(psychologist_id)
-    else:
-        # Психолог лайкает пациента
-        patient_id = target_id
-        psychologist_id = user_id
-        patient_info = db.get_patient_info(patient_id)
-        psychologist_info = db.get_psychologist_info(psychologist_id)
+    is_mutual = like['is_mutual']
+    patient_id = like['patient_id']
+    psychologist_id = like['psychologist_id']
+    patient_info = like['patient']
+    psychologist_info = like['psychologist']
     
     # Проверяем, что оба профиля существуют
     if not patient_info or not psychologist_info:
         await query.message.reply_text("Ошибка: профиль не найден")
         return
     
-    # Получаем процент совместимости
-    matching_enabled = db.get_feature_flag('psychological_test_and_matching')
-    match_percentage = None
-    if matching_enabled:
-        match_data = db.get_match_percentage(patient_id, psychologist_id)
-        match_percentage = match_data if match_data else None
+    # Процент совместимости показываем, только если подбор включен
+    matching_enabled = await adb.get_feature_flag('psychological_test_and_matching')
+    match_percentage = like['match_percentage'] if matching_enabled else None
     
-    log_user_action(user_id, "like_sent", f"To:{target_id},Mutual:{is_mutual},Match:{match_percentage}")
+    await log_user_action(user_id, "like_sent", f"To:{target_id},Mutual:{is_mutual},Match:{match_percentage}")
     
     try:
         await query.message.delete()
     except:
         pass
     
-    await context.bot.send_message(chat_id=user_id, text=MESSAGES['like_sent'])
+    # Сообщения уходят через очередь отправки: обработчик не ждет Telegram.
+    # Ответ автору лайка — интерактивный, второй стороне — уведомление
+    outbound.send_message(user_id, MESSAGES['like_sent'])
     
     if is_mutual:
         # Взаимный лайк
@@ -678,17 +742,19 @@ async def like_psychologist(update: Update, context: ContextTypes.DEFAULT_TYPE):
             name=psychologist_info['name'],
             contact=psychologist_info['contact']
         )
-        await context.bot.send_message(chat_id=patient_id, text=match_text_patient)
+        outbound.send_message(patient_id, match_text_patient,
+                              lane=INTERACTIVE if patient_id == user_id else NOTIFICATION)
         
         match_text_psych = MESSAGES['match_notification_psychologist'].format(
             contact=patient_info['contact']
         )
-        await context.bot.send_message(chat_id=psychologist_id, text=match_text_psych)
+        outbound.send_message(psychologist_id, match_text_psych,
+                              lane=INTERACTIVE if psychologist_id == user_id else NOTIFICATION)
         
-        log_user_action(user_id, "match_created", f"With:{target_id}")
+        await log_user_action(user_id, "match_created", f"With:{target_id}")
     else:
         # Уведомление о новом лайке
-        if user['user_type'] == 'patient':
+        if like['user_type'] == 'patient':
             # Пациент лайкнул психолога
             match_text = f", совместимость: {match_percentage}%" if match_percentage else ""
             notification_text = (
@@ -701,52 +767,72 @@ async def like_psychologist(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboard = [[InlineKeyboardButton("❤️ Лайкнуть в ответ", callback_data=f'like_{patient_id}')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await context.bot.send_message(
-                chat_id=psychologist_id, 
-                text=notification_text,
-                reply_markup=reply_markup
-            )
+            outbound.send_message(psychologist_id, notification_text,
+                                  lane=NOTIFICATION, reply_markup=reply_markup)
 
 
 async def show_my_likes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
-    log_user_action(user_id, "view_likes")
+    last_active.touch(user_id)
+    await log_user_action(user_id, "view_likes")
     
-    likes = db.get_likes_for_psychologist(user_id)
+    total = await adb.count_likes_for_psychologist(user_id)
     
-    if not likes:
+    if not total:
         await update.message.reply_text(MESSAGES['likes_list_empty'])
         return
     
-    context.user_data['patient_likes'] = likes
-    db.update_card_index(user_id, 0)
-    
-    await show_patient_card(update, context, 0)
+    # Список лайков не кэшируется: у сообщения с карточкой хранятся только курсор и общее количество
+    await show_patient_card(update, context, 'first', total=total)
 
 
-async def show_patient_card(update: Update, context: ContextTypes.DEFAULT_TYPE, index: int):
-    """Показать карточку пациента из списка лайков"""
+async def show_patient_card(update: Update, context: ContextTypes.DEFAULT_TYPE, direction: str,
+                            total: Optional[int] = None):
+    """
+    Показать карточку пациента из списка лайков (direction: 'first', 'next' или 'prev').
+    Листание идет от курсора сообщения, в котором нажата кнопка
+    """
     user_id = update.effective_user.id
-    patients = context.user_data.get('patient_likes', [])
+    message_state = (card_message_state(context, update.callback_query.message.message_id)
+                     if update.callback_query else {})
+    state = message_state.get('likes_cursor')
+    if total is not None:
+        state = {'key': None, 'index': 0, 'total': total}
+    
+    if not state:
+        total = await adb.count_likes_for_psychologist(user_id)
+        state = {'key': None, 'index': 0, 'total': total}
+        direction = 'first'
+    
+    if direction == 'first' or state['key'] is None:
+        rows = await adb.get_likes_page(user_id, limit=2)
+        patient = rows[0] if rows else None
+        index, has_prev, has_next = 0, False, len(rows) > 1
+    elif direction == 'next':
+        rows = await adb.get_likes_page(user_id, tuple(state['key']), 'next', limit=2)
+        patient = rows[0] if rows else None
+        index, has_prev, has_next = state['index'] + 1, True, len(rows) > 1
+    else:
+        rows = await adb.get_likes_page(user_id, tuple(state['key']), 'prev', limit=2)
+        patient = rows[-1] if rows else None
+        index, has_prev, has_next = max(state['index'] - 1, 0), len(rows) > 1, True
     
-    if not patients or index >= len(patients):
-        await update.message.reply_text("Больше нет пациентов")
+    if not patient:
+        await update.effective_message.reply_text("Больше нет пациентов")
         return
     
-    if index < 0:
-        index = 0
+    total = max(state['total'], index + 1)
+    cursor = {'key': list(patient['cursor']), 'index': index, 'total': total}
+    message_state['likes_cursor'] = cursor
+    await adb.update_card_index(user_id, index)
     
-    patient = patients[index]
-    db.update_card_index(user_id, index)
-    
-    matching_enabled = db.get_feature_flag('psychological_test_and_matching')
+    matching_enabled = await adb.get_feature_flag('psychological_test_and_matching')
     match_text = f"🔥 Совместимость: {patient['match_percentage']}%\n\n" if matching_enabled and patient['match_percentage'] else ""
     mutual_text = "✅ ВЗАИМНЫЙ ЛАЙК\n\n" if patient['is_mutual'] else ""
     date_str = patient['liked_date'].split('.')[0] if '.' in patient['liked_date'] else patient['liked_date']
     
     card_text = (
-        f"👤 Пациент #{index + 1} из {len(patients)}\n\n"
+        f"👤 Пациент #{index + 1} из {total}\n\n"
         f"{mutual_text}"
         f"📋 Запрос:\n{patient['main_request']}\n\n"
         f"{match_text}"
@@ -757,10 +843,10 @@ async def show_patient_card(update: Update, context: ContextTypes.DEFAULT_TYPE,
     keyboard = []
     nav_buttons = []
     
-    if index > 0:
+    if has_prev:
         nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'patient_prev_{index}'))
     
-    if index < len(patients) - 1:
+    if has_next:
         nav_buttons.append(InlineKeyboardButton("➡️ Вперед", callback_data=f'patient_next_{index}'))
     
     if nav_buttons:
@@ -774,42 +860,38 @@ async def show_patient_card(update: Update, context: ContextTypes.DEFAULT_TYPE,
     if update.callback_query:
         try:
             await update.callback_query.message.edit_text(card_text, reply_markup=reply_markup)
+            return
         except:
-            await update.callback_query.message.reply_text(card_text, reply_markup=reply_markup)
+            sent = await update.callback_query.message.reply_text(card_text, reply_markup=reply_markup)
     else:
-        await update.message.reply_text(card_text, reply_markup=reply_markup)
+        sent = await update.message.reply_text(card_text, reply_markup=reply_markup)
+    if sent is not None:
+        card_message_state(context, sent.message_id)['likes_cursor'] = cursor
 
 
 async def patient_card_navigation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Навигация по карточкам пациентов"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = query.from_user.id
-    db.update_last_active(user_id)
-    
-    data_parts = query.data.split('_')
-    direction = data_parts[1]
-    current_index = int(data_parts[2])
+    last_active.touch(user_id)
     
-    if direction == 'next':
-        new_index = current_index + 1
-    else:
-        new_index = current_index - 1
+    direction = query.data.split('_')[1]
     
-    await show_patient_card(update, context, new_index)
+    await asyncio.gather(query.answer(), show_patient_card(update, context, 'next' if direction == 'next' else 'prev'))
 
 
 async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db.update_last_active(user_id)
+    last_active.touch(user_id)
     
     if user_id not in ADMIN_IDS:
         return
     
-    log_user_action(user_id, "view_stats")
+    await log_user_action(user_id, "view_stats")
     
-    stats = db.get_statistics()
+    # Досбрасываем отложенные касания, чтобы счетчики активности были точными
+    await last_active.flush()
+    stats = await adb.get_statistics()
     
     message = MESSAGES['stats_template'].format(
         psychologists=stats['psychologists_count'],
@@ -824,11 +906,42 @@ async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(message)
 
 
+def reload_messages():
+    """
+    Перечитать messages.json без перезапуска. Новый файл проверяется целиком (все прежние
+    ключи на месте, шаблоны кэша отрисовки собираются) до замены: при ошибке ValueError,
+    а MESSAGES и кэш остаются со старыми текстами
+    """
+    with open(MESSAGES_PATH, 'r', encoding='utf-8') as f:
+        messages = json.load(f)
+    missing = sorted(MESSAGES.keys() - messages.keys())
+    if missing:
+        raise ValueError(f"missing keys: {', '.join(missing)}")
+    render_cache.reload(messages)
+    MESSAGES.clear()
+    MESSAGES.update(messages)
+
+
+async def reload_messages_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    try:
+        reload_messages()
+    except (OSError, ValueError) as e:
+        logger.error(f"Error reloading messages: {e}")
+        await update.message.reply_text(f"❌ Не удалось перечитать messages.json: {e}")
+        return
+    
+    logger.info("Messages reloaded")
+    await update.message.reply_text("✅ Тексты перечитаны")
+
+
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Проверка блокировки
-    if db.is_user_blocked(user_id):
+    if await adb.is_user_blocked(user_id):
         await update.message.reply_text("❌ Ваш аккаунт заблокирован.")
         return
     
@@ -852,8 +965,68 @@ async def already_liked_callback(update: Update, context: ContextTypes.DEFAULT_T
     await query.answer("Вы уже лайкнули этого психолога!")
 
 
+# Сколько SQL-операторов может выполнить один апдейт (внешний обработчик вместе с вложенными).
+# Превышение пишется в лог; tests/test_query_budget.py прогоняет обработчики на фейковых
+# апдейтах и падает при превышении. Фича-флаги заложены с промахом кэша (2 запроса)
+QUERY_BUDGETS = {
+    'start': 3,
+    'handle_text': 6,
+    'browse_psychologists': 5,
+    'card_navigation': 5,
+    'like_psychologist': 5,
+    'show_my_likes': 6,
+    'patient_card_navigation': 5,
+    'show_statistics': 3,
+}
+
+# Все обработчики (корутины этого модуля) замеряются и считают запросы к БД на апдейт;
+# вызовы между ними тоже идут через обертки
+for _name, _handler in list(globals().items()):
+    if inspect.iscoroutinefunction(_handler) and _handler.__module__ == __name__:
+        _handler = query_budget.instrument(_handler, _name, QUERY_BUDGETS.get(_name))
+        globals()[_name] = metrics.registry.instrument(_handler, f'handler.{_name}')
+
+
+async def post_init(application: Application):
+    if matching_system.vector_store is not None:
+        await adb.run_write(matching_system.sync_vector_store)
+    action_log.start()
+    last_active.start()
+    match_maintenance.start()
+    statistics_maintenance.start()
+    metrics_dumper.start()
+    outbound.start(application.bot)
+
+
+async def post_stop(application: Application):
+    # Очередь дожидается доставки, пока HTTP-клиент бота еще открыт (post_shutdown — уже после его закрытия)
+    await card_renders.drain()
+    await outbound.stop()
+    logger.info(f"Outbound queue counters: {outbound.counters()}")
+    logger.info(f"Card render counters: {card_renders.counters()}")
+    logger.info(f"Render cache counters: {render_cache.counters()}")
+
+
+async def post_shutdown(application: Application):
+    await action_log.stop()
+    await last_active.stop()
+    await match_maintenance.stop()
+    await statistics_maintenance.stop()
+    await metrics_dumper.stop()
+    logger.info(f"Action log counters: {action_log.counters()}")
+    adb.close()
+    db.close()
+
+
 def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     conv_handler = ConversationHandler(
         entry_points=[
@@ -881,7 +1054,9 @@ def main():
     )
     
     application.add_handler(conv_handler)
-    application.add_handler(CallbackQueryHandler(card_navigation, pattern='^card_(prev|next)_'))
+    application.add_handler(CommandHandler('reload_messages', reload_messages_command))
+    # Старые карточки с card_prev_N/card_next_N тоже листаются
+    application.add_handler(CallbackQueryHandler(card_navigation, pattern='^card_(prev|next)'))
     application.add_handler(CallbackQueryHandler(patient_card_navigation, pattern='^patient_(prev|next)_'))
     application.add_handler(CallbackQueryHandler(like_psychologist, pattern='^like_'))
     application.add_handler(CallbackQueryHandler(already_liked_callback, pattern='^already_liked$'))
@@ -1,24 +1,264 @@
+import json
 import sqlite3
 import logging
-from datetime import datetime
-from typing import Optional, List, Dict, Tuple
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+from typing import Optional, List, Dict, Tuple, Iterable, Iterator
+
+import numpy as np
+
+import query_budget
+from sql_tracer import SQLTracer, TracingConnection
+from vectors import VectorLike, pack_vector, to_array, unpack_vector
 
 logger = logging.getLogger(__name__)
 
+# Материализованные счетчики статистики (см. migrations/006_statistics_counters.sql):
+# итоги в stat_counters и почасовые корзины activity_buckets, которые ведут триггеры
+STATISTICS_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS stat_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS activity_buckets (
+        kind TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (kind, bucket)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users
+    BEGIN
+        INSERT INTO stat_counters (name, value) VALUES ('users_' || NEW.user_type, 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        INSERT INTO activity_buckets (kind, bucket, value)
+            SELECT 'active_' || NEW.user_type, strftime('%Y-%m-%d %H:00:00', NEW.last_active), 1
+            WHERE strftime('%Y-%m-%d %H:00:00', NEW.last_active) IS NOT NULL
+            ON CONFLICT (kind, bucket) DO UPDATE SET value = value + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE stat_counters SET value = value - 1 WHERE name = 'users_' || OLD.user_type;
+        UPDATE activity_buckets SET value = value - 1
+            WHERE kind = 'active_' || OLD.user_type
+            AND bucket = strftime('%Y-%m-%d %H:00:00', OLD.last_active);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_users_stats_update AFTER UPDATE OF user_type, last_active ON users
+    WHEN OLD.user_type IS NOT NEW.user_type
+        OR strftime('%Y-%m-%d %H:00:00', OLD.last_active) IS NOT strftime('%Y-%m-%d %H:00:00', NEW.last_active)
+    BEGIN
+        UPDATE stat_counters SET value = value - 1
+            WHERE name = 'users_' || OLD.user_type AND OLD.user_type IS NOT NEW.user_type;
+        INSERT INTO stat_counters (name, value)
+            SELECT 'users_' || NEW.user_type, 1 WHERE OLD.user_type IS NOT NEW.user_type
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        UPDATE activity_buckets SET value = value - 1
+            WHERE kind = 'active_' || OLD.user_type
+            AND bucket = strftime('%Y-%m-%d %H:00:00', OLD.last_active);
+        INSERT INTO activity_buckets (kind, bucket, value)
+            SELECT 'active_' || NEW.user_type, strftime('%Y-%m-%d %H:00:00', NEW.last_active), 1
+            WHERE strftime('%Y-%m-%d %H:00:00', NEW.last_active) IS NOT NULL
+            ON CONFLICT (kind, bucket) DO UPDATE SET value = value + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_likes_stats_insert AFTER INSERT ON likes
+    WHEN NEW.is_mutual = 1
+    BEGIN
+        INSERT INTO stat_counters (name, value) VALUES ('mutual_likes', 1)
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        INSERT INTO activity_buckets (kind, bucket, value)
+            SELECT 'mutual_likes', strftime('%Y-%m-%d %H:00:00', NEW.liked_date), 1
+            WHERE strftime('%Y-%m-%d %H:00:00', NEW.liked_date) IS NOT NULL
+            ON CONFLICT (kind, bucket) DO UPDATE SET value = value + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_likes_stats_delete AFTER DELETE ON likes
+    WHEN OLD.is_mutual = 1
+    BEGIN
+        UPDATE stat_counters SET value = value - 1 WHERE name = 'mutual_likes';
+        UPDATE activity_buckets SET value = value - 1
+            WHERE kind = 'mutual_likes' AND bucket = strftime('%Y-%m-%d %H:00:00', OLD.liked_date);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_likes_stats_update AFTER UPDATE OF is_mutual, liked_date ON likes
+    WHEN OLD.is_mutual = 1 OR NEW.is_mutual = 1
+    BEGIN
+        UPDATE stat_counters SET value = value - 1 WHERE name = 'mutual_likes' AND OLD.is_mutual = 1;
+        UPDATE activity_buckets SET value = value - 1
+            WHERE kind = 'mutual_likes' AND bucket = strftime('%Y-%m-%d %H:00:00', OLD.liked_date)
+            AND OLD.is_mutual = 1;
+        INSERT INTO stat_counters (name, value)
+            SELECT 'mutual_likes', 1 WHERE NEW.is_mutual = 1
+            ON CONFLICT (name) DO UPDATE SET value = value + 1;
+        INSERT INTO activity_buckets (kind, bucket, value)
+            SELECT 'mutual_likes', strftime('%Y-%m-%d %H:00:00', NEW.liked_date), 1
+            WHERE NEW.is_mutual = 1 AND strftime('%Y-%m-%d %H:00:00', NEW.liked_date) IS NOT NULL
+            ON CONFLICT (kind, bucket) DO UPDATE SET value = value + 1;
+    END
+    ''',
+)
+
+# Сортировки списка пользователей в админке: колонка keyset-курсора (вторая — user_id)
+USER_PAGE_SORTS = {
+    'registration': 'u.registration_date',
+    'activity': 'u.last_active',
+    'id': 'u.user_id',
+}
+
+# Пересборка счетчиков из базовых таблиц
+STATISTICS_REBUILD = (
+    '''
+    DELETE FROM stat_counters
+    ''',
+    '''
+    DELETE FROM activity_buckets
+    ''',
+    '''
+    INSERT INTO stat_counters (name, value)
+        SELECT 'users_' || user_type, COUNT(*) FROM users GROUP BY user_type
+    ''',
+    '''
+    INSERT INTO stat_counters (name, value)
+        SELECT 'mutual_likes', COUNT(*) FROM likes WHERE is_mutual = 1
+    ''',
+    '''
+    INSERT INTO activity_buckets (kind, bucket, value)
+        SELECT 'active_' || user_type, strftime('%Y-%m-%d %H:00:00', last_active), COUNT(*)
+        FROM users WHERE strftime('%Y-%m-%d %H:00:00', last_active) IS NOT NULL
+        GROUP BY 1, 2
+    ''',
+    '''
+    INSERT INTO activity_buckets (kind, bucket, value)
+        SELECT 'mutual_likes', strftime('%Y-%m-%d %H:00:00', liked_date), COUNT(*)
+        FROM likes WHERE is_mutual = 1 AND strftime('%Y-%m-%d %H:00:00', liked_date) IS NOT NULL
+        GROUP BY 1, 2
+    ''',
+)
+
+class _ThreadConnection:
+    """Соединение потока в threading.local: когда поток завершается, объект удаляется вместе с ним"""
+    
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+
 class Database:
-    def __init__(self, db_path: str):
+    """
+    Доступ к SQLite. У каждого потока одно постоянное соединение (WAL, busy_timeout,
+    кэш подготовленных запросов), поэтому бот и админка могут работать с одним файлом
+    одновременно. Соединение закрывается, когда поток завершается (потоки запросов Flask
+    короткоживущие). Записи выполняются через transaction().
+    """
+    
+    def __init__(self, db_path: str, busy_timeout: float = 5.0, cached_statements: int = 256,
+                 flag_cache_ttl: float = 2.0, tracer: Optional[SQLTracer] = None):
         self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        # Трассировка запросов (sql_tracer.SQLTracer): время, отпечатки, журнал медленных
+        self.tracer = tracer
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        
+        # Кэш фича-флагов: в пределах TTL чтение из памяти, после — проверка PRAGMA data_version
+        self.flag_cache_ttl = flag_cache_ttl
+        self._flag_cache: Dict[str, bool] = {}
+        self._flag_cache_expires = 0.0
+        self._flag_cache_lock = threading.Lock()
+        
         self.init_db()
     
-    def get_connection(self):
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: транзакциями управляет transaction(), чтения идут в autocommit
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            cached_statements=self.cached_statements,
+            check_same_thread=False,
+            factory=TracingConnection
+        )
+        conn.tracer = self.tracer
         conn.row_factory = sqlite3.Row
+        # Настройка соединения учитывается в бюджете апдейта как одно открытие, а не как запросы
+        query_budget.record_connect()
+        with query_budget.untracked():
+            conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout * 1000)}')
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
         return conn
     
-    def init_db(self):
+    def get_connection(self) -> sqlite3.Connection:
+        """Постоянное соединение текущего потока (создается при первом обращении)"""
+        holder = getattr(self._local, 'conn', None)
+        if holder is None:
+            conn = self._connect()
+            holder = self._local.conn = _ThreadConnection(conn)
+            with self._connections_lock:
+                self._connections.append(conn)
+            weakref.finalize(holder, self._release_connection, conn)
+        return holder.conn
+    
+    def _release_connection(self, conn: sqlite3.Connection):
+        """Поток завершился: закрыть его соединение и убрать из списка открытых"""
+        with self._connections_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        conn.close()
+    
+    @contextmanager
+    def transaction(self):
+        """
+        Транзакция на соединении текущего потока: commit при выходе, rollback при исключении.
+        BEGIN IMMEDIATE сразу берет блокировку записи, чтобы параллельные процессы ждали
+        по busy_timeout, а не получали SQLITE_BUSY посреди транзакции.
+        Вложенные вызовы присоединяются к внешней транзакции.
+        """
         conn = self.get_connection()
-        cursor = conn.cursor()
+        if conn.in_transaction:
+            yield conn.cursor()
+            return
         
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+    
+    def close(self):
+        """Закрыть все соединения, открытые этим объектом"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+    
+    def init_db(self):
+        with self.transaction() as cursor:
+            self._create_schema(cursor)
+        self.backfill_vector_blobs()
+        logger.info("Database initialized successfully")
+    
+    def _create_schema(self, cursor):
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
@@ -45,6 +285,7 @@ class Database:
                 price TEXT,
                 experience TEXT NOT NULL,
                 contact TEXT,
+                profile_version INTEGER DEFAULT 1,
                 FOREIGN KEY (user_id) REFERENCES users(user_id)
             )
         ''')
@@ -63,6 +304,9 @@ class Database:
                 user_id INTEGER PRIMARY KEY,
                 values_vector TEXT NOT NULL,
                 completed_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                vector_blob BLOB,
+                vector_norm REAL,
+                vector_dim INTEGER,
                 FOREIGN KEY (user_id) REFERENCES users(user_id)
             )
         ''')
@@ -78,6 +322,14 @@ class Database:
             )
         ''')
         
+        # Очередь пересчета совместимости между процессами (см. migrations/009_match_updates.sql)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS match_updates (
+                user_id INTEGER PRIMARY KEY,
+                queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS likes (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -117,120 +369,352 @@ class Database:
             VALUES ('psychological_test_and_matching', 0, 'Включить психологический тест и подбор по совместимости')
         ''')
         
-        conn.commit()
-        conn.close()
-        logger.info("Database initialized successfully")
+        # Поле blocked раньше добавлялось только при первой блокировке; нужно для выборок векторов
+        cursor.execute("PRAGMA table_info(users)")
+        if 'blocked' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0')
+        
+        # Бинарное хранение векторов (см. migrations/005_binary_vectors.sql)
+        cursor.execute("PRAGMA table_info(test_results)")
+        test_result_columns = [row[1] for row in cursor.fetchall()]
+        for column, column_type in (('vector_blob', 'BLOB'), ('vector_norm', 'REAL'), ('vector_dim', 'INTEGER')):
+            if column not in test_result_columns:
+                cursor.execute(f'ALTER TABLE test_results ADD COLUMN {column} {column_type}')
+        
+        # Версия профиля психолога для кэша подписей карточек (см. migrations/008_profile_version.sql)
+        cursor.execute("PRAGMA table_info(psychologist_profiles)")
+        if 'profile_version' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE psychologist_profiles ADD COLUMN profile_version INTEGER DEFAULT 1')
+        
+        # Индексы горячих запросов (см. migrations/004_add_indexes.sql)
+        for statement in (
+            'CREATE INDEX IF NOT EXISTS idx_matches_patient_score ON matches (patient_id, match_percentage DESC, psychologist_id DESC)',
+            'CREATE INDEX IF NOT EXISTS idx_matches_psychologist ON matches (psychologist_id, patient_id, match_percentage)',
+            'CREATE INDEX IF NOT EXISTS idx_likes_to_user ON likes (to_user_id, liked_date DESC, id DESC)',
+            'CREATE INDEX IF NOT EXISTS idx_likes_mutual_date ON likes (is_mutual, liked_date)',
+            'CREATE INDEX IF NOT EXISTS idx_user_actions_user_time ON user_actions (user_id, timestamp)',
+            'CREATE INDEX IF NOT EXISTS idx_user_actions_type_time ON user_actions (action_type, timestamp)',
+            'CREATE INDEX IF NOT EXISTS idx_users_type_completed ON users (user_type, test_completed)',
+            'CREATE INDEX IF NOT EXISTS idx_users_type_registration ON users (user_type, registration_date DESC, user_id DESC)',
+            'CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)',
+            'CREATE INDEX IF NOT EXISTS idx_users_registration ON users (registration_date)',
+        ):
+            cursor.execute(statement)
+        
+        # Счетчики статистики; на существующей БД без них заполняются из базовых таблиц
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stat_counters'")
+        counters_exist = cursor.fetchone() is not None
+        for statement in STATISTICS_SCHEMA:
+            cursor.execute(statement)
+        if not counters_exist:
+            for statement in STATISTICS_REBUILD:
+                cursor.execute(statement)
     
     def create_user(self, user_id: int, username: Optional[str], user_type: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
         try:
-            cursor.execute('''
-                INSERT INTO users (user_id, username, user_type)
-                VALUES (?, ?, ?)
-            ''', (user_id, username, user_type))
-            conn.commit()
+            with self.transaction() as cursor:
+                cursor.execute('''
+                    INSERT INTO users (user_id, username, user_type)
+                    VALUES (?, ?, ?)
+                ''', (user_id, username, user_type))
             logger.info(f"User created: {user_id}, type: {user_type}")
         except sqlite3.IntegrityError:
             logger.warning(f"User {user_id} already exists")
-        finally:
-            conn.close()
     
     def get_user(self, user_id: int) -> Optional[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
         row = cursor.fetchone()
-        conn.close()
         return dict(row) if row else None
     
     def update_last_active(self, user_id: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE users SET last_active = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        ''', (user_id,))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE users SET last_active = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+            ''', (user_id,))
+    
+    def update_last_active_bulk(self, touches: Iterable[Tuple[int, str]]) -> int:
+        """Обновить last_active пачкой (user_id, timestamp) одной транзакцией; время не откатывается назад"""
+        rows = [(timestamp, user_id, timestamp) for user_id, timestamp in touches]
+        if not rows:
+            return 0
+        
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                UPDATE users SET last_active = ?
+                WHERE user_id = ? AND (last_active IS NULL OR last_active < ?)
+            ''', rows)
+        return len(rows)
     
     def save_psychologist_profile(self, user_id: int, name: str, photo_file_id: str, 
                                   education: str, experience: str, contact: str,
                                   gender: str = None, age: int = None, about_me: str = None,
                                   approach: str = None, work_requests: str = None, price: str = None):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO psychologist_profiles 
-            (user_id, name, photo_file_id, gender, age, education, about_me, 
-             approach, work_requests, price, experience, contact)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, name, photo_file_id, gender, age, education, about_me,
-              approach, work_requests, price, experience, contact))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO psychologist_profiles 
+                (user_id, name, photo_file_id, gender, age, education, about_me, 
+                 approach, work_requests, price, experience, contact, profile_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                        COALESCE((SELECT profile_version FROM psychologist_profiles WHERE user_id = ?), 0) + 1)
+            ''', (user_id, name, photo_file_id, gender, age, education, about_me,
+                  approach, work_requests, price, experience, contact, user_id))
         logger.info(f"Psychologist profile saved: {user_id}")
     
     def save_patient_profile(self, user_id: int, main_request: str, contact: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO patient_profiles 
-            (user_id, main_request, contact)
-            VALUES (?, ?, ?)
-        ''', (user_id, main_request, contact))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO patient_profiles 
+                (user_id, main_request, contact)
+                VALUES (?, ?, ?)
+            ''', (user_id, main_request, contact))
         logger.info(f"Patient profile saved: {user_id}")
     
-    def save_test_result(self, user_id: int, values_vector: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT OR REPLACE INTO test_results (user_id, values_vector)
-            VALUES (?, ?)
-        ''', (user_id, values_vector))
-        cursor.execute('''
-            UPDATE users SET test_completed = 1 WHERE user_id = ?
-        ''', (user_id,))
-        conn.commit()
-        conn.close()
+    def save_test_result(self, user_id: int, values_vector: VectorLike):
+        """Сохранить вектор ценностей (JSON-строка, список или массив) как float32 BLOB"""
+        blob, norm, dim = pack_vector(values_vector)
+        if not isinstance(values_vector, str):
+            values_vector = json.dumps(to_array(values_vector).tolist())
+        
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO test_results 
+                (user_id, values_vector, vector_blob, vector_norm, vector_dim)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (user_id, values_vector, blob, norm, dim))
+            cursor.execute('''
+                UPDATE users SET test_completed = 1 WHERE user_id = ?
+            ''', (user_id,))
         logger.info(f"Test result saved: {user_id}")
     
     def get_test_result(self, user_id: int) -> Optional[str]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('SELECT values_vector FROM test_results WHERE user_id = ?', (user_id,))
         row = cursor.fetchone()
-        conn.close()
         return row['values_vector'] if row else None
     
-    def save_match(self, patient_id: int, psychologist_id: int, match_percentage: float):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_test_vector(self, user_id: int) -> Optional[np.ndarray]:
+        """Вектор пользователя как float32-view поверх BLOB (JSON-строки читаются прозрачно)"""
+        cursor = self.get_connection().cursor()
+        cursor.execute(
+            'SELECT vector_blob, values_vector FROM test_results WHERE user_id = ?', (user_id,)
+        )
+        row = cursor.fetchone()
+        if not row:
+            return None
+        if row['vector_blob'] is not None:
+            return unpack_vector(row['vector_blob'])
+        return to_array(row['values_vector'])
+    
+    def get_test_vectors(self, user_type: str) -> List[Tuple[int, np.ndarray, float]]:
+        """
+        Векторы всех прошедших тест незаблокированных пользователей типа одним запросом:
+        (user_id, float32-view поверх BLOB, L2-норма). Строки без BLOB читаются из JSON.
+        """
+        cursor = self.get_connection().cursor()
         cursor.execute('''
-            INSERT OR REPLACE INTO matches 
-            (patient_id, psychologist_id, match_percentage)
-            VALUES (?, ?, ?)
-        ''', (patient_id, psychologist_id, match_percentage))
-        conn.commit()
-        conn.close()
+            SELECT tr.user_id, tr.vector_blob, tr.vector_norm, tr.values_vector
+            FROM test_results tr
+            JOIN users u ON u.user_id = tr.user_id
+            WHERE u.user_type = ? AND u.test_completed = 1 AND COALESCE(u.blocked, 0) = 0
+            ORDER BY tr.user_id
+        ''', (user_type,))
+        
+        result = []
+        for row in cursor.fetchall():
+            if row['vector_blob'] is not None:
+                result.append((row['user_id'], unpack_vector(row['vector_blob']), row['vector_norm']))
+            else:
+                vector = to_array(row['values_vector'])
+                result.append((row['user_id'], vector, float(np.linalg.norm(vector))))
+        return result
+    
+    def backfill_vector_blobs(self, batch_size: int = 1000) -> int:
+        """Заполнить vector_blob/vector_norm/vector_dim для строк, сохраненных в старом JSON-формате"""
+        total = 0
+        while True:
+            cursor = self.get_connection().cursor()
+            cursor.execute('''
+                SELECT user_id, values_vector FROM test_results
+                WHERE vector_blob IS NULL
+                LIMIT ?
+            ''', (batch_size,))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            
+            updates = []
+            for row in rows:
+                blob, norm, dim = pack_vector(row['values_vector'])
+                updates.append((blob, norm, dim, row['user_id']))
+            
+            with self.transaction() as cursor:
+                cursor.executemany('''
+                    UPDATE test_results SET vector_blob = ?, vector_norm = ?, vector_dim = ?
+                    WHERE user_id = ?
+                ''', updates)
+            total += len(updates)
+        
+        if total:
+            logger.info(f"Vector blobs backfilled: {total}")
+        return total
+    
+    def get_test_results(self, user_type: str) -> List[Tuple[int, str]]:
+        """Получить векторы всех прошедших тест незаблокированных пользователей типа одним запросом"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('''
+            SELECT tr.user_id, tr.values_vector
+            FROM test_results tr
+            JOIN users u ON u.user_id = tr.user_id
+            WHERE u.user_type = ? AND u.test_completed = 1 AND COALESCE(u.blocked, 0) = 0
+            ORDER BY tr.user_id
+        ''', (user_type,))
+        rows = cursor.fetchall()
+        return [(row['user_id'], row['values_vector']) for row in rows]
+    
+    def save_match(self, patient_id: int, psychologist_id: int, match_percentage: float):
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT OR REPLACE INTO matches 
+                (patient_id, psychologist_id, match_percentage)
+                VALUES (?, ?, ?)
+            ''', (patient_id, psychologist_id, match_percentage))
+    
+    @staticmethod
+    def _match_rows(matches: Iterable) -> Iterator[Tuple[int, int, float]]:
+        """Приводит строки (patient_id, psychologist_id, pct) к типам sqlite (в т.ч. из numpy)"""
+        for patient_id, psychologist_id, match_percentage in matches:
+            yield int(patient_id), int(psychologist_id), float(match_percentage)
+    
+    def save_matches(self, matches: Iterable) -> int:
+        """Сохранить пачку совпадений (patient_id, psychologist_id, pct) одной транзакцией"""
+        rows = list(self._match_rows(matches))
+        if not rows:
+            return 0
+        
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO matches 
+                (patient_id, psychologist_id, match_percentage)
+                VALUES (?, ?, ?)
+            ''', rows)
+        return len(rows)
+    
+    def save_matches_stream(self, matches: Iterable, chunk_size: int = 5000) -> int:
+        """Потоковое сохранение совпадений: одна транзакция на каждые chunk_size строк"""
+        saved = 0
+        rows = self._match_rows(matches)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            with self.transaction() as cursor:
+                cursor.executemany('''
+                    INSERT OR REPLACE INTO matches 
+                    (patient_id, psychologist_id, match_percentage)
+                    VALUES (?, ?, ?)
+                ''', chunk)
+            saved += len(chunk)
+        logger.info(f"Matches saved: {saved}")
+        return saved
+    
+    def replace_matches_for_user(self, user_id: int, matches: Iterable) -> int:
+        """Заменить все строки совместимости пользователя (любой роли) одной транзакцией"""
+        rows = list(self._match_rows(matches))
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM matches WHERE patient_id = ? OR psychologist_id = ?', (user_id, user_id))
+            cursor.executemany('''
+                INSERT OR REPLACE INTO matches 
+                (patient_id, psychologist_id, match_percentage)
+                VALUES (?, ?, ?)
+            ''', rows)
+        return len(rows)
+    
+    def delete_matches(self, pairs: Iterable[Tuple[int, int]]) -> int:
+        """Удалить строки совместимости по парам (patient_id, psychologist_id)"""
+        rows = [(int(patient_id), int(psychologist_id)) for patient_id, psychologist_id in pairs]
+        if not rows:
+            return 0
+        
+        with self.transaction() as cursor:
+            cursor.executemany(
+                'DELETE FROM matches WHERE patient_id = ? AND psychologist_id = ?', rows
+            )
+        return len(rows)
+    
+    def queue_match_update(self, user_id: int):
+        """
+        Поставить пользователя в общую очередь пересчета совместимости: ее разбирает
+        MatchMaintenanceWorker бота (для изменений из админки и других процессов)
+        """
+        with self.transaction() as cursor:
+            cursor.execute('INSERT OR IGNORE INTO match_updates (user_id) VALUES (?)', (user_id,))
+    
+    def take_match_updates(self) -> List[int]:
+        """Забрать очередь пересчета совместимости. Пустая очередь — одно чтение без блокировки записи"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT 1 FROM match_updates LIMIT 1')
+        if cursor.fetchone() is None:
+            return []
+        with self.transaction() as cursor:
+            cursor.execute('DELETE FROM match_updates RETURNING user_id')
+            return [row['user_id'] for row in cursor.fetchall()]
+    
+    def get_match_patient_ids(self) -> List[int]:
+        """Пациенты, у которых есть строки совместимости (по индексу idx_matches_patient_score)"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT DISTINCT patient_id FROM matches ORDER BY patient_id')
+        return [row['patient_id'] for row in cursor.fetchall()]
+    
+    def get_matches_for_patients(self, patient_ids: List[int]) -> List[Tuple[int, int, float]]:
+        """Строки совместимости группы пациентов (порция сверки)"""
+        if not patient_ids:
+            return []
+        placeholders = ', '.join('?' * len(patient_ids))
+        cursor = self.get_connection().cursor()
+        cursor.execute(f'''
+            SELECT patient_id, psychologist_id, match_percentage FROM matches
+            WHERE patient_id IN ({placeholders})
+        ''', [int(patient_id) for patient_id in patient_ids])
+        return [tuple(row) for row in cursor.fetchall()]
+    
+    def apply_matches_diff(self, upserts: Iterable, deletes: Iterable[Tuple[int, int]]) -> int:
+        """Записать расхождения сверки одной короткой транзакцией. Возвращает число удаленных строк"""
+        rows = list(self._match_rows(upserts))
+        pairs = [(int(patient_id), int(psychologist_id)) for patient_id, psychologist_id in deletes]
+        if not rows and not pairs:
+            return 0
+        
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO matches 
+                (patient_id, psychologist_id, match_percentage)
+                VALUES (?, ?, ?)
+            ''', rows)
+            cursor.executemany(
+                'DELETE FROM matches WHERE patient_id = ? AND psychologist_id = ?', pairs
+            )
+        return len(pairs)
+    
+    def get_all_matches(self) -> List[Tuple[int, int, float]]:
+        """Все строки совместимости (для сверки с test_results)"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT patient_id, psychologist_id, match_percentage FROM matches')
+        return [tuple(row) for row in cursor.fetchall()]
     
     def get_match_percentage(self, patient_id: int, psychologist_id: int) -> Optional[float]:
         """Получить процент совместимости между пациентом и психологом"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('''
             SELECT match_percentage FROM matches
             WHERE patient_id = ? AND psychologist_id = ?
         ''', (patient_id, psychologist_id))
         row = cursor.fetchone()
-        conn.close()
         return row['match_percentage'] if row else None
     
     def get_psychologists_for_patient(self, patient_id: int) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         
         # Проверяем, включен ли фича-флаг для совместимости
         matching_enabled = self.get_feature_flag('psychological_test_and_matching')
@@ -241,7 +725,7 @@ class Database:
                     u.user_id, u.username,
                     pp.name, pp.photo_file_id, pp.gender, pp.age, pp.education, 
                     pp.about_me, pp.approach, pp.work_requests, pp.price,
-                    pp.experience, pp.contact,
+                    pp.experience, pp.contact, pp.profile_version,
                     m.match_percentage,
                     CASE WHEN l.from_user_id IS NOT NULL THEN 1 ELSE 0 END as already_liked
                 FROM users u
@@ -258,7 +742,7 @@ class Database:
                     u.user_id, u.username,
                     pp.name, pp.photo_file_id, pp.gender, pp.age, pp.education, 
                     pp.about_me, pp.approach, pp.work_requests, pp.price,
-                    pp.experience, pp.contact,
+                    pp.experience, pp.contact, pp.profile_version,
                     NULL as match_percentage,
                     CASE WHEN l.from_user_id IS NOT NULL THEN 1 ELSE 0 END as already_liked
                 FROM users u
@@ -269,69 +753,201 @@ class Database:
             ''', (patient_id,))
         
         rows = cursor.fetchall()
-        conn.close()
         return [dict(row) for row in rows]
     
+    def get_psychologists_page(self, patient_id: int, after: Optional[Tuple] = None,
+                               direction: str = 'next', limit: int = 2,
+                               inclusive: bool = False) -> List[Dict]:
+        """
+        Окно карточек психологов для пациента с keyset-курсором.
+        Порядок тот же, что в get_psychologists_for_patient: по (match_percentage, user_id)
+        при включенной совместимости, иначе по (registration_date, user_id), по убыванию.
+        after — курсор карточки, от которой листаем (None — начало списка);
+        direction='next' берет карточки после курсора, 'prev' — перед ним.
+        Строки возвращаются в порядке показа, у каждой есть поле 'cursor'.
+        """
+        matching_enabled = self.get_feature_flag('psychological_test_and_matching')
+        
+        if matching_enabled:
+            sort_column, id_column = 'm.match_percentage', 'm.psychologist_id'
+            query = '''
+                SELECT 
+                    u.user_id, u.username,
+                    pp.name, pp.photo_file_id, pp.gender, pp.age, pp.education, 
+                    pp.about_me, pp.approach, pp.work_requests, pp.price,
+                    pp.experience, pp.contact, pp.profile_version,
+                    m.match_percentage,
+                    CASE WHEN l.from_user_id IS NOT NULL THEN 1 ELSE 0 END as already_liked,
+                    m.match_percentage as sort_value
+                FROM matches m
+                JOIN users u ON u.user_id = m.psychologist_id
+                JOIN psychologist_profiles pp ON u.user_id = pp.user_id
+                LEFT JOIN likes l ON l.from_user_id = ? AND l.to_user_id = u.user_id
+                WHERE m.patient_id = ? AND u.test_completed = 1
+            '''
+            params = [patient_id, patient_id]
+        else:
+            sort_column, id_column = 'u.registration_date', 'u.user_id'
+            query = '''
+                SELECT 
+                    u.user_id, u.username,
+                    pp.name, pp.photo_file_id, pp.gender, pp.age, pp.education, 
+                    pp.about_me, pp.approach, pp.work_requests, pp.price,
+                    pp.experience, pp.contact, pp.profile_version,
+                    NULL as match_percentage,
+                    CASE WHEN l.from_user_id IS NOT NULL THEN 1 ELSE 0 END as already_liked,
+                    u.registration_date as sort_value
+                FROM users u
+                JOIN psychologist_profiles pp ON u.user_id = pp.user_id
+                LEFT JOIN likes l ON l.from_user_id = ? AND l.to_user_id = u.user_id
+                WHERE u.user_type = 'psychologist'
+            '''
+            params = [patient_id]
+        
+        rows = self._fetch_keyset_page(query, params, sort_column, id_column,
+                                       after, direction, limit, inclusive)
+        for row in rows:
+            row['cursor'] = (row.pop('sort_value'), row['user_id'])
+        return rows
+    
+    def _fetch_keyset_page(self, query: str, params: List, sort_column: str, id_column: str,
+                           after: Optional[Tuple], direction: str, limit: int,
+                           inclusive: bool) -> List[Dict]:
+        """Добавляет к запросу keyset-условие по (sort_column, id_column) DESC и LIMIT"""
+        if direction not in ('next', 'prev'):
+            raise ValueError(f"Unknown direction: {direction}")
+        
+        if after is not None:
+            operator = '<' if direction == 'next' else '>'
+            if inclusive:
+                operator += '='
+            query += f' AND ({sort_column}, {id_column}) {operator} (?, ?)'
+            params = list(params) + list(after)
+        
+        order = 'DESC' if direction == 'next' else 'ASC'
+        query += f' ORDER BY {sort_column} {order}, {id_column} {order} LIMIT ?'
+        
+        cursor = self.get_connection().cursor()
+        cursor.execute(query, list(params) + [limit])
+        rows = [dict(row) for row in cursor.fetchall()]
+        if direction == 'prev':
+            rows.reverse()
+        return rows
+    
     def get_all_psychologists(self) -> List[int]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('''
             SELECT user_id FROM users 
             WHERE user_type = 'psychologist' AND test_completed = 1
         ''')
         rows = cursor.fetchall()
-        conn.close()
         return [row['user_id'] for row in rows]
     
     def get_all_patients(self) -> List[int]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('''
             SELECT user_id FROM users 
             WHERE user_type = 'patient' AND test_completed = 1
         ''')
         rows = cursor.fetchall()
-        conn.close()
         return [row['user_id'] for row in rows]
     
     def create_like(self, from_user_id: int, to_user_id: int) -> Tuple[bool, bool]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        with self.transaction() as cursor:
+            created, is_mutual = self._insert_like(cursor, from_user_id, to_user_id)
         
-        cursor.execute('''
-            SELECT id FROM likes 
-            WHERE from_user_id = ? AND to_user_id = ?
-        ''', (from_user_id, to_user_id))
-        if cursor.fetchone():
-            conn.close()
-            return False, False
+        if created:
+            logger.info(f"Like created: {from_user_id} -> {to_user_id}, mutual: {is_mutual}")
+        return created, is_mutual
+    
+    def create_like_enriched(self, from_user_id: int, to_user_id: int) -> Dict:
+        """
+        Лайк и все, что нужно обработчику для уведомлений, за один вызов в одной транзакции.
+        Роли определяются по типу автора лайка. Результат: created, is_mutual, user_type
+        (тип автора), patient_id, psychologist_id, patient и psychologist (поля профилей
+        как в get_patient_info / get_psychologist_info, None если профиля нет) и
+        match_percentage. Повторный лайк: created=False, остальные поля не заполняются.
+        """
+        result = {'created': False, 'is_mutual': False, 'user_type': None,
+                  'patient_id': None, 'psychologist_id': None,
+                  'patient': None, 'psychologist': None, 'match_percentage': None}
+        with self.transaction() as cursor:
+            result['created'], result['is_mutual'] = self._insert_like(cursor, from_user_id, to_user_id)
+            if not result['created']:
+                return result
+            
+            cursor.execute('''
+                WITH roles AS (
+                    SELECT user_type,
+                           CASE WHEN user_type = 'patient' THEN :from_id ELSE :to_id END as patient_id,
+                           CASE WHEN user_type = 'patient' THEN :to_id ELSE :from_id END as psychologist_id
+                    FROM users WHERE user_id = :from_id
+                )
+                SELECT 
+                    r.user_type, r.patient_id, r.psychologist_id,
+                    pu.username as patient_username, pp.main_request, pp.contact as patient_contact,
+                    su.username as psychologist_username,
+                    sp.name, sp.photo_file_id, sp.gender, sp.age, sp.education,
+                    sp.about_me, sp.approach, sp.work_requests, sp.price,
+                    sp.experience, sp.contact as psychologist_contact, sp.profile_version,
+                    m.match_percentage
+                FROM roles r
+                LEFT JOIN users pu ON pu.user_id = r.patient_id
+                LEFT JOIN patient_profiles pp ON pp.user_id = pu.user_id
+                LEFT JOIN users su ON su.user_id = r.psychologist_id
+                LEFT JOIN psychologist_profiles sp ON sp.user_id = su.user_id
+                LEFT JOIN matches m ON m.patient_id = r.patient_id AND m.psychologist_id = r.psychologist_id
+            ''', {'from_id': from_user_id, 'to_id': to_user_id})
+            row = cursor.fetchone()
         
-        cursor.execute('''
-            INSERT INTO likes (from_user_id, to_user_id)
-            VALUES (?, ?)
-        ''', (from_user_id, to_user_id))
+        logger.info(f"Like created: {from_user_id} -> {to_user_id}, mutual: {result['is_mutual']}")
+        if row is None:
+            return result
         
+        result.update(user_type=row['user_type'], patient_id=row['patient_id'],
+                      psychologist_id=row['psychologist_id'], match_percentage=row['match_percentage'])
+        if row['main_request'] is not None:
+            result['patient'] = {'user_id': row['patient_id'], 'username': row['patient_username'],
+                                 'main_request': row['main_request'], 'contact': row['patient_contact']}
+        if row['name'] is not None:
+            result['psychologist'] = {
+                'user_id': row['psychologist_id'], 'username': row['psychologist_username'],
+                'name': row['name'], 'photo_file_id': row['photo_file_id'], 'gender': row['gender'],
+                'age': row['age'], 'education': row['education'], 'about_me': row['about_me'],
+                'approach': row['approach'], 'work_requests': row['work_requests'], 'price': row['price'],
+                'experience': row['experience'], 'contact': row['psychologist_contact'],
+                'profile_version': row['profile_version'],
+            }
+        return result
+    
+    def _insert_like(self, cursor: sqlite3.Cursor, from_user_id: int, to_user_id: int) -> Tuple[bool, bool]:
+        """
+        Вставить лайк внутри транзакции: (создан, взаимный). Повтор отсекает UNIQUE
+        (from_user_id, to_user_id) через ON CONFLICT DO NOTHING, взаимность определяется
+        той же вставкой; встречный лайк помечается отдельным UPDATE, только если лайк взаимный.
+        """
         cursor.execute('''
-            SELECT id FROM likes 
-            WHERE from_user_id = ? AND to_user_id = ?
-        ''', (to_user_id, from_user_id))
-        is_mutual = cursor.fetchone() is not None
+            INSERT INTO likes (from_user_id, to_user_id, is_mutual)
+            SELECT ?, ?, EXISTS (SELECT 1 FROM likes WHERE from_user_id = ? AND to_user_id = ?)
+            WHERE true
+            ON CONFLICT (from_user_id, to_user_id) DO NOTHING
+            RETURNING is_mutual
+        ''', (from_user_id, to_user_id, to_user_id, from_user_id))
+        # Дочитываем RETURNING до конца, чтобы оператор завершился до следующего
+        rows = cursor.fetchall()
+        if not rows:
+            return False, False
         
+        is_mutual = bool(rows[0]['is_mutual'])
         if is_mutual:
             cursor.execute('''
                 UPDATE likes SET is_mutual = 1 
-                WHERE (from_user_id = ? AND to_user_id = ?) 
-                OR (from_user_id = ? AND to_user_id = ?)
-            ''', (from_user_id, to_user_id, to_user_id, from_user_id))
-        
-        conn.commit()
-        conn.close()
-        logger.info(f"Like created: {from_user_id} -> {to_user_id}, mutual: {is_mutual}")
+                WHERE from_user_id = ? AND to_user_id = ?
+            ''', (to_user_id, from_user_id))
         return True, is_mutual
     
     def get_likes_for_psychologist(self, psychologist_id: int) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('''
             SELECT 
                 u.user_id, u.username,
@@ -346,12 +962,48 @@ class Database:
             ORDER BY l.liked_date DESC
         ''', (psychologist_id, psychologist_id))
         rows = cursor.fetchall()
-        conn.close()
         return [dict(row) for row in rows]
     
+    def get_likes_page(self, psychologist_id: int, after: Optional[Tuple] = None,
+                       direction: str = 'next', limit: int = 2,
+                       inclusive: bool = False) -> List[Dict]:
+        """
+        Окно лайков психологу с keyset-курсором по (liked_date, id), новые сначала.
+        Поля те же, что в get_likes_for_psychologist, плюс 'cursor'.
+        """
+        query = '''
+            SELECT 
+                u.user_id, u.username,
+                pp.main_request, pp.contact,
+                l.liked_date, l.is_mutual,
+                m.match_percentage,
+                l.id as like_id
+            FROM likes l
+            JOIN users u ON l.from_user_id = u.user_id
+            JOIN patient_profiles pp ON u.user_id = pp.user_id
+            LEFT JOIN matches m ON m.patient_id = u.user_id AND m.psychologist_id = ?
+            WHERE l.to_user_id = ?
+        '''
+        rows = self._fetch_keyset_page(query, [psychologist_id, psychologist_id],
+                                       'l.liked_date', 'l.id', after, direction, limit, inclusive)
+        for row in rows:
+            row['cursor'] = (row['liked_date'], row.pop('like_id'))
+        return rows
+    
+    def count_likes_for_psychologist(self, psychologist_id: int) -> int:
+        """Количество лайков от пациентов (с профилем) психологу"""
+        cursor = self.get_connection().cursor()
+        cursor.execute('''
+            SELECT COUNT(*) as count
+            FROM likes l
+            JOIN users u ON l.from_user_id = u.user_id
+            JOIN patient_profiles pp ON u.user_id = pp.user_id
+            WHERE l.to_user_id = ?
+        ''', (psychologist_id,))
+        return cursor.fetchone()['count']
+    
     def get_patient_info(self, patient_id: int) -> Optional[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('''
             SELECT u.user_id, u.username, pp.main_request, pp.contact
             FROM users u
@@ -359,55 +1011,109 @@ class Database:
             WHERE u.user_id = ?
         ''', (patient_id,))
         row = cursor.fetchone()
-        conn.close()
         return dict(row) if row else None
     
     def get_psychologist_info(self, psychologist_id: int) -> Optional[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('''
             SELECT u.user_id, u.username, 
                    pp.name, pp.photo_file_id, pp.gender, pp.age, pp.education, 
                    pp.about_me, pp.approach, pp.work_requests, pp.price, 
-                   pp.experience, pp.contact
+                   pp.experience, pp.contact, pp.profile_version
             FROM users u
             JOIN psychologist_profiles pp ON u.user_id = pp.user_id
             WHERE u.user_id = ?
         ''', (psychologist_id,))
         row = cursor.fetchone()
-        conn.close()
         return dict(row) if row else None
     
     def update_card_index(self, user_id: int, index: int):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE users SET current_card_index = ? WHERE user_id = ?
-        ''', (index, user_id))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE users SET current_card_index = ? WHERE user_id = ?
+            ''', (index, user_id))
     
     def get_card_index(self, user_id: int) -> int:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('SELECT current_card_index FROM users WHERE user_id = ?', (user_id,))
         row = cursor.fetchone()
-        conn.close()
         return row['current_card_index'] if row else 0
     
     def log_action(self, user_id: int, action_type: str, action_data: Optional[str] = None):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO user_actions (user_id, action_type, action_data)
-            VALUES (?, ?, ?)
-        ''', (user_id, action_type, action_data))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                INSERT INTO user_actions (user_id, action_type, action_data)
+                VALUES (?, ?, ?)
+            ''', (user_id, action_type, action_data))
+    
+    def log_actions(self, actions: Iterable[Tuple[int, str, Optional[str], str]]) -> int:
+        """Записать пачку событий (user_id, action_type, action_data, timestamp) одной транзакцией"""
+        rows = list(actions)
+        if not rows:
+            return 0
+        
+        with self.transaction() as cursor:
+            cursor.executemany('''
+                INSERT INTO user_actions (user_id, action_type, action_data, timestamp)
+                VALUES (?, ?, ?, ?)
+            ''', rows)
+        return len(rows)
     
     def get_statistics(self) -> Dict:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """
+        Статистика для админки и бота одним запросом по счетчикам (STATISTICS_SCHEMA).
+        Скользящие 24 часа: полные часы берутся из почасовых корзин, а начало окна
+        (неполный час) досчитывается по индексам last_active и (is_mutual, liked_date).
+        """
+        since = datetime.now(timezone.utc) - timedelta(days=1)
+        full_hours = since.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        bounds = {
+            'since': since.strftime('%Y-%m-%d %H:%M:%S'),
+            'full_hours': full_hours.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        
+        cursor = self.get_connection().cursor()
+        cursor.execute("""
+            SELECT
+                COALESCE((SELECT value FROM stat_counters WHERE name = 'users_psychologist'), 0)
+                    AS psychologists_count,
+                COALESCE((SELECT value FROM stat_counters WHERE name = 'users_patient'), 0)
+                    AS patients_count,
+                (SELECT COALESCE(SUM(value), 0) FROM activity_buckets
+                 WHERE kind = 'active_psychologist' AND bucket >= :full_hours)
+                + (SELECT COUNT(*) FROM users
+                   WHERE last_active >= :since AND last_active < :full_hours
+                   AND user_type = 'psychologist')
+                    AS active_psychologists_24h,
+                (SELECT COALESCE(SUM(value), 0) FROM activity_buckets
+                 WHERE kind = 'active_patient' AND bucket >= :full_hours)
+                + (SELECT COUNT(*) FROM users
+                   WHERE last_active >= :since AND last_active < :full_hours
+                   AND user_type = 'patient')
+                    AS active_patients_24h,
+                COALESCE((SELECT value FROM stat_counters WHERE name = 'mutual_likes'), 0)
+                    AS mutual_likes,
+                (SELECT COALESCE(SUM(value), 0) FROM activity_buckets
+                 WHERE kind = 'mutual_likes' AND bucket >= :full_hours)
+                + (SELECT COUNT(*) FROM likes
+                   WHERE is_mutual = 1 AND liked_date >= :since AND liked_date < :full_hours)
+                    AS mutual_likes_24h
+        """, bounds)
+        row = cursor.fetchone()
+        
+        return {
+            'psychologists_count': row['psychologists_count'],
+            'patients_count': row['patients_count'],
+            'active_users_24h': row['active_psychologists_24h'] + row['active_patients_24h'],
+            'active_psychologists_24h': row['active_psychologists_24h'],
+            'active_patients_24h': row['active_patients_24h'],
+            'mutual_matches': row['mutual_likes'] // 2,
+            'matches_24h': row['mutual_likes_24h'] // 2
+        }
+    
+    def recompute_statistics(self) -> Dict:
+        """Статистика напрямую из базовых таблиц (медленно; эталон для check_statistics_counters)"""
+        cursor = self.get_connection().cursor()
         
         cursor.execute("SELECT COUNT(*) as count FROM users WHERE user_type = 'psychologist'")
         psychologists_count = cursor.fetchone()['count']
@@ -445,8 +1151,6 @@ class Database:
         """)
         matches_24h = cursor.fetchone()['count'] // 2
         
-        conn.close()
-        
         return {
             'psychologists_count': psychologists_count,
             'patients_count': patients_count,
@@ -457,128 +1161,309 @@ class Database:
             'matches_24h': matches_24h
         }
     
+    def rebuild_statistics_counters(self):
+        """Пересобрать счетчики статистики из базовых таблиц"""
+        with self.transaction() as cursor:
+            for statement in STATISTICS_REBUILD:
+                cursor.execute(statement)
+        logger.info("Statistics counters rebuilt")
+    
+    def check_statistics_counters(self, repair: bool = False) -> Dict[str, Tuple[int, int]]:
+        """
+        Сверить get_statistics с пересчетом из базовых таблиц в одном снимке БД.
+        Возвращает расхождения {показатель: (по счетчикам, по таблицам)};
+        при repair=True счетчики пересобираются в той же транзакции.
+        Заодно удаляются пустые и вышедшие из окна корзины (prune_activity_buckets).
+        """
+        with self.transaction() as cursor:
+            counters = self.get_statistics()
+            actual = self.recompute_statistics()
+            mismatches = {
+                key: (counters[key], actual[key]) for key in actual if counters[key] != actual[key]
+            }
+            if mismatches and repair:
+                for statement in STATISTICS_REBUILD:
+                    cursor.execute(statement)
+            self.prune_activity_buckets()
+        
+        if mismatches:
+            logger.warning(f"Statistics counters mismatch{' (repaired)' if repair else ''}: {mismatches}")
+        return mismatches
+    
+    def prune_activity_buckets(self) -> int:
+        """
+        Удалить пустые корзины activity_buckets и корзины старше суток: get_statistics
+        читает только корзины за последние 24 часа, а триггеры старые корзины не удаляют.
+        Возвращает число удаленных корзин
+        """
+        with self.transaction() as cursor:
+            cursor.execute("""
+                DELETE FROM activity_buckets
+                WHERE value = 0 OR bucket < strftime('%Y-%m-%d %H:00:00', 'now', '-1 day')
+            """)
+            return cursor.rowcount
+    
+    def _load_feature_flags(self, data_version: int):
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT flag_name, enabled FROM feature_flags')
+        flags = {row['flag_name']: bool(row['enabled']) for row in cursor.fetchall()}
+        with self._flag_cache_lock:
+            self._flag_cache = flags
+            self._flag_cache_expires = time.monotonic() + self.flag_cache_ttl
+        self._local.flags_data_version = data_version
+    
+    def invalidate_feature_flags(self):
+        """Сбросить кэш фича-флагов"""
+        with self._flag_cache_lock:
+            self._flag_cache_expires = 0.0
+        self._local.flags_data_version = None
+    
     def get_feature_flag(self, flag_name: str) -> bool:
-        """Получить значение фича-флага"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT enabled FROM feature_flags WHERE flag_name = ?', (flag_name,))
-        row = cursor.fetchone()
-        conn.close()
-        return bool(row['enabled']) if row else False
+        """
+        Получить значение фича-флага.
+        В пределах flag_cache_ttl значение берется из памяти. После истечения TTL
+        выполняется PRAGMA data_version: флаги перечитываются, только если другое
+        соединение (например, админка) что-то закоммитило. flag_cache_ttl=0 отключает кэш.
+        """
+        if self.flag_cache_ttl <= 0:
+            cursor = self.get_connection().cursor()
+            cursor.execute('SELECT enabled FROM feature_flags WHERE flag_name = ?', (flag_name,))
+            row = cursor.fetchone()
+            return bool(row['enabled']) if row else False
+        
+        if time.monotonic() >= self._flag_cache_expires:
+            data_version = self.get_connection().execute('PRAGMA data_version').fetchone()[0]
+            if data_version != getattr(self._local, 'flags_data_version', None):
+                self._load_feature_flags(data_version)
+            else:
+                with self._flag_cache_lock:
+                    self._flag_cache_expires = time.monotonic() + self.flag_cache_ttl
+        
+        return self._flag_cache.get(flag_name, False)
     
     def set_feature_flag(self, flag_name: str, enabled: bool):
         """Установить значение фича-флага"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE feature_flags 
-            SET enabled = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE flag_name = ?
-        ''', (1 if enabled else 0, flag_name))
-        conn.commit()
-        conn.close()
+        with self.transaction() as cursor:
+            cursor.execute('''
+                UPDATE feature_flags 
+                SET enabled = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE flag_name = ?
+            ''', (1 if enabled else 0, flag_name))
+        self.invalidate_feature_flags()
         logger.info(f"Feature flag '{flag_name}' set to {enabled}")
     
     def get_all_feature_flags(self) -> List[Dict]:
         """Получить все фича-флаги"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        cursor = self.get_connection().cursor()
         cursor.execute('SELECT * FROM feature_flags ORDER BY flag_name')
         rows = cursor.fetchall()
-        conn.close()
         return [dict(row) for row in rows]
     
     def delete_user_profile(self, user_id: int):
         """Удаляет все данные пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         try:
-            # Удаляем из всех таблиц
-            cursor.execute('DELETE FROM user_actions WHERE user_id = ?', (user_id,))
-            cursor.execute('DELETE FROM test_results WHERE user_id = ?', (user_id,))
-            cursor.execute('DELETE FROM matches WHERE patient_id = ? OR psychologist_id = ?', (user_id, user_id))
-            cursor.execute('DELETE FROM likes WHERE from_user_id = ? OR to_user_id = ?', (user_id, user_id))
-            cursor.execute('DELETE FROM psychologist_profiles WHERE user_id = ?', (user_id,))
-            cursor.execute('DELETE FROM patient_profiles WHERE user_id = ?', (user_id,))
-            cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-            
-            conn.commit()
+            with self.transaction() as cursor:
+                # Удаляем из всех таблиц
+                cursor.execute('DELETE FROM user_actions WHERE user_id = ?', (user_id,))
+                cursor.execute('DELETE FROM test_results WHERE user_id = ?', (user_id,))
+                cursor.execute('DELETE FROM matches WHERE patient_id = ? OR psychologist_id = ?', (user_id, user_id))
+                cursor.execute('DELETE FROM likes WHERE from_user_id = ? OR to_user_id = ?', (user_id, user_id))
+                cursor.execute('DELETE FROM psychologist_profiles WHERE user_id = ?', (user_id,))
+                cursor.execute('DELETE FROM patient_profiles WHERE user_id = ?', (user_id,))
+                cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
             logger.info(f"User {user_id} profile deleted")
         except sqlite3.Error as e:
             logger.error(f"Error deleting user {user_id}: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
     
     def get_all_users_with_stats(self) -> List[Dict]:
-        """Получить всех пользователей со статистикой"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """
+        Получить всех пользователей со статистикой лайков.
+        Счетчики считаются двумя группировками по likes, а не подзапросами на каждую строку;
+        mutual_matches — число взаимных пар (взаимные лайки, отправленные пользователем).
+        """
+        cursor = self.get_connection().cursor()
         cursor.execute('''
             SELECT 
                 u.user_id, u.username, u.user_type, u.registration_date, 
                 u.last_active, u.test_completed,
-                (SELECT COUNT(*) FROM likes WHERE from_user_id = u.user_id) as likes_sent,
-                (SELECT COUNT(*) FROM likes WHERE to_user_id = u.user_id) as likes_received,
-                (SELECT COUNT(*) FROM likes WHERE (from_user_id = u.user_id OR to_user_id = u.user_id) AND is_mutual = 1) as mutual_matches
+                COALESCE(s.likes_sent, 0) as likes_sent,
+                COALESCE(r.likes_received, 0) as likes_received,
+                COALESCE(s.mutual_matches, 0) as mutual_matches
             FROM users u
+            LEFT JOIN (
+                SELECT from_user_id, COUNT(*) as likes_sent, SUM(is_mutual = 1) as mutual_matches
+                FROM likes GROUP BY from_user_id
+            ) s ON s.from_user_id = u.user_id
+            LEFT JOIN (
+                SELECT to_user_id, COUNT(*) as likes_received
+                FROM likes GROUP BY to_user_id
+            ) r ON r.to_user_id = u.user_id
             ORDER BY u.registration_date DESC
         ''')
         rows = cursor.fetchall()
-        conn.close()
         return [dict(row) for row in rows]
     
+    def get_users_page(self, after: Optional[Tuple] = None, direction: str = 'next', limit: int = 50,
+                       sort: str = 'registration', user_type: Optional[str] = None,
+                       blocked: Optional[bool] = None, active_after: Optional[str] = None,
+                       active_before: Optional[str] = None, search: Optional[str] = None) -> List[Dict]:
+        """
+        Страница списка пользователей для админки с keyset-курсором по (колонка сортировки, user_id),
+        по убыванию. Фильтры: тип, блокировка, last_active в [active_after, active_before),
+        поиск по username (подстрока) или точному ID. Счетчики лайков считаются одной
+        группировкой только по пользователям страницы. У каждой строки есть поле 'cursor'.
+        """
+        sort_column = USER_PAGE_SORTS.get(sort)
+        if sort_column is None:
+            raise ValueError(f"Unknown sort: {sort}")
+        
+        conditions, params = [], []
+        if user_type:
+            conditions.append('u.user_type = ?')
+            params.append(user_type)
+        if blocked is not None:
+            conditions.append('COALESCE(u.blocked, 0) = ?')
+            params.append(int(blocked))
+        if active_after:
+            conditions.append('u.last_active >= ?')
+            params.append(active_after)
+        if active_before:
+            conditions.append('u.last_active < ?')
+            params.append(active_before)
+        search = (search or '').strip().lstrip('@')
+        if search:
+            pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            if search.isdigit():
+                conditions.append("(u.user_id = ? OR u.username LIKE ? ESCAPE '\\')")
+                params.extend([int(search), pattern])
+            else:
+                conditions.append("u.username LIKE ? ESCAPE '\\'")
+                params.append(pattern)
+        
+        query = f'''
+            SELECT 
+                u.user_id, u.username, u.user_type, u.registration_date,
+                u.last_active, u.test_completed, COALESCE(u.blocked, 0) as blocked,
+                {sort_column} as sort_value
+            FROM users u
+            WHERE {' AND '.join(conditions) or '1 = 1'}
+        '''
+        rows = self._fetch_keyset_page(query, params, sort_column, 'u.user_id',
+                                       after, direction, limit, False)
+        
+        counts = self._like_counts([row['user_id'] for row in rows])
+        for row in rows:
+            row.update(counts.get(row['user_id'], {'likes_sent': 0, 'likes_received': 0, 'mutual_matches': 0}))
+            row['cursor'] = (row.pop('sort_value'), row['user_id'])
+        return rows
+    
+    def _like_counts(self, user_ids: List[int]) -> Dict[int, Dict]:
+        """Отправленные, полученные лайки и взаимные пары пользователей одной группировкой"""
+        if not user_ids:
+            return {}
+        placeholders = ', '.join('?' * len(user_ids))
+        cursor = self.get_connection().cursor()
+        cursor.execute(f'''
+            SELECT user_id, SUM(sent) as likes_sent, SUM(received) as likes_received,
+                   SUM(mutual) as mutual_matches
+            FROM (
+                SELECT from_user_id as user_id, 1 as sent, 0 as received, is_mutual = 1 as mutual
+                FROM likes WHERE from_user_id IN ({placeholders})
+                UNION ALL
+                SELECT to_user_id, 0, 1, 0
+                FROM likes WHERE to_user_id IN ({placeholders})
+            )
+            GROUP BY user_id
+        ''', list(user_ids) * 2)
+        return {
+            row['user_id']: {'likes_sent': row['likes_sent'], 'likes_received': row['likes_received'],
+                             'mutual_matches': row['mutual_matches']}
+            for row in cursor.fetchall()
+        }
+    
+    def get_user_activity_summary(self, user_id: int, actions_limit: int = 10) -> Dict:
+        """
+        Сводка активности пользователя для админки одним запросом: лайки отправленные и
+        полученные, взаимные пары, распределение процентов совместимости (перцентили по
+        ближайшему рангу), последние действия и статус теста. Каждая часть читается по
+        индексу пользователя, строки лайков и совпадений в Python не передаются.
+        """
+        cursor = self.get_connection().cursor()
+        cursor.execute('''
+            WITH
+            sent AS (
+                SELECT COUNT(*) as likes_sent, COALESCE(SUM(is_mutual = 1), 0) as mutual_matches
+                FROM likes WHERE from_user_id = :user_id
+            ),
+            received AS (
+                SELECT COUNT(*) as likes_received FROM likes WHERE to_user_id = :user_id
+            ),
+            scores AS (
+                SELECT match_percentage as score,
+                       ROW_NUMBER() OVER (ORDER BY match_percentage) as rank,
+                       COUNT(*) OVER () as total
+                FROM (
+                    SELECT match_percentage FROM matches WHERE patient_id = :user_id
+                    UNION ALL
+                    SELECT match_percentage FROM matches WHERE psychologist_id = :user_id
+                )
+            ),
+            score_stats AS (
+                SELECT COUNT(*) as matches_count, MIN(score) as score_min, AVG(score) as score_avg,
+                       MIN(CASE WHEN rank >= total * 0.25 THEN score END) as score_p25,
+                       MIN(CASE WHEN rank >= total * 0.5 THEN score END) as score_p50,
+                       MIN(CASE WHEN rank >= total * 0.9 THEN score END) as score_p90,
+                       MAX(score) as score_max
+                FROM scores
+            ),
+            recent_actions AS (
+                SELECT action_type, action_data, timestamp FROM user_actions
+                WHERE user_id = :user_id
+                ORDER BY timestamp DESC, id DESC
+                LIMIT :actions_limit
+            )
+            SELECT sent.*, received.*, score_stats.*,
+                   (SELECT json_group_array(json_object('action_type', action_type,
+                                                        'action_data', action_data,
+                                                        'timestamp', timestamp))
+                    FROM recent_actions) as last_actions,
+                   (SELECT test_completed FROM users WHERE user_id = :user_id) as test_completed,
+                   (SELECT completed_date FROM test_results WHERE user_id = :user_id) as test_completed_date
+            FROM sent, received, score_stats
+        ''', {'user_id': user_id, 'actions_limit': actions_limit})
+        summary = dict(cursor.fetchone())
+        summary['last_actions'] = json.loads(summary['last_actions'])
+        summary['test_completed'] = bool(summary['test_completed'])
+        return summary
+    
     def block_user(self, user_id: int):
         """Блокировать пользователя (помечаем в БД)"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         try:
-            # Добавляем поле blocked если его нет
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [row[1] for row in cursor.fetchall()]
-            if 'blocked' not in columns:
-                cursor.execute('ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0')
-            
-            cursor.execute('UPDATE users SET blocked = 1 WHERE user_id = ?', (user_id,))
-            conn.commit()
+            with self.transaction() as cursor:
+                # Добавляем поле blocked если его нет
+                cursor.execute("PRAGMA table_info(users)")
+                columns = [row[1] for row in cursor.fetchall()]
+                if 'blocked' not in columns:
+                    cursor.execute('ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0')
+                
+                cursor.execute('UPDATE users SET blocked = 1 WHERE user_id = ?', (user_id,))
             logger.info(f"User {user_id} blocked")
         except sqlite3.Error as e:
             logger.error(f"Error blocking user {user_id}: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
     
     def unblock_user(self, user_id: int):
         """Разблокировать пользователя"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
         try:
-            cursor.execute('UPDATE users SET blocked = 0 WHERE user_id = ?', (user_id,))
-            conn.commit()
+            with self.transaction() as cursor:
+                cursor.execute('UPDATE users SET blocked = 0 WHERE user_id = ?', (user_id,))
             logger.info(f"User {user_id} unblocked")
         except sqlite3.Error as e:
             logger.error(f"Error unblocking user {user_id}: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
     
     def is_user_blocked(self, user_id: int) -> bool:
         """Проверить, заблокирован ли пользователь"""
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        try:
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [row[1] for row in cursor.fetchall()]
-            if 'blocked' not in columns:
-                return False
-            
-            cursor.execute('SELECT blocked FROM users WHERE user_id = ?', (user_id,))
-            row = cursor.fetchone()
-            return bool(row['blocked']) if row else False
-        finally:
-            conn.close()
-
+        # Колонку blocked гарантирует init_db, поэтому схема здесь не проверяется
+        cursor = self.get_connection().cursor()
+        cursor.execute('SELECT blocked FROM users WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        return bool(row['blocked']) if row else False
@@ -1,10 +1,143 @@
 import json
+import logging
 import math
-from typing import List, Dict
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Dict, Iterator, Optional, Sequence, Tuple, Set
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _group_by_dimension(vectors: Sequence[np.ndarray],
+                        norms: Optional[Sequence[float]] = None) -> Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Раскладывает векторы по размерности: {dim: (индексы строк, матрица, нормы строк)}.
+    Готовые нормы (test_results.vector_norm) используются как есть, иначе считаются.
+    """
+    groups: Dict[int, List[int]] = {}
+    for i, vector in enumerate(vectors):
+        groups.setdefault(len(vector), []).append(i)
+    
+    result = {}
+    for dim, rows in groups.items():
+        matrix = np.array([vectors[i] for i in rows], dtype=np.float64).reshape(len(rows), dim)
+        if norms is None:
+            row_norms = np.linalg.norm(matrix, axis=1)
+        else:
+            row_norms = np.array([norms[i] for i in rows], dtype=np.float64)
+        result[dim] = (np.array(rows, dtype=np.int64), matrix, row_norms)
+    return result
+
+
+def cosine_to_percentage(dot: np.ndarray, norms_left: np.ndarray, norms_right: np.ndarray) -> np.ndarray:
+    """Переводит скалярные произведения в проценты совместимости (как calculate_match_percentage)"""
+    denominator = norms_left * norms_right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosine = np.where(denominator > 0, dot / denominator, 0.0)
+    cosine = np.clip(cosine, -1.0, 1.0)
+    percentage = np.where(denominator > 0, (cosine + 1) / 2 * 100, 0.0)
+    return np.round(percentage, 1)
+
+
+def _score_query(query: np.ndarray, groups: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]],
+                 size: int) -> np.ndarray:
+    """Совместимость вектора с заранее сгруппированными векторами (результат _group_by_dimension)"""
+    scores = np.zeros(size, dtype=np.float64)
+    query = np.asarray(query, dtype=np.float64)
+    group = groups.get(query.shape[0])
+    if group is None:
+        return scores
+    
+    rows, matrix, row_norms = group
+    scores[rows] = cosine_to_percentage(matrix @ query, row_norms, np.linalg.norm(query))
+    return scores
+
+
+def top_k_order(ids: np.ndarray, scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Индексы k лучших строк в порядке показа карточек: по убыванию (score, id).
+    argpartition отбирает кандидатов за O(n), сортируются только они
+    (вместе со всеми строками, равными k-му результату, чтобы порядок был детерминирован).
+    """
+    if k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < len(scores):
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = np.flatnonzero(scores >= scores[candidates].min())
+    else:
+        candidates = np.arange(len(scores))
+    order = np.lexsort((-ids[candidates], -scores[candidates]))
+    return candidates[order[:k]]
+
+
+@dataclass
+class ReconcilePlan:
+    """Состояние сверки: пациенты к проверке и векторы на момент начала"""
+    patient_ids: List[int]
+    patient_vectors: Dict[int, Tuple[np.ndarray, float]]
+    psychologist_ids: np.ndarray
+    psychologist_vectors: List[np.ndarray]
+    psychologist_norms: np.ndarray
+    
+    def chunks(self, chunk_size: int) -> Iterator[List[int]]:
+        for start in range(0, len(self.patient_ids), chunk_size):
+            yield self.patient_ids[start:start + chunk_size]
+
+
+@dataclass
+class ReconcileDiff:
+    """Расхождения matches одной порции пациентов"""
+    upserts: List[Tuple[int, int, float]] = field(default_factory=list)
+    deletes: List[Tuple[int, int]] = field(default_factory=list)
+    inserted: int = 0
+    updated: int = 0
+
 
 class MatchingSystem:
-    def __init__(self, db):
+    """
+    Расчет совместимости и поддержка таблицы matches.
+    
+    ranking_mode:
+      - 'materialized' — в matches хранятся все пары пациент × психолог;
+      - 'topk' — у каждого пациента хранятся только top_k лучших психологов. Они
+        пересчитываются по матрице векторов психологов в памяти, когда пациент открывает
+        каталог (refresh_top_k), и при завершении теста пациентом. Завершение теста
+        психологом строк не пишет: он попадет в топы при следующем открытии каталога.
+    Матрица психологов перечитывается раз в vectors_ttl секунд или после invalidate_vectors().
+    
+    ann_index (например, ann_index.IVFIndex) — генератор кандидатов для top_k_for_patient:
+    вместо точного расчета по всем психологам берутся k ближайших из индекса.
+    Индекс строится при первом запросе, обновляется инкрементально в update_user/forget_user
+    и перестраивается целиком в начале сверки (prepare_reconcile).
+    
+    vector_store (vector_store.VectorStore) — общий для процессов файл векторов: если задан,
+    инкрементальные расчеты и top-K считаются прямо по нему, без чтения векторов из SQLite.
+    Файл поддерживается в update_user/forget_user и пересобирается sync_vector_store().
+    """
+    
+    RANKING_MODES = ('materialized', 'topk')
+    
+    def __init__(self, db, ranking_mode: str = 'materialized', top_k: int = 50,
+                 vectors_ttl: float = 60.0, ann_index=None, vector_store=None):
+        if ranking_mode not in self.RANKING_MODES:
+            raise ValueError(f"Unknown ranking mode: {ranking_mode}")
         self.db = db
+        self.ranking_mode = ranking_mode
+        self.top_k = top_k
+        self.vectors_ttl = vectors_ttl
+        # Пользователи, чьи векторы (или статус) изменились и ждут пересчета
+        self._dirty: Set[int] = set()
+        self._dirty_lock = threading.Lock()
+        # Пользователи, пересчитанные update_user во время сверки (None — сверка не идет)
+        self._reconcile_touched: Optional[Set[int]] = None
+        # Кэш матрицы психологов для режима topk: (id, группы по размерности, время загрузки)
+        self._psychologist_vectors: Optional[Tuple[np.ndarray, Dict, float]] = None
+        self._vectors_lock = threading.Lock()
+        self.ann_index = ann_index
+        self.vector_store = vector_store
     
     def calculate_match_percentage(self, vector1_str: str, vector2_str: str) -> float:
         vector1 = json.loads(vector1_str)
@@ -26,35 +159,360 @@ class MatchingSystem:
         
         return round(percentage, 1)
     
-    def calculate_all_matches_for_patient(self, patient_id: int):
-        patient_vector = self.db.get_test_result(patient_id)
-        if not patient_vector:
+    def load_vectors(self, user_type: str) -> Tuple[np.ndarray, List[np.ndarray], np.ndarray]:
+        """Загружает векторы (float32-view поверх BLOB) и их нормы для всех пользователей типа одним запросом"""
+        rows = self.db.get_test_vectors(user_type)
+        ids = np.array([user_id for user_id, _, _ in rows], dtype=np.int64)
+        vectors = [vector for _, vector, _ in rows]
+        norms = np.array([norm for _, _, norm in rows], dtype=np.float64)
+        return ids, vectors, norms
+    
+    def score_vector(self, vector: Sequence[float], vectors: Sequence[np.ndarray],
+                     norms: Optional[Sequence[float]] = None) -> np.ndarray:
+        """
+        Совместимость одного вектора со списком векторов одним матрично-векторным
+        произведением. Векторы другой размерности получают 0.0.
+        """
+        return _score_query(vector, _group_by_dimension(vectors, norms), len(vectors))
+    
+    def score_matrix(self, left: Sequence[np.ndarray], right: Sequence[np.ndarray],
+                     left_norms: Optional[Sequence[float]] = None,
+                     right_norms: Optional[Sequence[float]] = None) -> np.ndarray:
+        """Полная матрица совместимости left × right (одно матричное произведение на размерность)"""
+        scores = np.zeros((len(left), len(right)), dtype=np.float64)
+        left_groups = _group_by_dimension(left, left_norms)
+        right_groups = _group_by_dimension(right, right_norms)
+        
+        for dim, (left_rows, left_matrix, left_row_norms) in left_groups.items():
+            if dim not in right_groups:
+                continue
+            right_rows, right_matrix, right_row_norms = right_groups[dim]
+            block = cosine_to_percentage(
+                left_matrix @ right_matrix.T,
+                left_row_norms[:, None],
+                right_row_norms[None, :]
+            )
+            scores[np.ix_(left_rows, right_rows)] = block
+        return scores
+    
+    def get_vector(self, user_id: int) -> Optional[np.ndarray]:
+        """Вектор пользователя из vector_store, если он есть, иначе из test_results"""
+        if self.vector_store is not None:
+            vector = self.vector_store.get(user_id)
+            if vector is not None:
+                return vector
+        return self.db.get_test_vector(user_id)
+    
+    def _use_vector_store(self, vector: Sequence[float]) -> bool:
+        """
+        Считать по vector_store: в файле векторы одной размерности, запрос другой
+        размерности считается по SQLite, где у него могут быть совпадающие по размерности пары
+        """
+        return self.vector_store is not None and len(vector) == self.vector_store.header()['dim']
+    
+    def score_against(self, vector: Sequence[float], user_type: str) -> Tuple[np.ndarray, np.ndarray]:
+        """(id, проценты совместимости) вектора со всеми пользователями типа"""
+        if self._use_vector_store(vector):
+            return self.vector_store.score(vector, user_type)
+        ids, vectors, norms = self.load_vectors(user_type)
+        return ids, self.score_vector(vector, vectors, norms)
+    
+    def calculate_scores_for_patient(self, patient_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Возвращает (id психологов, проценты совместимости) для пациента"""
+        patient_vector = self.get_vector(patient_id)
+        if patient_vector is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return self.score_against(patient_vector, 'psychologist')
+    
+    def calculate_scores_for_psychologist(self, psychologist_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Возвращает (id пациентов, проценты совместимости) для психолога"""
+        psychologist_vector = self.get_vector(psychologist_id)
+        if psychologist_vector is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return self.score_against(psychologist_vector, 'patient')
+    
+    def calculate_match_matrix(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Возвращает (id пациентов, id психологов, матрица пациенты × психологи) для полного пересчета"""
+        patient_ids, patient_vectors, patient_norms = self.load_vectors('patient')
+        psychologist_ids, psychologist_vectors, psychologist_norms = self.load_vectors('psychologist')
+        scores = self.score_matrix(patient_vectors, psychologist_vectors, patient_norms, psychologist_norms)
+        return patient_ids, psychologist_ids, scores
+    
+    def psychologist_vectors(self) -> Tuple[np.ndarray, Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]]]:
+        """Матрица векторов психологов в памяти: (id, группы по размерности), с TTL"""
+        with self._vectors_lock:
+            cached = self._psychologist_vectors
+            if cached is None or time.monotonic() - cached[2] >= self.vectors_ttl:
+                ids, vectors, norms = self.load_vectors('psychologist')
+                cached = (ids, _group_by_dimension(vectors, norms), time.monotonic())
+                self._psychologist_vectors = cached
+            return cached[0], cached[1]
+    
+    def invalidate_vectors(self):
+        """Сбросить матрицу психологов (вектор, блокировка или удаление психолога)"""
+        with self._vectors_lock:
+            self._psychologist_vectors = None
+    
+    def build_ann_index(self):
+        """Полностью перестроить ann_index по векторам психологов из test_results"""
+        psychologist_ids, vectors, _ = self.load_vectors('psychologist')
+        self.ann_index.build(psychologist_ids, vectors)
+    
+    def _sync_ann_index(self, user_id: int, active: bool):
+        """Инкрементально добавить (обновить) или удалить психолога в ann_index"""
+        if self.ann_index is None or not self.ann_index.is_built:
             return
+        vector = self.db.get_test_vector(user_id) if active else None
+        if vector is None:
+            self.ann_index.remove(user_id)
+        else:
+            self.ann_index.add(user_id, vector)
+    
+    def sync_vector_store(self) -> int:
+        """Пересобрать vector_store из test_results (незаблокированные пользователи, прошедшие тест)"""
+        if self.vector_store is None:
+            return 0
+        rows = [
+            (user_id, user_type, vector)
+            for user_type in ('patient', 'psychologist')
+            for user_id, vector, _ in self.db.get_test_vectors(user_type)
+        ]
+        return self.vector_store.rebuild(rows)
+    
+    def _sync_vector_store(self, user_id: int, user_type: Optional[str], active: bool):
+        """Записать текущий вектор пользователя в vector_store или удалить его оттуда"""
+        if self.vector_store is None:
+            return
+        vector = self.db.get_test_vector(user_id) if active else None
+        if vector is None:
+            self.vector_store.delete(user_id)
+        else:
+            self.vector_store.upsert(user_id, user_type, vector)
+    
+    def top_k_for_patient(self, patient_id: int, k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(id психологов, проценты) — k лучших для пациента по убыванию, без обращения к matches"""
+        k = self.top_k if k is None else k
+        patient_vector = self.get_vector(patient_id)
+        if patient_vector is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
         
-        psychologists = self.db.get_all_psychologists()
+        if self.ann_index is not None:
+            if not self.ann_index.is_built:
+                self.build_ann_index()
+            psychologist_ids, cosine = self.ann_index.search(patient_vector, k)
+            return psychologist_ids, cosine_to_percentage(cosine, 1.0, 1.0)
         
-        for psychologist_id in psychologists:
-            psychologist_vector = self.db.get_test_result(psychologist_id)
-            if psychologist_vector:
-                match_percentage = self.calculate_match_percentage(
-                    patient_vector, psychologist_vector
-                )
-                self.db.save_match(patient_id, psychologist_id, match_percentage)
+        if self._use_vector_store(patient_vector):
+            psychologist_ids, scores = self.vector_store.score(patient_vector, 'psychologist')
+        else:
+            psychologist_ids, groups = self.psychologist_vectors()
+            scores = _score_query(patient_vector, groups, len(psychologist_ids))
+        order = top_k_order(psychologist_ids, scores, k)
+        return psychologist_ids[order], scores[order]
+    
+    def refresh_top_k(self, patient_id: int) -> int:
+        """
+        Режим topk: заменить строки пациента в matches его текущими top_k психологами
+        (вызывается при открытии каталога). В режиме materialized ничего не делает.
+        """
+        if self.ranking_mode != 'topk':
+            return 0
+        psychologist_ids, scores = self.top_k_for_patient(patient_id)
+        return self.db.replace_matches_for_user(
+            patient_id, zip(np.full(len(psychologist_ids), patient_id), psychologist_ids, scores)
+        )
+    
+    def _retained_rows(self, patient_ids: np.ndarray, psychologist_ids: np.ndarray,
+                       scores: np.ndarray) -> Iterator[Tuple[int, int, float]]:
+        """Строки matches, которые хранятся в текущем режиме: все пары или top_k на пациента"""
+        for i, patient_id in enumerate(patient_ids.tolist()):
+            if self.ranking_mode == 'topk':
+                columns = top_k_order(psychologist_ids, scores[i], self.top_k)
+            else:
+                columns = slice(None)
+            for psychologist_id, match_percentage in zip(psychologist_ids[columns].tolist(),
+                                                         scores[i][columns].tolist()):
+                yield patient_id, psychologist_id, match_percentage
+    
+    def calculate_all_matches_for_patient(self, patient_id: int):
+        psychologist_ids, scores = self.calculate_scores_for_patient(patient_id)
+        self.db.save_matches(zip(np.full(len(psychologist_ids), patient_id), psychologist_ids, scores))
     
     def calculate_all_matches_for_psychologist(self, psychologist_id: int):
-        psychologist_vector = self.db.get_test_result(psychologist_id)
-        if not psychologist_vector:
-            return
+        patient_ids, scores = self.calculate_scores_for_psychologist(psychologist_id)
+        self.db.save_matches(zip(patient_ids, np.full(len(patient_ids), psychologist_id), scores))
+    
+    def recalculate_all_matches(self, chunk_size: int = 5000) -> int:
+        """Полный пересчет таблицы совместимости с потоковой записью по chunk_size строк"""
+        patient_ids, psychologist_ids, scores = self.calculate_match_matrix()
+        return self.db.save_matches_stream(
+            self._retained_rows(patient_ids, psychologist_ids, scores), chunk_size=chunk_size
+        )
+
+    def mark_dirty(self, user_id: int):
+        """
+        Отметить пользователя для инкрементального пересчета в этом процессе (вектор, роль,
+        блокировка). Другие процессы ставят пользователя в очередь Database.queue_match_update.
+        """
+        with self._dirty_lock:
+            self._dirty.add(user_id)
+    
+    def forget_user(self, user_id: int):
+        """Пользователь удален: его строки уже удалены delete_user_profile"""
+        with self._dirty_lock:
+            self._dirty.discard(user_id)
+            if self._reconcile_touched is not None:
+                self._reconcile_touched.add(user_id)
+        self.invalidate_vectors()
+        self._sync_ann_index(user_id, active=False)
+        self._sync_vector_store(user_id, None, active=False)
+    
+    def pending_updates(self) -> int:
+        return len(self._dirty)
+    
+    def update_user(self, user_id: int) -> int:
+        """
+        Инкрементально обновить строки одного пользователя: пересчитать их
+        по текущему вектору или удалить, если пользователя нет, он заблокирован
+        или не прошел тест. Возвращает число записанных строк.
+        """
+        with self._dirty_lock:
+            if self._reconcile_touched is not None:
+                self._reconcile_touched.add(user_id)
+        user = self.db.get_user(user_id)
+        active = bool(user and not user.get('blocked') and user['test_completed'])
+        self._sync_vector_store(user_id, user and user['user_type'], active)
+        if not user or user['user_type'] != 'patient':
+            self.invalidate_vectors()
+            self._sync_ann_index(user_id, active)
         
-        patients = self.db.get_all_patients()
+        if not active:
+            self.db.replace_matches_for_user(user_id, [])
+            return 0
+        
+        if user['user_type'] == 'patient':
+            if self.ranking_mode == 'topk':
+                return self.refresh_top_k(user_id)
+            psychologist_ids, scores = self.calculate_scores_for_patient(user_id)
+            rows = zip(np.full(len(psychologist_ids), user_id), psychologist_ids, scores)
+        elif self.ranking_mode == 'topk':
+            # Строки психолога в топах пациентов обновятся при следующем открытии каталога
+            return 0
+        else:
+            patient_ids, scores = self.calculate_scores_for_psychologist(user_id)
+            rows = zip(patient_ids, np.full(len(patient_ids), user_id), scores)
+        return self.db.replace_matches_for_user(user_id, rows)
+    
+    def update_dirty(self) -> int:
+        """
+        Пересчитать всех отмеченных пользователей: отмеченных в этом процессе и из общей
+        очереди match_updates. Возвращает число обработанных
+        """
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+        dirty.update(self.db.take_match_updates())
         
-        for patient_id in patients:
-            patient_vector = self.db.get_test_result(patient_id)
-            if patient_vector:
-                match_percentage = self.calculate_match_percentage(
-                    patient_vector, psychologist_vector
-                )
-                self.db.save_match(patient_id, psychologist_id, match_percentage)
+        for user_id in dirty:
+            try:
+                self.update_user(user_id)
+            except Exception:
+                logger.exception(f"Failed to update matches for user {user_id}")
+                self.mark_dirty(user_id)
+        return len(dirty)
+    
+    def prepare_reconcile(self) -> ReconcilePlan:
+        """
+        Начало сверки: перестроить ann_index и vector_store, загрузить векторы и список
+        пациентов (прошедшие тест и те, у кого есть строки в matches). Только чтение SQLite.
+        """
+        with self._dirty_lock:
+            self._reconcile_touched = set()
+        if self.ann_index is not None:
+            self.build_ann_index()
+        self.sync_vector_store()
+        
+        patient_ids, patient_vectors, patient_norms = self.load_vectors('patient')
+        psychologist_ids, psychologist_vectors, psychologist_norms = self.load_vectors('psychologist')
+        return ReconcilePlan(
+            patient_ids=sorted(set(patient_ids.tolist()) | set(self.db.get_match_patient_ids())),
+            patient_vectors={
+                patient_id: (vector, norm)
+                for patient_id, vector, norm in zip(patient_ids.tolist(), patient_vectors, patient_norms.tolist())
+            },
+            psychologist_ids=psychologist_ids,
+            psychologist_vectors=psychologist_vectors,
+            psychologist_norms=psychologist_norms,
+        )
+    
+    def reconcile_diff(self, plan: ReconcilePlan, patient_ids: Sequence[int]) -> ReconcileDiff:
+        """Расхождения matches для порции пациентов: расчет по векторам плана, только чтение SQLite"""
+        existing = {
+            (patient_id, psychologist_id): match_percentage
+            for patient_id, psychologist_id, match_percentage in self.db.get_matches_for_patients(list(patient_ids))
+        }
+        active = [patient_id for patient_id in patient_ids if patient_id in plan.patient_vectors]
+        scores = self.score_matrix(
+            [plan.patient_vectors[patient_id][0] for patient_id in active], plan.psychologist_vectors,
+            [plan.patient_vectors[patient_id][1] for patient_id in active], plan.psychologist_norms
+        )
+        
+        diff = ReconcileDiff()
+        rows = self._retained_rows(np.array(active, dtype=np.int64), plan.psychologist_ids, scores)
+        for patient_id, psychologist_id, match_percentage in rows:
+            current = existing.pop((patient_id, psychologist_id), None)
+            if current is None:
+                diff.inserted += 1
+            elif round(current, 1) != round(match_percentage, 1):
+                diff.updated += 1
+            else:
+                continue
+            diff.upserts.append((patient_id, psychologist_id, match_percentage))
+        diff.deletes = list(existing)
+        return diff
+    
+    def apply_reconcile_diff(self, diff: ReconcileDiff) -> int:
+        """
+        Записать расхождения порции одной короткой транзакцией. Строки пользователей,
+        пересчитанных update_user после начала сверки, пропускаются: они свежее плана.
+        Возвращает число удаленных строк.
+        """
+        with self._dirty_lock:
+            touched = set(self._reconcile_touched or ())
+        if touched:
+            diff.upserts = [row for row in diff.upserts if row[0] not in touched and row[1] not in touched]
+            diff.deletes = [pair for pair in diff.deletes if pair[0] not in touched and pair[1] not in touched]
+        return self.db.apply_matches_diff(diff.upserts, diff.deletes)
+    
+    def finish_reconcile(self, result: Dict[str, int]) -> Dict[str, int]:
+        """
+        Конец сверки. Пользователи, пересчитанные во время нее, отмечаются для повторного
+        update_user: пересборка индекса и vector_store могла перезаписать их свежие векторы
+        """
+        with self._dirty_lock:
+            touched, self._reconcile_touched = self._reconcile_touched or set(), None
+            self._dirty.update(touched)
+        logger.info(f"Matches reconciled: {result}")
+        return result
+    
+    def reconcile(self, chunk_size: int = 500) -> Dict[str, int]:
+        """
+        Сверка matches с test_results порциями по chunk_size пациентов: расчет только для
+        порции и запись только расходящихся строк (новых, изменившихся, лишних) отдельной
+        короткой транзакцией на порцию. Исправляет строки, пропущенные инкрементальным
+        пересчетом (изменения из других процессов, сбои update_dirty). В боте шаги выполняет
+        MatchMaintenanceWorker: расчет в потоках-читателях, запись в потоке-писателе.
+        """
+        plan = self.prepare_reconcile()
+        result = {'inserted': 0, 'updated': 0, 'deleted': 0}
+        try:
+            for chunk in plan.chunks(chunk_size):
+                diff = self.reconcile_diff(plan, chunk)
+                result['deleted'] += self.apply_reconcile_diff(diff)
+                result['inserted'] += diff.inserted
+                result['updated'] += diff.updated
+        finally:
+            self.finish_reconcile(result)
+        return result
 
 
 class PsychologicalTest:
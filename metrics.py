@@ -0,0 +1,278 @@
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Верхние границы корзин гистограммы задержек в секундах: 50 мкс × 2^i, до ~26 с
+BUCKETS = tuple(50e-6 * 2 ** i for i in range(20))
+
+
+class _Series:
+    """Счетчики одного имени в одном потоке (пишет только поток-владелец)"""
+
+    __slots__ = ('count', 'errors', 'rows', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def merge(self, other: '_Series'):
+        self.count += other.count
+        self.errors += other.errors
+        self.rows += other.rows
+        self.total += other.total
+        for i, value in enumerate(other.buckets):
+            self.buckets[i] += value
+
+
+class _ThreadStore:
+    """Словарь счетчиков потока в threading.local: удаляется вместе с завершившимся потоком"""
+
+    def __init__(self):
+        self.series: Dict[str, _Series] = {}
+
+
+class MetricsRegistry:
+    """
+    Метрики задержек обработчиков бота и методов Database.
+
+    Каждый поток пишет в собственный словарь счетчиков (threading.local), поэтому
+    запись не берет блокировок и не конкурирует с другими потоками. snapshot()
+    суммирует словари всех потоков; чтение чужих счетчиков под GIL безопасно,
+    а возможное расхождение на один вызов для метрик не важно. Словарь завершившегося
+    потока (например, запроса Flask) вливается в общий итог и больше не хранится отдельно.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._stores: List[Dict[str, _Series]] = []
+        self._stores_lock = threading.Lock()
+        # Счетчики завершившихся потоков
+        self._retired: Dict[str, _Series] = {}
+
+    def _store(self) -> Dict[str, _Series]:
+        holder = getattr(self._local, 'store', None)
+        if holder is None:
+            holder = self._local.store = _ThreadStore()
+            # Блокировка берется один раз на поток — при регистрации его словаря
+            with self._stores_lock:
+                self._stores.append(holder.series)
+            weakref.finalize(holder, self._retire, holder.series)
+        return holder.series
+
+    def _retire(self, store: Dict[str, _Series]):
+        """Поток завершился: перенести его счетчики в общий итог"""
+        with self._stores_lock:
+            self._stores = [other for other in self._stores if other is not store]
+            for name, series in store.items():
+                retired = self._retired.get(name)
+                if retired is None:
+                    retired = self._retired[name] = _Series()
+                retired.merge(series)
+
+    def observe(self, name: str, seconds: float, error: bool = False, rows: Optional[int] = None):
+        store = self._store()
+        series = store.get(name)
+        if series is None:
+            series = store[name] = _Series()
+        series.count += 1
+        series.total += seconds
+        series.buckets[bisect_left(BUCKETS, seconds)] += 1
+        if error:
+            series.errors += 1
+        if rows:
+            series.rows += rows
+
+    @contextmanager
+    def timed(self, name: str):
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, error)
+
+    def instrument(self, func: Callable, name: Optional[str] = None) -> Callable:
+        """Обернуть функцию или корутину замером задержки, ошибок и числа строк результата"""
+        name = name or func.__qualname__
+        observe = self.observe
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    result = await func(*args, **kwargs)
+                except BaseException:
+                    observe(name, time.perf_counter() - started, error=True)
+                    raise
+                observe(name, time.perf_counter() - started, rows=_rows(result))
+                return result
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                observe(name, time.perf_counter() - started, error=True)
+                raise
+            observe(name, time.perf_counter() - started, rows=_rows(result))
+            return result
+        return wrapper
+
+    def instrument_methods(self, obj: Any, prefix: str, exclude: Iterable[str] = ()) -> Any:
+        """Заменить публичные методы объекта обертками (атрибуты экземпляра) с именами prefix.method"""
+        exclude = set(exclude)
+        for name in dir(obj):
+            if name.startswith('_') or name in exclude:
+                continue
+            method = getattr(obj, name)
+            if inspect.ismethod(method):
+                setattr(obj, name, self.instrument(method, f'{prefix}.{name}'))
+        return obj
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """Сумма счетчиков всех потоков: {имя: {count, errors, rows, sum, buckets}}"""
+        with self._stores_lock:
+            stores = list(self._stores)
+            # Копия итога: завершение потока во время суммирования не должно его менять
+            retired = {}
+            for name, series in self._retired.items():
+                retired[name] = _Series()
+                retired[name].merge(series)
+            stores.append(retired)
+
+        result: Dict[str, Dict] = {}
+        for store in stores:
+            for name, series in list(store.items()):
+                merged = result.get(name)
+                if merged is None:
+                    merged = result[name] = {'count': 0, 'errors': 0, 'rows': 0, 'sum': 0.0,
+                                             'buckets': [0] * (len(BUCKETS) + 1)}
+                merged['count'] += series.count
+                merged['errors'] += series.errors
+                merged['rows'] += series.rows
+                merged['sum'] += series.total
+                for i, value in enumerate(series.buckets):
+                    merged['buckets'][i] += value
+        return result
+
+    def dump(self, path: str, process: str):
+        """Атомарно записать снимок в JSON-файл (его читает другой процесс, например админка)"""
+        data = {'process': process, 'pid': os.getpid(), 'updated_at': time.time(), 'metrics': self.snapshot()}
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+def _rows(result: Any) -> Optional[int]:
+    """Число строк в результате: длина списка, 1 для словаря (одна строка)"""
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict):
+        return 1
+    return None
+
+
+def load_snapshot(path: str) -> Optional[Dict]:
+    """Прочитать снимок, записанный dump(); None — файла нет или он поврежден"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def quantile(series: Dict, q: float) -> Optional[float]:
+    """Оценка квантиля по корзинам гистограммы (линейно внутри корзины), в секундах"""
+    count = series['count']
+    if not count:
+        return None
+    rank = q * count
+    seen = 0
+    for i, value in enumerate(series['buckets']):
+        if value and seen + value >= rank:
+            lower = BUCKETS[i - 1] if i > 0 else 0.0
+            upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1] * 2
+            return lower + (upper - lower) * (rank - seen) / value
+        seen += value
+    return BUCKETS[-1]
+
+
+def summary(snapshot: Dict[str, Dict]) -> List[Dict]:
+    """Строки для страницы производительности, самые затратные по суммарному времени сверху"""
+    rows = []
+    for name, series in snapshot.items():
+        rows.append({
+            'name': name,
+            'count': series['count'],
+            'errors': series['errors'],
+            'rows': series['rows'],
+            'total_s': series['sum'],
+            'avg_ms': series['sum'] / series['count'] * 1000 if series['count'] else 0.0,
+            'p50_ms': (quantile(series, 0.5) or 0.0) * 1000,
+            'p95_ms': (quantile(series, 0.95) or 0.0) * 1000,
+            'p99_ms': (quantile(series, 0.99) or 0.0) * 1000,
+        })
+    rows.sort(key=lambda row: row['total_s'], reverse=True)
+    return rows
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def to_prometheus(snapshots: Dict[str, Dict[str, Dict]]) -> str:
+    """Текстовый формат Prometheus для снимков нескольких процессов: {process: snapshot}"""
+    lines = [
+        '# HELP psymatch_call_duration_seconds Latency of bot handlers and database calls',
+        '# TYPE psymatch_call_duration_seconds histogram',
+    ]
+    for process, snapshot in snapshots.items():
+        for name, series in sorted(snapshot.items()):
+            labels = f'process="{_escape(process)}",name="{_escape(name)}"'
+            cumulative = 0
+            for bound, value in zip(BUCKETS, series['buckets']):
+                cumulative += value
+                lines.append(f'psymatch_call_duration_seconds_bucket{{{labels},le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'psymatch_call_duration_seconds_bucket{{{labels},le="+Inf"}} {series["count"]}')
+            lines.append(f'psymatch_call_duration_seconds_sum{{{labels}}} {series["sum"]:.6f}')
+            lines.append(f'psymatch_call_duration_seconds_count{{{labels}}} {series["count"]}')
+
+    for metric, key, help_text in (
+        ('psymatch_call_errors_total', 'errors', 'Calls that raised an exception'),
+        ('psymatch_call_rows_total', 'rows', 'Rows returned by calls'),
+    ):
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} counter')
+        for process, snapshot in snapshots.items():
+            for name, series in sorted(snapshot.items()):
+                lines.append(f'{metric}{{process="{_escape(process)}",name="{_escape(name)}"}} {series[key]}')
+    return '\n'.join(lines) + '\n'
+
+
+# Общий реестр процесса
+registry = MetricsRegistry()
+
+# Служебные методы Database (соединения, транзакции, схема) не замеряются
+DATABASE_EXCLUDED_METHODS = ('get_connection', 'transaction', 'close', 'init_db')
+
+
+def instrument_database(db, metrics_registry: MetricsRegistry = registry):
+    """Замерять все публичные методы экземпляра Database под именами db.<метод>"""
+    return metrics_registry.instrument_methods(db, 'db', DATABASE_EXCLUDED_METHODS)
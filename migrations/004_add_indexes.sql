@@ -0,0 +1,31 @@
+-- Migration 004: Индексы для горячих запросов (совместимость, лайки, действия)
+
+-- Карточки пациента: WHERE patient_id = ? ORDER BY match_percentage DESC (+ keyset по psychologist_id)
+CREATE INDEX IF NOT EXISTS idx_matches_patient_score
+    ON matches (patient_id, match_percentage DESC, psychologist_id DESC);
+
+-- Фильтр только по психологу: лайки психолога, удаление профиля
+CREATE INDEX IF NOT EXISTS idx_matches_psychologist
+    ON matches (psychologist_id, patient_id, match_percentage);
+
+-- Полученные лайки: WHERE to_user_id = ? ORDER BY liked_date DESC (+ keyset по id)
+CREATE INDEX IF NOT EXISTS idx_likes_to_user
+    ON likes (to_user_id, liked_date DESC, id DESC);
+
+-- Взаимные лайки для статистики
+CREATE INDEX IF NOT EXISTS idx_likes_mutual_date
+    ON likes (is_mutual, liked_date);
+
+-- Действия пользователей: по пользователю и по типу действия во времени
+CREATE INDEX IF NOT EXISTS idx_user_actions_user_time
+    ON user_actions (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_user_actions_type_time
+    ON user_actions (action_type, timestamp);
+
+-- Пользователи: выборки по типу (прошедшие тест, каталог по дате регистрации) и активность
+CREATE INDEX IF NOT EXISTS idx_users_type_completed
+    ON users (user_type, test_completed);
+CREATE INDEX IF NOT EXISTS idx_users_type_registration
+    ON users (user_type, registration_date DESC, user_id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_last_active
+    ON users (last_active);
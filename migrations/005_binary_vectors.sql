@@ -0,0 +1,8 @@
+-- Migration 005: Бинарное хранение векторов ценностей
+-- vector_blob - упакованный float32-вектор, vector_norm - L2-норма, vector_dim - размерность.
+-- Существующие JSON-строки (values_vector) переводятся в BLOB при следующем запуске
+-- бота или админки (Database.backfill_vector_blobs); до этого они читаются из JSON.
+
+ALTER TABLE test_results ADD COLUMN vector_blob BLOB;
+ALTER TABLE test_results ADD COLUMN vector_norm REAL;
+ALTER TABLE test_results ADD COLUMN vector_dim INTEGER;
@@ -0,0 +1,108 @@
+-- Migration 006: Материализованные счетчики статистики
+-- stat_counters - итоги (пользователи по типам, взаимные лайки), activity_buckets - почасовые
+-- корзины для скользящих 24 часов: пользователи по часу last_active, взаимные лайки по часу liked_date.
+-- Счетчики поддерживаются триггерами, поэтому учитываются все пути записи (бот, админка, скрипты).
+-- Database.get_statistics читает их одним запросом; проверка и пересборка из базовых таблиц —
+-- scripts/check_statistics.py.
+
+CREATE TABLE IF NOT EXISTS stat_counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS activity_buckets (
+    kind TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    value INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, bucket)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users
+BEGIN
+    INSERT INTO stat_counters (name, value) VALUES ('users_' || NEW.user_type, 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    INSERT INTO activity_buckets (kind, bucket, value)
+        SELECT 'active_' || NEW.user_type, strftime('%Y-%m-%d %H:00:00', NEW.last_active), 1
+        WHERE strftime('%Y-%m-%d %H:00:00', NEW.last_active) IS NOT NULL
+        ON CONFLICT (kind, bucket) DO UPDATE SET value = value + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users
+BEGIN
+    UPDATE stat_counters SET value = value - 1 WHERE name = 'users_' || OLD.user_type;
+    UPDATE activity_buckets SET value = value - 1
+        WHERE kind = 'active_' || OLD.user_type
+        AND bucket = strftime('%Y-%m-%d %H:00:00', OLD.last_active);
+END;
+
+-- Касание в пределах того же часа корзину не меняет, поэтому триггер срабатывает редко
+CREATE TRIGGER IF NOT EXISTS trg_users_stats_update AFTER UPDATE OF user_type, last_active ON users
+WHEN OLD.user_type IS NOT NEW.user_type
+    OR strftime('%Y-%m-%d %H:00:00', OLD.last_active) IS NOT strftime('%Y-%m-%d %H:00:00', NEW.last_active)
+BEGIN
+    UPDATE stat_counters SET value = value - 1
+        WHERE name = 'users_' || OLD.user_type AND OLD.user_type IS NOT NEW.user_type;
+    INSERT INTO stat_counters (name, value)
+        SELECT 'users_' || NEW.user_type, 1 WHERE OLD.user_type IS NOT NEW.user_type
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    UPDATE activity_buckets SET value = value - 1
+        WHERE kind = 'active_' || OLD.user_type
+        AND bucket = strftime('%Y-%m-%d %H:00:00', OLD.last_active);
+    INSERT INTO activity_buckets (kind, bucket, value)
+        SELECT 'active_' || NEW.user_type, strftime('%Y-%m-%d %H:00:00', NEW.last_active), 1
+        WHERE strftime('%Y-%m-%d %H:00:00', NEW.last_active) IS NOT NULL
+        ON CONFLICT (kind, bucket) DO UPDATE SET value = value + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_likes_stats_insert AFTER INSERT ON likes
+WHEN NEW.is_mutual = 1
+BEGIN
+    INSERT INTO stat_counters (name, value) VALUES ('mutual_likes', 1)
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    INSERT INTO activity_buckets (kind, bucket, value)
+        SELECT 'mutual_likes', strftime('%Y-%m-%d %H:00:00', NEW.liked_date), 1
+        WHERE strftime('%Y-%m-%d %H:00:00', NEW.liked_date) IS NOT NULL
+        ON CONFLICT (kind, bucket) DO UPDATE SET value = value + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_likes_stats_delete AFTER DELETE ON likes
+WHEN OLD.is_mutual = 1
+BEGIN
+    UPDATE stat_counters SET value = value - 1 WHERE name = 'mutual_likes';
+    UPDATE activity_buckets SET value = value - 1
+        WHERE kind = 'mutual_likes' AND bucket = strftime('%Y-%m-%d %H:00:00', OLD.liked_date);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trg_likes_stats_update AFTER UPDATE OF is_mutual, liked_date ON likes
+WHEN OLD.is_mutual = 1 OR NEW.is_mutual = 1
+BEGIN
+    UPDATE stat_counters SET value = value - 1 WHERE name = 'mutual_likes' AND OLD.is_mutual = 1;
+    UPDATE activity_buckets SET value = value - 1
+        WHERE kind = 'mutual_likes' AND bucket = strftime('%Y-%m-%d %H:00:00', OLD.liked_date)
+        AND OLD.is_mutual = 1;
+    INSERT INTO stat_counters (name, value)
+        SELECT 'mutual_likes', 1 WHERE NEW.is_mutual = 1
+        ON CONFLICT (name) DO UPDATE SET value = value + 1;
+    INSERT INTO activity_buckets (kind, bucket, value)
+        SELECT 'mutual_likes', strftime('%Y-%m-%d %H:00:00', NEW.liked_date), 1
+        WHERE NEW.is_mutual = 1 AND strftime('%Y-%m-%d %H:00:00', NEW.liked_date) IS NOT NULL
+        ON CONFLICT (kind, bucket) DO UPDATE SET value = value + 1;
+END;
+
+-- Начальное заполнение из базовых таблиц
+DELETE FROM stat_counters;
+DELETE FROM activity_buckets;
+
+INSERT INTO stat_counters (name, value)
+    SELECT 'users_' || user_type, COUNT(*) FROM users GROUP BY user_type;
+INSERT INTO stat_counters (name, value)
+    SELECT 'mutual_likes', COUNT(*) FROM likes WHERE is_mutual = 1;
+
+INSERT INTO activity_buckets (kind, bucket, value)
+    SELECT 'active_' || user_type, strftime('%Y-%m-%d %H:00:00', last_active), COUNT(*)
+    FROM users WHERE strftime('%Y-%m-%d %H:00:00', last_active) IS NOT NULL
+    GROUP BY 1, 2;
+INSERT INTO activity_buckets (kind, bucket, value)
+    SELECT 'mutual_likes', strftime('%Y-%m-%d %H:00:00', liked_date), COUNT(*)
+    FROM likes WHERE is_mutual = 1 AND strftime('%Y-%m-%d %H:00:00', liked_date) IS NOT NULL
+    GROUP BY 1, 2;
@@ -0,0 +1,6 @@
+-- Migration 007: Индекс для постраничного списка пользователей в админке
+-- Сортировка по дате регистрации без фильтра по типу: keyset по (registration_date, user_id)
+-- идет по индексу (user_id — rowid, он входит в индекс неявно)
+
+CREATE INDEX IF NOT EXISTS idx_users_registration
+    ON users (registration_date);
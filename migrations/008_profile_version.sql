@@ -0,0 +1,6 @@
+-- Migration 008: Версия профиля психолога
+-- profile_version увеличивается при каждом save_psychologist_profile и входит в ключ кэша
+-- подписей карточек (render_cache.py): измененный профиль получает новую подпись без
+-- явного сброса кэша, в том числе если профиль сохранен другим процессом.
+
+ALTER TABLE psychologist_profiles ADD COLUMN profile_version INTEGER DEFAULT 1;
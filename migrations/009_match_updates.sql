@@ -0,0 +1,8 @@
+-- Migration 009: Очередь пересчета совместимости между процессами
+-- Админка (блокировка/разблокировка) ставит пользователя в очередь, MatchMaintenanceWorker бота
+-- забирает ее и пересчитывает строки matches, ANN-индекс и кэш векторов в своем процессе.
+
+CREATE TABLE IF NOT EXISTS match_updates (
+    user_id INTEGER PRIMARY KEY,
+    queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
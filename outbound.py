@@ -0,0 +1,379 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, Iterable, Optional, Tuple
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Полосы приоритета: ответы на действия пользователя уходят раньше уведомлений другим людям
+INTERACTIVE = 0
+NOTIFICATION = 1
+LANE_NAMES = ('interactive', 'notification')
+# Методы, которые после TimedOut не повторяются: запрос мог дойти до Telegram,
+# и повтор отправил бы пользователю дубль. Правки сообщений повторять безопасно
+NO_RETRY_ON_TIMEOUT = ('send_message', 'send_photo', 'send_document', 'send_media_group',
+                       'forward_message', 'copy_message')
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity (допустимый всплеск)"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена (0 — можно отправлять сейчас)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+@dataclass
+class OutboundMessage:
+    chat_id: int
+    method: str
+    kwargs: Dict[str, Any]
+    lane: int
+    future: asyncio.Future
+    enqueued: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих сообщений Telegram. Обработчики ставят отправку в очередь
+    (send_message) и сразу возвращаются, а фоновая задача доставляет сообщения
+    с соблюдением лимитов Telegram:
+      - общий лимит бота (global_rate сообщений в секунду, всплеск global_burst);
+      - лимит на чат (chat_rate в секунду, всплеск chat_burst);
+      - RetryAfter (flood control) приостанавливает все отправки на указанное время,
+        сообщение повторяется; сетевые ошибки повторяются с экспоненциальной задержкой
+        для этого чата, кроме TimedOut для методов из no_retry_on_timeout (отправка
+        новых сообщений: повтор мог бы прислать дубль); BadRequest и прочие ошибки
+        не повторяются;
+      - Forbidden (пользователь заблокировал бота) не повторяется и считается
+        отдельно от ошибок в self.blocked.
+    Полосы приоритета: INTERACTIVE выбирается раньше NOTIFICATION. Сообщения одного
+    чата уходят по порядку и по одному (следующее — после ответа на предыдущее).
+    Задержка от постановки до доставки пишется в метрики как outbound.<полоса>.
+
+    Очередь ограничена max_queue: при переполнении новые уведомления отбрасываются,
+    интерактивные ответы принимаются всегда. send_message возвращает Future с
+    результатом вызова бота (None, если сообщение отброшено или не доставлено).
+    """
+
+    def __init__(self, bot=None, global_rate: float = 30.0, global_burst: float = 30.0,
+                 chat_rate: float = 1.0, chat_burst: float = 3.0, max_in_flight: int = 8,
+                 max_retries: int = 5, backoff_base: float = 1.0, backoff_max: float = 60.0,
+                 max_queue: int = 10000, no_retry_on_timeout: Iterable[str] = NO_RETRY_ON_TIMEOUT,
+                 metrics_registry: metrics.MetricsRegistry = metrics.registry):
+        self.bot = bot
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_queue = max_queue
+        self.no_retry_on_timeout = frozenset(no_retry_on_timeout)
+        self.metrics_registry = metrics_registry
+
+        self._global = TokenBucket(global_rate, global_burst, time.monotonic())
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        # По полосе: чат -> его сообщения по порядку; порядок чатов — очередь обхода
+        self._lanes: Tuple['OrderedDict[int, Deque[OutboundMessage]]', ...] = (OrderedDict(), OrderedDict())
+        self._pending = 0
+        self._busy = set()
+        self._retry_at: Dict[int, float] = {}
+        self._paused_until = 0.0
+        self._tasks = set()
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.blocked = 0
+        self.dropped = 0
+
+    # --- Постановка в очередь ---
+
+    def send_message(self, chat_id: int, text: str, lane: int = INTERACTIVE, **kwargs) -> asyncio.Future:
+        """Поставить Bot.send_message в очередь без ожидания отправки"""
+        return self.enqueue(chat_id, 'send_message', lane, text=text, **kwargs)
+
+    def enqueue(self, chat_id: int, method: str, lane: int = INTERACTIVE, **kwargs) -> asyncio.Future:
+        """Поставить в очередь вызов метода бота method(chat_id=chat_id, **kwargs)"""
+        future = asyncio.get_running_loop().create_future()
+        if lane != INTERACTIVE and self._pending >= self.max_queue:
+            self.dropped += 1
+            logger.warning(f"Outbound queue full, dropped {method} to {chat_id}")
+            future.set_result(None)
+            return future
+
+        message = OutboundMessage(chat_id, method, kwargs, lane, future)
+        self._lanes[lane].setdefault(chat_id, deque()).append(message)
+        self._pending += 1
+        self._notify()
+        return future
+
+    def _requeue(self, message: OutboundMessage):
+        """Вернуть сообщение в начало очереди его чата (повтор идет раньше следующих)"""
+        lane = self._lanes[message.lane]
+        lane.setdefault(message.chat_id, deque()).appendleft(message)
+        lane.move_to_end(message.chat_id, last=False)
+        self._pending += 1
+
+    def _notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # --- Доставка ---
+
+    def start(self, bot=None):
+        if bot is not None:
+            self.bot = bot
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name=type(self).__name__)
+
+    async def stop(self, timeout: Optional[float] = 10.0):
+        """Доставить оставшиеся сообщения (не дольше timeout секунд) и остановить задачу"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._notify()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Outbound queue stopped with {self._pending} undelivered messages")
+            self._task.cancel()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(self._task, *self._tasks, return_exceptions=True)
+            for lane in self._lanes:
+                for messages in lane.values():
+                    for message in messages:
+                        message.future.set_result(None)
+                lane.clear()
+            self.dropped += self._pending
+            self._pending = 0
+            self._busy.clear()
+        self._task = None
+        self._wakeup = None
+
+    async def _run(self):
+        while True:
+            message, wait = self._next_ready(time.monotonic())
+            if message is not None:
+                task = asyncio.create_task(self._deliver(message))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                continue
+            if self._stopping and not self._pending and not self._busy:
+                return
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _next_ready(self, now: float) -> Tuple[Optional[OutboundMessage], Optional[float]]:
+        """
+        Следующее сообщение, которое можно отправить сейчас, или (None, сколько ждать);
+        None вместо времени ожидания — ждать события (новое сообщение, конец отправки).
+        """
+        if not self._pending:
+            return None, None
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        delay = self._global.delay(now)
+        if delay > 0:
+            return None, delay
+        if len(self._busy) >= self.max_in_flight:
+            return None, None
+
+        wait = None
+        for lane in self._lanes:
+            for chat_id, messages in lane.items():
+                if chat_id in self._busy:
+                    continue
+                delay = max(self._retry_at.get(chat_id, 0.0) - now, self._chat_bucket(chat_id, now).delay(now))
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+                message = messages.popleft()
+                if not messages:
+                    del lane[chat_id]
+                self._pending -= 1
+                self._retry_at.pop(chat_id, None)
+                self._global.consume(now)
+                self._chat_buckets[chat_id].consume(now)
+                self._busy.add(chat_id)
+                return message, 0.0
+        return None, wait
+
+    def _chat_bucket(self, chat_id: int, now: float) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= 10000:
+                self._prune_buckets(now)
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst, now)
+        return bucket
+
+    def _prune_buckets(self, now: float):
+        """Забыть полные корзины чатов без сообщений в работе: новая корзина будет такой же"""
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._busy and bucket.is_full(now):
+                del self._chat_buckets[chat_id]
+
+    async def _deliver(self, message: OutboundMessage):
+        message.attempts += 1
+        try:
+            result = await getattr(self.bot, message.method)(chat_id=message.chat_id, **message.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            # Flood control действует на бота целиком: приостанавливаем все отправки
+            self._paused_until = max(self._paused_until, time.monotonic() + float(retry_after))
+            logger.warning(f"Telegram flood control: retry {message.method} to {message.chat_id} "
+                           f"in {retry_after} s")
+            self._retry_or_fail(message, e)
+        except Forbidden as e:
+            self.blocked += 1
+            self._retry_at.pop(message.chat_id, None)
+            logger.info(f"Cannot deliver {message.method} to {message.chat_id}: {e}")
+            self._observe(message, error=True)
+            message.future.set_result(None)
+        except BadRequest as e:
+            self._fail(message, e)
+        except TimedOut as e:
+            if message.method in self.no_retry_on_timeout:
+                self._fail(message, e)
+            else:
+                self._retry_network_error(message, e)
+        except NetworkError as e:
+            self._retry_network_error(message, e)
+        except Exception as e:
+            self._fail(message, e)
+        except asyncio.CancelledError:
+            # Остановка по таймауту посреди отправки
+            self.dropped += 1
+            message.future.set_result(None)
+            raise
+        else:
+            self.sent += 1
+            self._observe(message)
+            message.future.set_result(result)
+        finally:
+            self._busy.discard(message.chat_id)
+            self._notify()
+
+    def _retry_network_error(self, message: OutboundMessage, error: Exception):
+        backoff = min(self.backoff_max, self.backoff_base * 2 ** (message.attempts - 1))
+        self._retry_at[message.chat_id] = time.monotonic() + backoff
+        self._retry_or_fail(message, error)
+
+    def _retry_or_fail(self, message: OutboundMessage, error: Exception):
+        if message.attempts > self.max_retries:
+            self._fail(message, error)
+            return
+        self.retried += 1
+        self._requeue(message)
+
+    def _fail(self, message: OutboundMessage, error: Exception):
+        self.failed += 1
+        self._retry_at.pop(message.chat_id, None)
+        logger.error(f"Failed to deliver {message.method} to {message.chat_id} "
+                     f"after {message.attempts} attempts: {error}")
+        self._observe(message, error=True)
+        message.future.set_result(None)
+
+    def _observe(self, message: OutboundMessage, error: bool = False):
+        self.metrics_registry.observe(f'outbound.{LANE_NAMES[message.lane]}',
+                                      time.monotonic() - message.enqueued, error)
+
+    def counters(self) -> Dict[str, int]:
+        return {
+            'pending': self._pending,
+            'in_flight': len(self._busy),
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'blocked': self.blocked,
+            'dropped': self.dropped,
+        }
+
+
+class RenderCoalescer:
+    """
+    Схлопывание частых перерисовок одного экрана (например, быстрых нажатий «вперед»
+    по карточкам одного пользователя). submit(key, func, *args) запускает func(*args)
+    в фоне; если для key отрисовка уже идет, запоминается только последний вызов,
+    и он выполняется один раз после текущей. Промежуточные вызовы не выполняются
+    (считаются в self.coalesced).
+    """
+
+    def __init__(self):
+        self._running: Dict[Any, asyncio.Task] = {}
+        self._latest: Dict[Any, Tuple[Callable, tuple]] = {}
+        self.rendered = 0
+        self.coalesced = 0
+
+    def submit(self, key: Any, func: Callable, *args) -> asyncio.Task:
+        task = self._running.get(key)
+        if task is not None and not task.done():
+            if key in self._latest:
+                self.coalesced += 1
+            self._latest[key] = (func, args)
+            return task
+        task = self._running[key] = asyncio.create_task(self._run(key, func, args))
+        return task
+
+    async def _run(self, key: Any, func: Callable, args: tuple):
+        try:
+            while True:
+                try:
+                    await func(*args)
+                except Exception:
+                    logger.exception(f"Render for {key} failed")
+                self.rendered += 1
+                pending = self._latest.pop(key, None)
+                if pending is None:
+                    return
+                func, args = pending
+        finally:
+            self._running.pop(key, None)
+
+    async def drain(self):
+        """Дождаться всех начатых и отложенных перерисовок"""
+        while self._running:
+            await asyncio.gather(*list(self._running.values()), return_exceptions=True)
+
+    def counters(self) -> Dict[str, int]:
+        return {'running': len(self._running), 'rendered': self.rendered, 'coalesced': self.coalesced}
@@ -0,0 +1,132 @@
+import functools
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Бюджет текущего апдейта; в потоки БД доходит через contextvars.copy_context (AsyncDatabase._run)
+_current: ContextVar[Optional['QueryBudget']] = ContextVar('query_budget', default=None)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Обработчик сделал больше запросов к БД или использовал больше соединений, чем разрешено"""
+
+
+class QueryBudget:
+    """
+    Счетчик обращений к БД за время обработки одного апдейта Telegram:
+    число выполненных SQL-операторов (round trip до SQLite), число разных
+    соединений (потоков БД), через которые они прошли, и число открытых заново.
+    Ограничиваются запросы и открытия: постоянные соединения потоков БД
+    открываются один раз, поэтому в установившемся режиме апдейт их не открывает.
+    """
+
+    def __init__(self, name: str, max_queries: Optional[int] = None, max_opened: Optional[int] = None):
+        self.name = name
+        self.max_queries = max_queries
+        self.max_opened = max_opened
+        self.queries = 0
+        self.opened = 0
+        self.statements: List[str] = []
+        self._connections = set()
+        # Читатели из пула AsyncDatabase могут выполнять запросы одного апдейта параллельно
+        self._lock = threading.Lock()
+
+    def record_query(self, connection, sql: str):
+        with self._lock:
+            self.queries += 1
+            self._connections.add(id(connection))
+            self.statements.append(sql)
+
+    def record_connect(self):
+        with self._lock:
+            self.opened += 1
+
+    @property
+    def connections(self) -> int:
+        return len(self._connections)
+
+    def violations(self) -> List[str]:
+        """Описания превышений бюджета; пустой список — бюджет соблюден"""
+        problems = []
+        if self.max_queries is not None and self.queries > self.max_queries:
+            problems.append(f"{self.queries} queries > {self.max_queries}")
+        if self.max_opened is not None and self.opened > self.max_opened:
+            problems.append(f"{self.opened} opened connections > {self.max_opened}")
+        return problems
+
+    def report(self) -> str:
+        """Сводка для сообщения об ошибке: счетчики и отпечатки запросов по числу повторов"""
+        # sql_tracer сам импортирует этот модуль (счетчик запросов в TracingCursor)
+        from sql_tracer import fingerprint
+        counts: Dict[str, int] = {}
+        for sql in self.statements:
+            key = fingerprint(sql)
+            counts[key] = counts.get(key, 0) + 1
+        lines = [f"{self.name}: {self.queries} queries, {self.connections} connections, {self.opened} opened"]
+        lines.extend(f"  {count} × {key}" for key, count in sorted(counts.items(), key=lambda item: -item[1]))
+        return '\n'.join(lines)
+
+    def check(self):
+        problems = self.violations()
+        if problems:
+            raise QueryBudgetExceeded(f"Query budget exceeded ({', '.join(problems)})\n{self.report()}")
+
+
+def current() -> Optional[QueryBudget]:
+    return _current.get()
+
+
+@contextmanager
+def track(name: str, max_queries: Optional[int] = None,
+          max_opened: Optional[int] = None) -> Iterator[QueryBudget]:
+    """Считать обращения к БД внутри блока (и в потоках БД, запущенных из него)"""
+    budget = QueryBudget(name, max_queries, max_opened)
+    token = _current.set(budget)
+    try:
+        yield budget
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def untracked() -> Iterator[None]:
+    """Не учитывать запросы внутри блока (служебные, например настройка нового соединения)"""
+    token = _current.set(None)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def record_query(connection, sql: str):
+    budget = _current.get()
+    if budget is not None:
+        budget.record_query(connection, sql)
+
+
+def record_connect():
+    budget = _current.get()
+    if budget is not None:
+        budget.record_connect()
+
+
+def instrument(func: Callable, name: str, max_queries: Optional[int] = None) -> Callable:
+    """
+    Обернуть обработчик бота подсчетом запросов на апдейт.
+    Бюджет открывает только внешний обработчик: вызовы одного обработчика из другого
+    считаются в бюджет внешнего. Превышение пишется в лог с отпечатками запросов.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if _current.get() is not None:
+            return await func(*args, **kwargs)
+        with track(name, max_queries) as budget:
+            result = await func(*args, **kwargs)
+        if budget.violations():
+            logger.warning(f"Query budget exceeded: {budget.report()}")
+        return result
+    return wrapper
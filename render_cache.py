@@ -0,0 +1,166 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Вариант подписи карточки -> ключ шаблона в messages.json и поля, которые меняются от показа к показу
+CARD_VARIANTS = {
+    'match': ('card_psychologist_template', ('match',)),
+    'no_match': ('card_psychologist_template_no_match', ()),
+}
+# Поля профиля в шаблонах карточки
+PROFILE_FIELDS = ('name', 'gender', 'age', 'education', 'about_me', 'approach', 'work_requests',
+                  'price', 'experience')
+
+
+def _escape(value) -> str:
+    """Значение поля профиля внутри скомпилированного шаблона: фигурные скобки не должны стать полями"""
+    return str(value).replace('{', '{{').replace('}', '}}')
+
+
+class RenderCache:
+    """
+    Кэш отрисовки бота: подписи карточек психологов и готовые клавиатуры.
+
+    Подпись карточки компилируется один раз на (psychologist_id, profile_version, вариант):
+    поля профиля подставляются в шаблон messages.json заранее, а поля показа (процент
+    совместимости) остаются полями формата. profile_version растет при каждом
+    save_psychologist_profile, поэтому измененный профиль (в том числе сохраненный другим
+    процессом) получает новый ключ; invalidate() сразу освобождает старые записи.
+
+    Клавиатуры (InlineKeyboardMarkup неизменяемы, их можно отдавать всем пользователям):
+    вопросы теста — собираются целиком при загрузке, карточки — по состоянию навигации
+    (вперед/назад, лайк или «уже лайкнут»). reload() после перезагрузки messages.json
+    сбрасывает подписи и пересобирает клавиатуры.
+    """
+
+    def __init__(self, messages: Dict, questions: List[Dict], max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._captions: 'OrderedDict[Tuple, Tuple[str, bool]]' = OrderedDict()
+        self._keyboards: 'OrderedDict[Tuple, InlineKeyboardMarkup]' = OrderedDict()
+        # Карточки рисуются из обработчиков, перезагрузка может прийти из другой задачи
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.reload(messages, questions)
+
+    def reload(self, messages: Dict, questions: Optional[List[Dict]] = None):
+        """
+        Новые тексты (и вопросы теста): сбросить подписи, пересобрать клавиатуры.
+        Все шаблоны проверяются до замены: при ошибке (нет ключа, неизвестное поле)
+        ValueError, а кэш остается со старыми текстами
+        """
+        questions = self._questions if questions is None else questions
+        try:
+            return self._reload(messages, questions)
+        except (KeyError, IndexError) as e:
+            raise ValueError(f"Invalid messages template: {e!r}") from e
+    
+    def _reload(self, messages: Dict, questions: List[Dict]):
+        for template_name, dynamic_fields in CARD_VARIANTS.values():
+            messages[template_name].format(**dict.fromkeys(PROFILE_FIELDS + dynamic_fields, ''))
+        
+        question_screens = []
+        for index, question in enumerate(questions):
+            text = messages['test_question_template'].format(
+                current=index + 1, total=len(questions), question=question['question']
+            )
+            keyboard = InlineKeyboardMarkup([
+                [InlineKeyboardButton(option, callback_data=f'test_answer_{index}_{i}')]
+                for i, option in enumerate(question['options'])
+            ])
+            question_screens.append((text, keyboard))
+
+        navigation = {}
+        for has_prev in (False, True):
+            for has_next in (False, True):
+                row = []
+                if has_prev:
+                    row.append(InlineKeyboardButton(messages['button_prev'], callback_data='card_prev'))
+                if has_next:
+                    row.append(InlineKeyboardButton(messages['button_next'], callback_data='card_next'))
+                navigation[has_prev, has_next] = tuple(row)
+
+        with self._lock:
+            self._messages = messages
+            self._questions = questions
+            self._question_screens = question_screens
+            self._navigation = navigation
+            self._already_liked = (InlineKeyboardButton('✅ Уже лайкнут', callback_data='already_liked'),)
+            self._captions.clear()
+            self._keyboards.clear()
+
+    def invalidate(self, psychologist_id: int):
+        """Забыть подписи и клавиатуры психолога (профиль изменился)"""
+        with self._lock:
+            for cache in (self._captions, self._keyboards):
+                for key in [key for key in cache if key[0] == psychologist_id]:
+                    del cache[key]
+
+    def caption(self, psychologist: Dict, variant: str, **fields) -> str:
+        """Подпись карточки; fields — поля показа варианта (для 'match' — match)"""
+        key = (psychologist['user_id'], psychologist.get('profile_version'), variant)
+        with self._lock:
+            entry = self._captions.get(key)
+            if entry is not None:
+                self._captions.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            entry = self._compile(psychologist, variant)
+            with self._lock:
+                self.misses += 1
+                self._captions[key] = entry
+                if len(self._captions) > self.max_entries:
+                    self._captions.popitem(last=False)
+        text, dynamic = entry
+        return text.format(**fields) if dynamic else text
+
+    def _compile(self, psychologist: Dict, variant: str) -> Tuple[str, bool]:
+        template_name, dynamic_fields = CARD_VARIANTS[variant]
+        profile = {
+            'name': psychologist['name'],
+            'gender': psychologist.get('gender', 'Не указано'),
+            'age': psychologist.get('age', 'Не указано'),
+            'education': psychologist['education'],
+            'about_me': psychologist.get('about_me', 'Не указано'),
+            'approach': psychologist.get('approach', 'Не указано'),
+            'work_requests': psychologist.get('work_requests', 'Не указано'),
+            'price': psychologist.get('price', 'Не указано'),
+            'experience': psychologist['experience'],
+        }
+        if not dynamic_fields:
+            return self._messages[template_name].format(**profile), False
+        # Поля показа остаются полями формата, значения профиля экранируются
+        profile = {name: _escape(value) for name, value in profile.items()}
+        profile.update({name: '{' + name + '}' for name in dynamic_fields})
+        return self._messages[template_name].format(**profile), True
+
+    def card_keyboard(self, psychologist_id: int, already_liked: bool,
+                      has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+        """Клавиатура карточки психолога для состояния навигации"""
+        key = (psychologist_id, bool(already_liked), has_prev, has_next)
+        with self._lock:
+            keyboard = self._keyboards.get(key)
+            if keyboard is not None:
+                self._keyboards.move_to_end(key)
+                return keyboard
+            rows = [self._navigation[has_prev, has_next]] if has_prev or has_next else []
+            if already_liked:
+                rows.append(self._already_liked)
+            else:
+                rows.append((InlineKeyboardButton(self._messages['button_like'],
+                                                  callback_data=f'like_{psychologist_id}'),))
+            keyboard = self._keyboards[key] = InlineKeyboardMarkup(rows)
+            if len(self._keyboards) > self.max_entries:
+                self._keyboards.popitem(last=False)
+            return keyboard
+
+    def question(self, index: int) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+        """Текст и клавиатура вопроса теста; None — вопросы кончились"""
+        screens = self._question_screens
+        return screens[index] if 0 <= index < len(screens) else None
+
+    def counters(self) -> Dict[str, int]:
+        return {'captions': len(self._captions), 'keyboards': len(self._keyboards),
+                'hits': self.hits, 'misses': self.misses}
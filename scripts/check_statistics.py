@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Проверка материализованных счетчиков статистики.
+
+Сравнивает Database.get_statistics (счетчики и почасовые корзины) с пересчетом
+по базовым таблицам. С флагом --repair пересобирает счетчики при расхождении,
+с --rebuild — пересобирает безусловно. Код выхода 1, если найдено расхождение
+и оно не исправлено.
+"""
+
+import os
+import sys
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import Database
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_PATH = os.getenv('DATABASE_PATH', 'psymatch.db')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сверка счетчиков статистики с базовыми таблицами')
+    parser.add_argument('--repair', action='store_true', help='пересобрать счетчики при расхождении')
+    parser.add_argument('--rebuild', action='store_true', help='пересобрать счетчики без проверки')
+    args = parser.parse_args()
+    
+    db = Database(DB_PATH)
+    
+    if args.rebuild:
+        print("🔥 Пересборка счетчиков статистики...")
+        db.rebuild_statistics_counters()
+        print("  ✅ Готово")
+        db.close()
+        return 0
+    
+    print("🔍 Сверка счетчиков статистики...")
+    mismatches = db.check_statistics_counters(repair=args.repair)
+    db.close()
+    
+    if not mismatches:
+        print("  ✅ Счетчики совпадают с таблицами")
+        return 0
+    
+    for key, (counter, actual) in mismatches.items():
+        print(f"  ⚠️ {key}: по счетчикам {counter}, по таблицам {actual}")
+    if args.repair:
+        print("  ✅ Счетчики пересобраны")
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Плановое обслуживание таблицы совместимости.
+
+По умолчанию выполняет сверку (пишет только расходящиеся строки).
+С флагом --full полностью пересчитывает таблицу.
+"""
+
+import os
+import sys
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import Database
+from matching import MatchingSystem
+from vector_store import VectorStore
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_PATH = os.getenv('DATABASE_PATH', 'psymatch.db')
+MATCH_RANKING_MODE = os.getenv('MATCH_RANKING_MODE', 'materialized')
+MATCH_TOP_K = int(os.getenv('MATCH_TOP_K', '50'))
+VECTOR_STORE_PATH = os.getenv('VECTOR_STORE_PATH', '')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сверка или полный пересчет таблицы matches')
+    parser.add_argument('--full', action='store_true', help='полный пересчет вместо сверки')
+    args = parser.parse_args()
+    
+    db = Database(DB_PATH)
+    matching_system = MatchingSystem(
+        db, ranking_mode=MATCH_RANKING_MODE, top_k=MATCH_TOP_K,
+        vector_store=VectorStore(VECTOR_STORE_PATH) if VECTOR_STORE_PATH else None
+    )
+    
+    if args.full:
+        print("🔥 Полный пересчет совместимости...")
+        saved = matching_system.recalculate_all_matches()
+        print(f"  ✅ Записано строк: {saved}")
+    else:
+        print("🔍 Сверка совместимости с результатами тестов...")
+        result = matching_system.reconcile()
+        print(f"  ✅ Добавлено: {result['inserted']}, обновлено: {result['updated']}, удалено: {result['deleted']}")
+    
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
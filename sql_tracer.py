@@ -0,0 +1,228 @@
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional
+
+import query_budget
+
+logger = logging.getLogger(__name__)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\b(IN|VALUES)\s*\(\s*\?(?:\s*,\s*\?)+\s*\)', re.IGNORECASE)
+_WHITESPACE = re.compile(r'\s+')
+_PLACEHOLDER = re.compile(r'\?')
+
+# Для этих операторов EXPLAIN QUERY PLAN имеет смысл (PRAGMA, BEGIN и т.п. пропускаются)
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+def fingerprint(sql: str) -> str:
+    """Нормализованный текст запроса: литералы заменены на ?, списки IN/VALUES (?, ?, ...) свернуты"""
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _WHITESPACE.sub(' ', sql).strip()
+    return _IN_LIST.sub(r'\1 (...)', sql)
+
+
+def describe_params(params: Any) -> Optional[str]:
+    """Параметры запроса без значений: число и типы (значения — контакты, ответы теста — в журнал не пишутся)"""
+    if not params:
+        return None
+    if isinstance(params, dict):
+        return f"{len(params)}: " + ', '.join(f'{name}={type(value).__name__}' for name, value in params.items())
+    return f"{len(params)}: " + ', '.join(type(value).__name__ for value in params)
+
+
+class SQLTracer:
+    """
+    Трассировка запросов Database: время каждого execute/executemany (и дочитывания
+    строк через fetchall/fetchmany), агрегаты по отпечатку запроса и журнал медленных
+    запросов — кольцевой буфер в памяти плюс JSON-строки в log_path.
+
+    Для медленных запросов один раз на отпечаток снимается EXPLAIN QUERY PLAN
+    (на том же соединении, запрос при этом не выполняется).
+
+    В журнал попадают только число и типы параметров: в них бывают контакты,
+    имена пользователей и ответы теста. log_params=True пишет сами значения
+    (обрезанные до 200 символов) — только для отладки.
+    """
+
+    def __init__(self, slow_threshold_ms: float = 100.0, ring_size: int = 200,
+                 log_path: Optional[str] = None, explain: bool = True, log_params: bool = False):
+        self.slow_threshold = slow_threshold_ms / 1000
+        self.log_path = log_path
+        self.explain = explain
+        self.log_params = log_params
+        self._slow: Deque[Dict] = deque(maxlen=ring_size)
+        self._stats: Dict[str, Dict] = {}
+        self._plans: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, sql: str, params: Any, seconds: float, connection: sqlite3.Connection,
+               total_seconds: Optional[float] = None, new_call: bool = True, logged: bool = False) -> bool:
+        """
+        Учесть seconds выполнения запроса. total_seconds — полное время вызова, если это
+        дочитывание строк уже учтенного запроса (new_call=False). Возвращает True, если
+        запрос попал в журнал медленных (сейчас или раньше — logged).
+        """
+        total_seconds = seconds if total_seconds is None else total_seconds
+        key = fingerprint(sql)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {'fingerprint': key, 'count': 0, 'total_s': 0.0,
+                                            'max_s': 0.0, 'slow': 0}
+            if new_call:
+                stats['count'] += 1
+            stats['total_s'] += seconds
+            stats['max_s'] = max(stats['max_s'], total_seconds)
+            if logged or total_seconds < self.slow_threshold:
+                return logged
+            stats['slow'] += 1
+            need_plan = self.explain and key not in self._plans
+
+        plan = self._explain(sql, params, connection) if need_plan else None
+        with self._lock:
+            if plan is not None:
+                self._plans[key] = plan
+            entry = {
+                'time': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+                'duration_ms': round(total_seconds * 1000, 3),
+                'fingerprint': key,
+                'sql': _WHITESPACE.sub(' ', sql).strip(),
+                'params': repr(params)[:200] if self.log_params and params else describe_params(params),
+                'plan': self._plans.get(key),
+            }
+            self._slow.append(entry)
+            if self.log_path:
+                try:
+                    with open(self.log_path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                except OSError as e:
+                    logger.error(f"Failed to write slow query log: {e}")
+        logger.warning(f"Slow query ({entry['duration_ms']} ms): {key}")
+        return True
+
+    def _explain(self, sql: str, params: Any, connection: sqlite3.Connection) -> Optional[List[str]]:
+        if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            return None
+        try:
+            # Базовый курсор: EXPLAIN не должен попадать в трассировку сам
+            cursor = sqlite3.Cursor(connection)
+            if params is None:
+                # executemany: параметров одной строки нет, план строится с NULL вместо них
+                sql, params = _PLACEHOLDER.sub('NULL', sql), ()
+            rows = cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+            return [row[3] for row in rows]
+        except sqlite3.Error as e:
+            return [f'EXPLAIN failed: {e}']
+
+    def slow_queries(self) -> List[Dict]:
+        """Последние медленные запросы, новые сначала"""
+        with self._lock:
+            return list(reversed(self._slow))
+
+    def stats(self, limit: Optional[int] = None) -> List[Dict]:
+        """Агрегаты по отпечаткам, самые затратные по суммарному времени сверху"""
+        with self._lock:
+            rows = [dict(stats) for stats in self._stats.values()]
+        rows.sort(key=lambda row: row['total_s'], reverse=True)
+        return rows[:limit] if limit else rows
+
+    def reset(self):
+        with self._lock:
+            self._slow.clear()
+            self._stats.clear()
+            self._plans.clear()
+
+
+class TracingCursor(sqlite3.Cursor):
+    """Курсор, который отдает время каждого запроса трассировщику соединения и учитывает его в бюджете апдейта"""
+
+    _trace = None
+
+    def execute(self, sql, parameters=()):
+        query_budget.record_query(self.connection, sql)
+        tracer = self.connection.tracer
+        if tracer is None:
+            return super().execute(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = time.perf_counter() - started
+            logged = tracer.record(sql, parameters, elapsed, self.connection)
+            self._trace = (sql, parameters, elapsed, logged)
+
+    def executemany(self, sql, seq_of_parameters):
+        query_budget.record_query(self.connection, sql)
+        tracer = self.connection.tracer
+        if tracer is None:
+            return super().executemany(sql, seq_of_parameters)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            tracer.record(sql, None, time.perf_counter() - started, self.connection)
+            self._trace = None
+
+    def _fetched(self, started: float):
+        """Добавить время дочитывания строк к последнему запросу (коррелированные подзапросы считаются тут)"""
+        if self._trace is None:
+            return
+        sql, parameters, elapsed, logged = self._trace
+        fetch = time.perf_counter() - started
+        logged = self.connection.tracer.record(sql, parameters, fetch, self.connection,
+                                               total_seconds=elapsed + fetch, new_call=False, logged=logged)
+        self._trace = (sql, parameters, elapsed + fetch, logged)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._fetched(started)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._fetched(started)
+
+
+class TracingConnection(sqlite3.Connection):
+    """Соединение, чьи курсоры (включая Connection.execute) проходят через TracingCursor"""
+
+    tracer: Optional[SQLTracer] = None
+
+    def cursor(self, factory=TracingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def read_slow_log(path: str, limit: int = 50) -> List[Dict]:
+    """Последние limit записей файла медленных запросов (общего для бота и админки), новые сначала"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            lines = deque(f, maxlen=limit)
+    except OSError:
+        return []
+    entries = []
+    for line in reversed(lines):
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+    return entries
@@ -34,8 +34,12 @@ def test_matching():
     class FakeDB:
         def get_test_result(self, user_id):
             return None
-        def save_match(self, p1, p2, pct):
-            pass
+        def get_test_vector(self, user_id):
+            return None
+        def get_test_vectors(self, user_type):
+            return []
+        def save_matches(self, matches):
+            return 0
         def get_all_psychologists(self):
             return []
         def get_all_patients(self):
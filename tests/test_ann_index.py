@@ -0,0 +1,115 @@
+"""
+Тесты для ann_index.py
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from ann_index import IVFIndex, recall_at_k
+from database import Database
+from matching import MatchingSystem
+
+
+@pytest.fixture
+def db():
+    """Создает временную БД для тестов"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as f:
+        db_path = f.name
+    
+    database = Database(db_path)
+    yield database
+    database.close()
+    
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def random_vectors(count, dim=8, seed=0):
+    return np.random.default_rng(seed).uniform(-1, 1, (count, dim)).astype(np.float32)
+
+
+def exact_top(ids, vectors, query, k):
+    cosine = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+    return ids[np.argsort(-cosine, kind='stable')[:k]].tolist()
+
+
+def test_search_all_lists_is_exact():
+    """Тест: при просмотре всех кластеров поиск совпадает с точным"""
+    ids = np.arange(100, 400)
+    vectors = random_vectors(300)
+    index = IVFIndex(n_lists=10)
+    index.build(ids, vectors)
+    
+    query = random_vectors(1, seed=1)[0]
+    found, cosine = index.search(query, 10, n_probe=10)
+    
+    assert set(found.tolist()) == set(exact_top(ids, vectors, query, 10))
+    assert list(cosine) == sorted(cosine, reverse=True)
+
+
+def test_incremental_add_remove():
+    """Тест инкрементального добавления, замены и удаления"""
+    index = IVFIndex(n_lists=4)
+    index.build(np.arange(50), random_vectors(50))
+    query = np.ones(8, dtype=np.float32)
+    
+    assert index.add(1000, query * 2)
+    found, cosine = index.search(query, 1, n_probe=4)
+    assert found.tolist() == [1000]
+    assert cosine[0] == pytest.approx(1.0)
+    
+    # Замена вектора не дублирует пользователя
+    assert index.add(1000, -query)
+    assert len(index) == 51
+    assert 1000 not in index.search(query, 5, n_probe=4)[0].tolist()
+    
+    # Векторы другой размерности в индекс не попадают
+    assert not index.add(2000, [1.0, 0.0])
+    
+    for user_id in range(50):
+        assert index.remove(user_id)
+    assert not index.remove(0)
+    assert index.search(-query, 5, n_probe=4)[0].tolist() == [1000]
+
+
+def test_recall_and_candidate_generator(db):
+    """Тест recall@K против точного ранжирования и использования индекса в MatchingSystem"""
+    vectors = random_vectors(200, seed=3)
+    for user_id, vector in enumerate(vectors, start=1):
+        user_type = 'patient' if user_id <= 20 else 'psychologist'
+        db.create_user(user_id, f'user{user_id}', user_type)
+        db.save_test_result(user_id, vector)
+    
+    index = IVFIndex(n_lists=8, n_probe=8)
+    matching_system = MatchingSystem(db, ranking_mode='topk', top_k=5, ann_index=index)
+    matching_system.build_ann_index()
+    
+    assert recall_at_k(matching_system, index, range(1, 21), k=5) == 1.0
+    assert 0.0 < recall_at_k(matching_system, index, range(1, 21), k=5, n_probe=2) <= 1.0
+    
+    exact_ids, exact_scores = MatchingSystem(db, top_k=5).top_k_for_patient(1)
+    ann_ids, ann_scores = matching_system.top_k_for_patient(1)
+    assert ann_ids.tolist() == exact_ids.tolist()
+    assert np.allclose(ann_scores, exact_scores, atol=0.1)
+    
+    # Блокировка психолога убирает его из индекса
+    best = int(ann_ids[0])
+    db.block_user(best)
+    matching_system.update_user(best)
+    assert best not in index
+    assert best not in matching_system.top_k_for_patient(1)[0].tolist()
+    
+    # Блокировка из админки (другой процесс) доходит до индекса бота через очередь match_updates
+    second = int(matching_system.top_k_for_patient(1)[0][0])
+    db.block_user(second)
+    db.queue_match_update(second)
+    matching_system.update_dirty()
+    assert second not in index
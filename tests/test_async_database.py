@@ -0,0 +1,76 @@
+"""
+Тесты для async_database.py
+"""
+
+import os
+import sys
+import asyncio
+import threading
+import tempfile
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import Database
+from async_database import AsyncDatabase
+
+
+@pytest.fixture
+def db():
+    """Создает временную БД для тестов"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as f:
+        db_path = f.name
+    
+    database = Database(db_path)
+    yield database
+    database.close()
+    
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+@pytest.fixture
+def adb(db):
+    """Создает асинхронный фасад"""
+    facade = AsyncDatabase(db, reader_threads=2)
+    yield facade
+    facade.close()
+
+
+def test_awaitable_methods(adb):
+    """Тест что методы Database доступны как корутины"""
+    async def scenario():
+        await adb.create_user(1, 'patient1', 'patient')
+        await adb.save_patient_profile(1, 'Тревога', '@patient1')
+        user = await adb.get_user(1)
+        profile = await adb.get_patient_info(1)
+        return user, profile
+    
+    user, profile = asyncio.run(scenario())
+    assert user['username'] == 'patient1'
+    assert profile['main_request'] == 'Тревога'
+
+
+def test_reads_and_writes_run_off_loop(adb):
+    """Тест что записи идут в поток-писатель, а чтения — в пул читателей"""
+    def thread_name():
+        return threading.current_thread().name
+    
+    async def scenario():
+        return await adb.run_write(thread_name), await adb.run_read(thread_name)
+    
+    writer, reader = asyncio.run(scenario())
+    assert writer.startswith('db-writer')
+    assert reader.startswith('db-reader')
+    assert AsyncDatabase.is_read_method('get_user')
+    assert not AsyncDatabase.is_read_method('create_like')
+
+
+def test_private_methods_not_exposed(adb):
+    """Тест что служебные методы не проксируются"""
+    with pytest.raises(AttributeError):
+        adb.get_connection
+    with pytest.raises(AttributeError):
+        adb._connect
@@ -0,0 +1,228 @@
+"""
+Тесты для background.py
+"""
+
+import os
+import sys
+import asyncio
+import tempfile
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import Database
+from async_database import AsyncDatabase
+from background import ActionLogBuffer, LastActiveTracker, MatchMaintenanceWorker, StatisticsMaintenance
+from matching import MatchingSystem
+
+
+@pytest.fixture
+def db():
+    """Создает временную БД для тестов"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as f:
+        db_path = f.name
+    
+    database = Database(db_path)
+    yield database
+    database.close()
+    
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+@pytest.fixture
+def adb(db):
+    """Создает асинхронный фасад"""
+    facade = AsyncDatabase(db)
+    yield facade
+    facade.close()
+
+
+def count_actions(db):
+    return db.get_connection().execute('SELECT COUNT(*) FROM user_actions').fetchone()[0]
+
+
+def test_action_log_flushes_on_batch_size(db, adb):
+    """Тест сброса буфера при достижении размера пачки"""
+    async def scenario():
+        buffer = ActionLogBuffer(adb, batch_size=5, flush_interval=60)
+        buffer.start()
+        for i in range(5):
+            await buffer.put(1, 'card_viewed', f'Index:{i}')
+        for _ in range(50):
+            if not buffer.counters()['pending']:
+                break
+            await asyncio.sleep(0.01)
+        written = count_actions(db)
+        await buffer.stop()
+        return written
+    
+    assert asyncio.run(scenario()) == 5
+
+
+def test_action_log_flushes_on_stop(db, adb):
+    """Тест финального сброса при остановке"""
+    async def scenario():
+        buffer = ActionLogBuffer(adb, batch_size=100, flush_interval=60)
+        buffer.start()
+        await buffer.put(1, 'command_start')
+        await buffer.put(1, 'test_answer', 'Q0:A1')
+        await buffer.stop()
+        return buffer.counters()
+    
+    counters = asyncio.run(scenario())
+    assert counters['written'] == 2
+    assert counters['pending'] == 0
+    assert count_actions(db) == 2
+
+
+def test_action_log_overflow_policies(adb):
+    """Тест политик переполнения очереди"""
+    oldest = ActionLogBuffer(adb, max_queue=2, overflow='drop_oldest')
+    for i in range(3):
+        assert oldest.add(1, 'event', str(i)) is True
+    assert oldest.dropped == 1
+    assert [item[2] for item in oldest._queue] == ['1', '2']
+    
+    newest = ActionLogBuffer(adb, max_queue=2, overflow='drop_newest')
+    assert newest.add(1, 'event', '0') is True
+    assert newest.add(1, 'event', '1') is True
+    assert newest.add(1, 'event', '2') is False
+    assert newest.dropped == 1
+    
+    with pytest.raises(ValueError):
+        ActionLogBuffer(adb, overflow='unknown')
+
+
+def test_action_log_block_policy_applies_backpressure(db, adb):
+    """Тест что политика 'block' сбрасывает буфер вместо потери событий"""
+    async def scenario():
+        buffer = ActionLogBuffer(adb, max_queue=2, overflow='block')
+        for i in range(5):
+            assert await buffer.put(1, 'event', str(i)) is True
+        await buffer.flush()
+        return buffer.dropped
+    
+    assert asyncio.run(scenario()) == 0
+    assert count_actions(db) == 5
+
+
+class FlakyActionLog:
+    """Фасад БД, первая запись в который падает"""
+
+    def __init__(self):
+        self.fail = True
+        self.batches = []
+
+    async def log_actions(self, batch):
+        await asyncio.sleep(0)
+        if self.fail:
+            self.fail = False
+            raise RuntimeError('database is locked')
+        self.batches.append([item[2] for item in batch])
+
+
+def test_action_log_requeues_failed_batch():
+    """Тест что незаписанная пачка возвращается в начало очереди"""
+    async def scenario():
+        adb = FlakyActionLog()
+        buffer = ActionLogBuffer(adb, batch_size=2, max_queue=3, overflow='drop_oldest')
+        for i in range(3):
+            buffer.add(1, 'event', str(i))
+        await buffer.flush()
+        after_failure = [item[2] for item in buffer._queue]
+        buffer.add(1, 'event', '3')
+        await buffer.flush()
+        return after_failure, adb.batches, buffer.counters()
+    
+    after_failure, batches, counters = asyncio.run(scenario())
+    assert after_failure == ['0', '1', '2']
+    # Пока очередь была полна, '3' вытеснило самое старое событие
+    assert batches == [['1', '2'], ['3']]
+    assert counters == {'pending': 0, 'written': 3, 'dropped': 1, 'failed': 2}
+    
+    async def overflow_on_requeue():
+        adb = FlakyActionLog()
+        buffer = ActionLogBuffer(adb, batch_size=2, max_queue=3, overflow='drop_newest')
+        for i in range(3):
+            buffer.add(1, 'event', str(i))
+        flush = asyncio.ensure_future(buffer.flush())
+        await asyncio.sleep(0)
+        # Пока пачка пишется, очередь снова пополняется до предела
+        buffer.add(1, 'event', '3')
+        buffer.add(1, 'event', '4')
+        await flush
+        return [item[2] for item in buffer._queue], buffer.dropped
+    
+    assert asyncio.run(overflow_on_requeue()) == (['0', '1', '2'], 2)
+
+
+def test_last_active_tracker_coalesces_touches(db, adb):
+    """Тест что касания схлопываются и пишутся одним пакетом"""
+    db.create_user(1, 'patient1', 'patient')
+    db.create_user(2, 'psych1', 'psychologist')
+    db.get_connection().execute("UPDATE users SET last_active = '2000-01-01 00:00:00'")
+    
+    async def scenario():
+        tracker = LastActiveTracker(adb, flush_interval=60)
+        for _ in range(10):
+            tracker.touch(1)
+        tracker.touch(2)
+        assert tracker.counters()['pending'] == 2
+        await tracker.flush()
+        return tracker.counters()
+    
+    counters = asyncio.run(scenario())
+    assert counters == {'pending': 0, 'written': 2}
+    assert db.get_user(1)['last_active'] > '2000-01-01 00:00:00'
+    assert db.get_statistics()['active_users_24h'] == 2
+
+
+def test_last_active_never_moves_backwards(db):
+    """Тест что устаревшее касание не откатывает last_active"""
+    db.create_user(1, 'patient1', 'patient')
+    db.update_last_active_bulk([(1, '2999-01-01 00:00:00')])
+    db.update_last_active_bulk([(1, '2001-01-01 00:00:00')])
+    assert db.get_user(1)['last_active'] == '2999-01-01 00:00:00'
+
+
+def test_match_maintenance_reconciles_in_chunks(db, adb):
+    """Тест фоновой сверки: каждая порция пишется отдельной короткой транзакцией"""
+    for user_id, user_type, vector in ((1, 'patient', '[1.0, 0.0]'), (2, 'patient', '[0.0, 1.0]'),
+                                       (3, 'psychologist', '[1.0, 0.0]')):
+        db.create_user(user_id, f'user{user_id}', user_type)
+        db.save_test_result(user_id, vector)
+    worker = MatchMaintenanceWorker(adb, MatchingSystem(db))
+    
+    transactions = []
+    apply_matches_diff = db.apply_matches_diff
+    
+    def record(upserts, deletes):
+        transactions.append(len(upserts))
+        return apply_matches_diff(upserts, deletes)
+    
+    db.apply_matches_diff = record
+    result = asyncio.run(worker.reconcile(chunk_size=1))
+    assert result == {'inserted': 2, 'updated': 0, 'deleted': 0}
+    assert transactions == [1, 1]
+    assert db.get_match_percentage(2, 3) == 50.0
+
+
+def test_statistics_maintenance_prunes_old_buckets(db, adb):
+    """Тест что фоновое обслуживание удаляет корзины активности старше суток"""
+    db.create_user(1, 'patient1', 'patient')
+    db.create_user(2, 'patient2', 'patient')
+    db.get_connection().execute("UPDATE users SET last_active = '2001-01-01 10:15:00' WHERE user_id = 2")
+    
+    async def scenario():
+        maintenance = StatisticsMaintenance(adb, flush_interval=60)
+        maintenance.start()
+        await maintenance.stop()
+        return maintenance.pruned
+    
+    assert asyncio.run(scenario()) == 1
+    buckets = db.get_connection().execute('SELECT bucket FROM activity_buckets').fetchall()
+    assert len(buckets) == 1
+    assert db.get_statistics()['active_patients_24h'] == 1
@@ -0,0 +1,99 @@
+"""
+Тесты для пакета benchmarks
+"""
+
+import os
+import sys
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.compare import compare
+from benchmarks.generator import Scale, generate
+from benchmarks.suite import run_benchmarks
+from database import Database
+
+NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def make_db():
+    """Фабрика временных БД"""
+    paths = []
+    
+    def factory():
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as f:
+            paths.append(f.name)
+        database = Database(f.name)
+        databases.append(database)
+        return database
+    
+    databases = []
+    yield factory
+    for database in databases:
+        database.close()
+    for db_path in paths:
+        for path in (db_path, db_path + '-wal', db_path + '-shm'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def dump(db):
+    connection = db.get_connection()
+    return {
+        table: connection.execute(f'SELECT * FROM {table} ORDER BY 1, 2').fetchall()
+        for table in ('users', 'test_results', 'likes', 'user_actions')
+    }
+
+
+def test_generator_is_deterministic(make_db):
+    """Тест: один seed — одинаковые данные"""
+    scale = Scale(psychologists=10, patients=30, actions=500)
+    first, second = make_db(), make_db()
+    
+    counts = generate(first, scale, seed=1, now=NOW)
+    generate(second, scale, seed=1, now=NOW)
+    
+    assert counts['users'] == 40
+    assert counts['user_actions'] == 500
+    assert [tuple(row) for row in dump(first)['likes']] == [tuple(row) for row in dump(second)['likes']]
+    assert first.get_test_vector(5).tolist() == second.get_test_vector(5).tolist()
+    assert len(first.get_test_vectors('psychologist')) == 10
+
+
+def test_run_and_compare():
+    """Тест прогона на минимальном масштабе и поиска регрессий"""
+    results = run_benchmarks(['tiny'], repeat=2, only=['create_like', 'create_like_enriched', 'get_statistics'])
+    benchmarks = results['scales']['tiny']['benchmarks']
+    assert set(benchmarks) == {'create_like', 'create_like_enriched', 'get_statistics'}
+    assert benchmarks['create_like']['runs'] == 2
+    assert benchmarks['create_like_enriched']['runs'] == 2
+    assert results['scales']['tiny']['quality'] == {}
+    
+    baseline = {'scales': {'tiny': {'benchmarks': {
+        'create_like': {'median_ms': benchmarks['create_like']['median_ms'] + 10},
+        'get_statistics': {'median_ms': 0.001},
+    }}}}
+    slow = {'scales': {'tiny': {'benchmarks': {'get_statistics': {'median_ms': 5.0}}}}}
+    
+    assert not any(row['regression'] for row in compare(results, baseline)
+                   if row['benchmark'] == 'create_like')
+    [row] = compare(slow, baseline)
+    assert row['regression']
+    assert compare(slow, baseline, threshold=10000)[0]['regression'] is False
+
+
+def test_ann_recall_quality():
+    """Тест: recall@K индекса считается и растет вместе с числом просматриваемых кластеров"""
+    results = run_benchmarks(['tiny'], repeat=3, only=['top_k_for_patient_ann', 'ann_recall'])
+    scale_results = results['scales']['tiny']
+    assert set(scale_results['benchmarks']) == {'top_k_for_patient_ann'}
+    
+    recalls = list(scale_results['quality'].values())
+    assert len(recalls) == 4
+    assert all(0.0 < recall <= 1.0 for recall in recalls)
+    assert recalls == sorted(recalls)
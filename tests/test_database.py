@@ -4,6 +4,7 @@
 
 import os
 import sys
+import numpy as np
 import pytest
 import tempfile
 from pathlib import Path
@@ -21,10 +22,12 @@ def db():
     
     database = Database(db_path)
     yield database
+    database.close()
     
     # Cleanup
-    if os.path.exists(db_path):
-        os.unlink(db_path)
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
 
 
 def test_create_user(db):
@@ -64,6 +67,15 @@ def test_save_psychologist_profile(db):
     assert profile['gender'] == 'Мужской'
     assert profile['age'] == 35
     assert profile['approach'] == 'КПТ'
+    assert profile['profile_version'] == 1
+    
+    # Каждое сохранение — новая версия (ключ кэша подписей карточек)
+    db.save_psychologist_profile(1, 'Иван Иванов', 'photo_id', 'МГУ', '6 лет', '@psych1')
+    profile = db.get_psychologist_info(1)
+    assert profile['experience'] == '6 лет'
+    assert profile['profile_version'] == 2
+    db.create_user(3, 'patient3', 'patient')
+    assert db.get_psychologists_page(3)[0]['profile_version'] == 2
 
 
 def test_create_like(db):
@@ -81,6 +93,37 @@ def test_create_like(db):
     assert is_mutual is True
 
 
+def test_create_like_enriched(db):
+    """Тест лайка с профилями обеих сторон и совместимостью в результате"""
+    db.create_user(1, 'patient1', 'patient')
+    db.save_patient_profile(1, 'Тревога', '@patient1')
+    db.create_user(2, 'psych2', 'psychologist')
+    db.save_psychologist_profile(2, 'Психолог', 'photo', 'МГУ', '5 лет', '@psych2')
+    db.save_match(1, 2, 75.0)
+    
+    like = db.create_like_enriched(1, 2)
+    assert (like['created'], like['is_mutual'], like['user_type']) == (True, False, 'patient')
+    assert (like['patient_id'], like['psychologist_id'], like['match_percentage']) == (1, 2, 75.0)
+    assert like['patient'] == db.get_patient_info(1)
+    assert like['psychologist'] == db.get_psychologist_info(2)
+    
+    assert db.create_like_enriched(1, 2)['created'] is False
+    
+    # Ответный лайк психолога: роли те же, оба лайка помечены взаимными
+    like = db.create_like_enriched(2, 1)
+    assert (like['created'], like['is_mutual'], like['user_type']) == (True, True, 'psychologist')
+    assert (like['patient_id'], like['psychologist_id']) == (1, 2)
+    mutual = db.get_connection().execute('SELECT COUNT(*) FROM likes WHERE is_mutual = 1').fetchone()[0]
+    assert mutual == 2
+    assert db.get_statistics()['mutual_matches'] == 1
+    
+    # Профиля нет — поля пустые, лайк все равно создан
+    db.create_user(3, 'patient3', 'patient')
+    like = db.create_like_enriched(3, 2)
+    assert like['created'] and like['patient'] is None and like['match_percentage'] is None
+    assert like['psychologist']['contact'] == '@psych2'
+
+
 def test_block_user(db):
     """Тест блокировки пользователя"""
     db.create_user(1, 'testuser', 'patient')
@@ -125,3 +168,354 @@ def test_save_match(db):
     match_percentage = db.get_match_percentage(1, 2)
     assert match_percentage == 85.5
 
+
+
+def test_save_matches(db):
+    """Тест пакетного сохранения совпадений"""
+    db.create_user(1, 'patient1', 'patient')
+    db.create_user(2, 'psych1', 'psychologist')
+    db.create_user(3, 'psych2', 'psychologist')
+    
+    saved = db.save_matches([(1, 2, 85.5), (1, 3, 40.0)])
+    assert saved == 2
+    assert db.get_match_percentage(1, 2) == 85.5
+    assert db.get_match_percentage(1, 3) == 40.0
+    
+    # Повторное сохранение заменяет значение
+    db.save_matches([(1, 2, 60.0)])
+    assert db.get_match_percentage(1, 2) == 60.0
+
+
+def test_save_matches_stream(db):
+    """Тест потоковой записи совпадений по частям"""
+    rows = ((1, psychologist_id, float(psychologist_id)) for psychologist_id in range(2, 12))
+    
+    saved = db.save_matches_stream(rows, chunk_size=3)
+    assert saved == 10
+    assert db.get_match_percentage(1, 11) == 11.0
+
+
+def test_connection_is_reused_per_thread(db):
+    """Тест что поток переиспользует одно соединение в режиме WAL"""
+    import threading
+    
+    conn = db.get_connection()
+    assert db.get_connection() is conn
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    
+    other = []
+    thread = threading.Thread(target=lambda: other.append(db.get_connection()))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+
+def test_thread_connection_closed_on_exit(db):
+    """Тест: соединение короткоживущего потока (запрос Flask) закрывается, когда поток завершается"""
+    import sqlite3
+    import threading
+    
+    db.get_connection()
+    opened = []
+    for _ in range(50):
+        thread = threading.Thread(target=lambda: opened.append(db.get_user(1) or db.get_connection()))
+        thread.start()
+        thread.join()
+    
+    assert len(db._connections) == 1
+    with pytest.raises(sqlite3.ProgrammingError):
+        opened[0].execute('SELECT 1')
+
+
+def test_transaction_rollback(db):
+    """Тест отката транзакции при исключении"""
+    with pytest.raises(RuntimeError):
+        with db.transaction() as cursor:
+            cursor.execute("INSERT INTO users (user_id, username, user_type) VALUES (1, 'u', 'patient')")
+            raise RuntimeError('boom')
+    
+    assert db.get_user(1) is None
+
+
+def test_two_instances_share_file(db):
+    """Тест одновременной работы двух процессов (экземпляров) с одним файлом"""
+    other = Database(db.db_path)
+    try:
+        other.create_user(1, 'from_admin', 'patient')
+        assert db.get_user(1)['username'] == 'from_admin'
+        
+        db.set_feature_flag('psychological_test_and_matching', True)
+        assert other.get_feature_flag('psychological_test_and_matching') is True
+    finally:
+        other.close()
+
+
+def test_feature_flag_cache(db):
+    """Тест кэша фича-флагов и его сброса при изменении из другого процесса"""
+    db.flag_cache_ttl = 60
+    assert db.get_feature_flag('psychological_test_and_matching') is False
+    
+    admin = Database(db.db_path)
+    try:
+        admin.set_feature_flag('psychological_test_and_matching', True)
+        
+        # В пределах TTL значение берется из памяти
+        assert db.get_feature_flag('psychological_test_and_matching') is False
+        
+        # После истечения TTL изменение замечается через PRAGMA data_version
+        db._flag_cache_expires = 0.0
+        assert db.get_feature_flag('psychological_test_and_matching') is True
+    finally:
+        admin.close()
+    
+    # Локальное изменение сбрасывает кэш сразу
+    db.set_feature_flag('psychological_test_and_matching', False)
+    assert db.get_feature_flag('psychological_test_and_matching') is False
+
+
+def test_psychologists_page_keyset(db):
+    """Тест keyset-пагинации карточек психологов"""
+    import json
+    db.set_feature_flag('psychological_test_and_matching', True)
+    db.create_user(1, 'patient1', 'patient')
+    db.save_test_result(1, json.dumps([1.0, 0.0]))
+    for user_id, score in [(2, 90.0), (3, 70.0), (4, 70.0), (5, 10.0)]:
+        db.create_user(user_id, f'psych{user_id}', 'psychologist')
+        db.save_psychologist_profile(user_id, f'Психолог {user_id}', 'photo', 'МГУ', '5 лет', '@p')
+        db.save_test_result(user_id, json.dumps([1.0, 0.0]))
+        db.save_match(1, user_id, score)
+    db.create_like(1, 3)
+    
+    full = [row['user_id'] for row in db.get_psychologists_for_patient(1)]
+    
+    # Листаем вперед по одной карточке
+    seen = []
+    rows = db.get_psychologists_page(1, limit=1)
+    while rows:
+        seen.append(rows[0]['user_id'])
+        rows = db.get_psychologists_page(1, rows[0]['cursor'], 'next', limit=1)
+    assert seen == [2, 4, 3, 5]
+    assert sorted(seen) == sorted(full)
+    
+    # Назад от последней карточки — в порядке показа
+    last = db.get_psychologists_page(1, (10.0, 5), 'next', limit=2, inclusive=True)
+    assert [row['user_id'] for row in last] == [5]
+    previous = db.get_psychologists_page(1, last[0]['cursor'], 'prev', limit=2)
+    assert [row['user_id'] for row in previous] == [4, 3]
+    assert previous[1]['already_liked'] == 1
+
+
+def test_likes_page_keyset(db):
+    """Тест keyset-пагинации лайков психологу"""
+    db.create_user(10, 'psych', 'psychologist')
+    for user_id in (1, 2, 3):
+        db.create_user(user_id, f'patient{user_id}', 'patient')
+        db.save_patient_profile(user_id, f'Запрос {user_id}', f'@p{user_id}')
+        db.create_like(user_id, 10)
+    
+    assert db.count_likes_for_psychologist(10) == 3
+    
+    first = db.get_likes_page(10, limit=2)
+    assert len(first) == 2
+    rest = db.get_likes_page(10, first[-1]['cursor'], 'next', limit=2)
+    # Лайки одной секунды упорядочены по id, новые сначала
+    assert [row['user_id'] for row in first + rest] == [3, 2, 1]
+
+
+def test_users_page(db):
+    """Тест страницы пользователей админки: фильтры, поиск, keyset-листание и счетчики лайков"""
+    for user_id in (1, 2, 3):
+        db.create_user(user_id, f'psych{user_id}', 'psychologist')
+    for user_id in (10, 11, 12):
+        db.create_user(user_id, f'patient_{user_id}', 'patient')
+    db.create_like(10, 1)
+    db.create_like(1, 10)
+    db.create_like(11, 1)
+    db.block_user(12)
+    with db.transaction() as cursor:
+        cursor.execute("UPDATE users SET last_active = '2000-01-01 00:00:00' WHERE user_id = 3")
+    
+    # Пользователи одной секунды упорядочены по ID, новые сначала
+    rows = db.get_users_page(limit=10)
+    assert [row['user_id'] for row in rows] == [12, 11, 10, 3, 2, 1]
+    by_id = {row['user_id']: row for row in rows}
+    assert (by_id[1]['likes_sent'], by_id[1]['likes_received'], by_id[1]['mutual_matches']) == (1, 2, 1)
+    assert (by_id[11]['likes_sent'], by_id[11]['mutual_matches']) == (1, 0)
+    assert by_id[12]['blocked'] == 1
+    expected = {row['user_id']: (row['likes_sent'], row['likes_received'], row['mutual_matches'])
+                for row in db.get_all_users_with_stats()}
+    assert {user_id: (row['likes_sent'], row['likes_received'], row['mutual_matches'])
+            for user_id, row in by_id.items()} == expected
+    
+    # Листаем вперед по две строки и обратно
+    first = db.get_users_page(limit=2)
+    second = db.get_users_page(first[-1]['cursor'], 'next', limit=2)
+    assert [row['user_id'] for row in first + second] == [12, 11, 10, 3]
+    previous = db.get_users_page(second[0]['cursor'], 'prev', limit=2)
+    assert [row['user_id'] for row in previous] == [12, 11]
+    
+    # Фильтры
+    assert [row['user_id'] for row in db.get_users_page(user_type='psychologist')] == [3, 2, 1]
+    assert [row['user_id'] for row in db.get_users_page(blocked=True)] == [12]
+    assert 12 not in [row['user_id'] for row in db.get_users_page(blocked=False)]
+    assert [row['user_id'] for row in db.get_users_page(active_before='2001-01-01 00:00:00')] == [3]
+    assert 3 not in [row['user_id'] for row in db.get_users_page(active_after='2001-01-01 00:00:00')]
+    
+    # Поиск: подстрока username (с @ и без), точный ID, символы LIKE экранируются
+    assert [row['user_id'] for row in db.get_users_page(search='@psych2')] == [2]
+    assert [row['user_id'] for row in db.get_users_page(search='11')] == [11]
+    assert [row['user_id'] for row in db.get_users_page(search='2')] == [12, 2]
+    assert [row['user_id'] for row in db.get_users_page(search='t_1')] == [12, 11, 10]
+    assert db.get_users_page(search='h_') == []
+    assert db.get_users_page(search='%') == []
+    
+    ids = db.get_users_page(sort='id', limit=2)
+    assert [row['user_id'] for row in ids] == [12, 11]
+    assert ids[-1]['cursor'] == (11, 11)
+    with pytest.raises(ValueError):
+        db.get_users_page(sort='username')
+
+
+def test_user_activity_summary(db):
+    """Тест сводки активности пользователя одним запросом"""
+    summary = db.get_user_activity_summary(1)
+    assert (summary['likes_sent'], summary['likes_received'], summary['matches_count']) == (0, 0, 0)
+    assert summary['score_p50'] is None
+    assert summary['last_actions'] == []
+    
+    db.create_user(1, 'patient1', 'patient')
+    db.save_test_result(1, [1.0, 0.0])
+    for user_id in range(2, 12):
+        db.create_user(user_id, f'psych{user_id}', 'psychologist')
+        db.save_match(1, user_id, float(user_id * 10))
+    db.create_like(1, 2)
+    db.create_like(2, 1)
+    db.create_like(3, 1)
+    db.log_actions([(1, 'start', None, '2024-01-01 10:00:00'),
+                    (1, 'like', '2', '2024-01-02 10:00:00'),
+                    (2, 'start', None, '2024-01-03 10:00:00')])
+    
+    summary = db.get_user_activity_summary(1, actions_limit=1)
+    assert (summary['likes_sent'], summary['likes_received'], summary['mutual_matches']) == (1, 2, 1)
+    # Проценты 20..110: перцентили по ближайшему рангу
+    assert summary['matches_count'] == 10
+    assert (summary['score_min'], summary['score_p25'], summary['score_p50'],
+            summary['score_p90'], summary['score_max']) == (20.0, 40.0, 60.0, 100.0, 110.0)
+    assert summary['score_avg'] == 65.0
+    assert summary['last_actions'] == [{'action_type': 'like', 'action_data': '2',
+                                        'timestamp': '2024-01-02 10:00:00'}]
+    assert summary['test_completed'] is True
+    assert summary['test_completed_date']
+    
+    # Психолог: совместимость считается по его столбцу matches
+    summary = db.get_user_activity_summary(5)
+    assert (summary['matches_count'], summary['score_p50']) == (1, 50.0)
+
+
+def test_test_vector_blob(db):
+    """Тест бинарного хранения вектора: float32 BLOB, норма и размерность"""
+    db.create_user(1, 'patient1', 'patient')
+    db.save_test_result(1, '[0.5, -1.0, 0.25]')
+    
+    vector = db.get_test_vector(1)
+    assert vector.dtype == np.float32
+    assert vector.tolist() == [0.5, -1.0, 0.25]
+    assert db.get_test_result(1) == '[0.5, -1.0, 0.25]'
+    
+    [(user_id, stored, norm)] = db.get_test_vectors('patient')
+    assert user_id == 1
+    assert norm == pytest.approx(np.linalg.norm([0.5, -1.0, 0.25]))
+    
+    row = db.get_connection().execute('SELECT vector_dim FROM test_results').fetchone()
+    assert row['vector_dim'] == 3
+    assert db.get_test_vector(2) is None
+
+
+def test_backfill_legacy_json_vectors(db):
+    """Тест перевода старых JSON-строк в BLOB и прозрачного чтения до перевода"""
+    db.create_user(1, 'patient1', 'patient')
+    with db.transaction() as cursor:
+        cursor.execute('UPDATE users SET test_completed = 1 WHERE user_id = 1')
+        cursor.execute("INSERT INTO test_results (user_id, values_vector) VALUES (1, '[1.0, 2.0]')")
+    
+    assert db.get_test_vector(1).tolist() == [1.0, 2.0]
+    assert db.get_test_vectors('patient')[0][2] == pytest.approx(np.sqrt(5))
+    
+    assert db.backfill_vector_blobs() == 1
+    assert db.backfill_vector_blobs() == 0
+    row = db.get_connection().execute('SELECT * FROM test_results').fetchone()
+    assert row['vector_blob'] is not None
+    assert row['vector_dim'] == 2
+
+
+def test_statistics_counters(db):
+    """Тест счетчиков статистики: совпадение с пересчетом по таблицам после любых записей"""
+    def ago(hours):
+        row = db.get_connection().execute("SELECT datetime('now', ?) AS ts", (f'-{hours * 60:.0f} minutes',)).fetchone()
+        return row['ts']
+    
+    for user_id in (1, 2, 3):
+        db.create_user(user_id, f'psych{user_id}', 'psychologist')
+    for user_id in (10, 11, 12, 13):
+        db.create_user(user_id, f'patient{user_id}', 'patient')
+    
+    # Активность по обе стороны границы окна, включая неполный час на ее краю
+    db.update_last_active_bulk([(2, ago(23.5)), (3, ago(30)), (11, ago(24.2)), (12, ago(23.95))])
+    with db.transaction() as cursor:
+        cursor.execute('UPDATE users SET last_active = ? WHERE user_id = 13', (ago(48),))
+    
+    db.create_like(10, 1)
+    db.create_like(1, 10)
+    db.create_like(11, 2)
+    db.create_like(2, 11)
+    db.create_like(12, 3)
+    with db.transaction() as cursor:
+        cursor.execute('UPDATE likes SET liked_date = ? WHERE from_user_id IN (11, 2)', (ago(23.97),))
+    
+    stats = db.get_statistics()
+    assert stats == db.recompute_statistics()
+    assert stats['psychologists_count'] == 3
+    assert stats['patients_count'] == 4
+    assert stats['mutual_matches'] == 2
+    assert stats['matches_24h'] == 2
+    assert db.check_statistics_counters() == {}
+    
+    db.delete_user_profile(1)
+    db.delete_user_profile(11)
+    assert db.get_statistics() == db.recompute_statistics()
+    assert db.get_statistics()['mutual_matches'] == 0
+    
+    # Корзины вне окна удаляются, статистика от этого не меняется
+    stats = db.get_statistics()
+    assert db.prune_activity_buckets() >= 2
+    assert db.prune_activity_buckets() == 0
+    buckets = [row['bucket'] for row in db.get_connection().execute('SELECT bucket FROM activity_buckets')]
+    assert buckets and min(buckets) >= ago(25)
+    assert db.get_statistics() == stats == db.recompute_statistics()
+    
+    # Рассинхрон (например, ручная правка таблиц) находится и исправляется
+    with db.transaction() as cursor:
+        cursor.execute("UPDATE stat_counters SET value = value + 5 WHERE name = 'users_patient'")
+    assert db.check_statistics_counters(repair=True) == {'patients_count': (8, 3)}
+    assert db.check_statistics_counters() == {}
+
+
+def test_statistics_counters_backfilled_for_existing_db(db):
+    """Тест заполнения счетчиков при открытии БД, созданной до их появления"""
+    db.create_user(1, 'psych1', 'psychologist')
+    db.create_user(2, 'patient2', 'patient')
+    db.create_like(2, 1)
+    db.create_like(1, 2)
+    with db.transaction() as cursor:
+        for trigger in ('users_stats_insert', 'users_stats_delete', 'users_stats_update',
+                        'likes_stats_insert', 'likes_stats_delete', 'likes_stats_update'):
+            cursor.execute(f'DROP TRIGGER trg_{trigger}')
+        cursor.execute('DROP TABLE stat_counters')
+        cursor.execute('DROP TABLE activity_buckets')
+    
+    reopened = Database(db.db_path)
+    try:
+        assert reopened.get_statistics() == reopened.recompute_statistics()
+        assert reopened.get_statistics()['mutual_matches'] == 1
+    finally:
+        reopened.close()
@@ -5,6 +5,7 @@
 import sys
 import pytest
 import json
+import numpy as np
 import tempfile
 from pathlib import Path
 
@@ -23,9 +24,11 @@ def db():
     
     database = Database(db_path)
     yield database
+    database.close()
     
-    if os.path.exists(db_path):
-        os.unlink(db_path)
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
 
 
 @pytest.fixture
@@ -89,6 +92,49 @@ def test_calculate_all_matches_for_patient(db, matching_system):
     assert 0.0 <= match2 <= 100.0
 
 
+def test_batch_scores_match_pairwise(db, matching_system):
+    """Тест что пакетный расчет совпадает с попарным"""
+    db.create_user(1, 'patient1', 'patient')
+    db.save_test_result(1, json.dumps([0.5, 0.3, -0.2, 0.7, 0.1]))
+    
+    vectors = {
+        2: [0.6, 0.4, -0.1, 0.6, 0.2],
+        3: [0.3, 0.6, 0.1, -0.4, 0.5],
+        4: [0.0, 0.0, 0.0, 0.0, 0.0],
+        5: [1.0, 0.5, 0.2],
+    }
+    for user_id, vector in vectors.items():
+        db.create_user(user_id, f'psych{user_id}', 'psychologist')
+        db.save_test_result(user_id, json.dumps(vector))
+    
+    psychologist_ids, scores = matching_system.calculate_scores_for_patient(1)
+    
+    assert psychologist_ids.tolist() == [2, 3, 4, 5]
+    patient_vector = db.get_test_result(1)
+    for psychologist_id, score in zip(psychologist_ids.tolist(), scores.tolist()):
+        expected = matching_system.calculate_match_percentage(patient_vector, db.get_test_result(psychologist_id))
+        assert score == pytest.approx(expected, abs=0.1)
+
+
+def test_calculate_match_matrix(db, matching_system):
+    """Тест полной матрицы пациенты × психологи"""
+    for user_id, user_type, vector in [
+        (1, 'patient', [1.0, 0.0]),
+        (2, 'patient', [0.0, 1.0]),
+        (3, 'psychologist', [1.0, 0.0]),
+        (4, 'psychologist', [-1.0, 0.0]),
+        (5, 'psychologist', [0.0, 1.0]),
+    ]:
+        db.create_user(user_id, f'user{user_id}', user_type)
+        db.save_test_result(user_id, json.dumps(vector))
+    
+    patient_ids, psychologist_ids, scores = matching_system.calculate_match_matrix()
+    
+    assert patient_ids.tolist() == [1, 2]
+    assert psychologist_ids.tolist() == [3, 4, 5]
+    assert scores.tolist() == [[100.0, 0.0, 50.0], [50.0, 50.0, 100.0]]
+
+
 def test_psychological_test():
     """Тест психологического теста"""
     questions = [
@@ -115,3 +161,153 @@ def test_psychological_test():
     assert len(vector) > 0
     assert all(-1.0 <= v <= 1.0 for v in vector)
 
+
+
+def create_users(db, users):
+    for user_id, user_type, vector in users:
+        db.create_user(user_id, f'user{user_id}', user_type)
+        db.save_test_result(user_id, json.dumps(vector))
+
+
+def test_update_user_incremental(db, matching_system):
+    """Тест инкрементального обновления строк одного пользователя"""
+    create_users(db, [
+        (1, 'patient', [1.0, 0.0]),
+        (2, 'patient', [0.0, 1.0]),
+        (3, 'psychologist', [1.0, 0.0]),
+    ])
+    
+    assert matching_system.update_user(3) == 2
+    assert db.get_match_percentage(1, 3) == 100.0
+    assert db.get_match_percentage(2, 3) == 50.0
+    
+    # Вектор психолога изменился — пересчитываются только его строки
+    db.save_test_result(3, json.dumps([0.0, 1.0]))
+    matching_system.mark_dirty(3)
+    assert matching_system.update_dirty() == 1
+    assert matching_system.pending_updates() == 0
+    assert db.get_match_percentage(1, 3) == 50.0
+    assert db.get_match_percentage(2, 3) == 100.0
+    
+    # Заблокированный психолог исчезает из совместимости
+    db.block_user(3)
+    matching_system.update_user(3)
+    assert db.get_match_percentage(1, 3) is None
+
+
+def test_update_dirty_takes_shared_queue(db, matching_system):
+    """Тест: пользователи из очереди match_updates (другой процесс) пересчитываются вместе с отмеченными"""
+    create_users(db, [
+        (1, 'patient', [1.0, 0.0]),
+        (2, 'psychologist', [1.0, 0.0]),
+        (3, 'psychologist', [0.0, 1.0]),
+    ])
+    matching_system.mark_dirty(2)
+    db.queue_match_update(3)
+    db.queue_match_update(3)
+    
+    assert matching_system.update_dirty() == 2
+    assert db.get_match_percentage(1, 2) == 100.0
+    assert db.get_match_percentage(1, 3) == 50.0
+    assert db.take_match_updates() == []
+    
+    # Блокировка из админки: строки убирает очередь, даже если этот процесс о ней не знал
+    db.block_user(2)
+    db.queue_match_update(2)
+    assert matching_system.update_dirty() == 1
+    assert db.get_match_percentage(1, 2) is None
+
+
+def test_reconcile(db, matching_system):
+    """Тест сверки matches с test_results"""
+    create_users(db, [
+        (1, 'patient', [1.0, 0.0]),
+        (2, 'psychologist', [1.0, 0.0]),
+        (3, 'psychologist', [0.0, 1.0]),
+    ])
+    db.save_match(1, 2, 10.0)   # устаревшее значение
+    db.save_match(1, 99, 70.0)  # строка без пользователя
+    
+    result = matching_system.reconcile()
+    
+    assert result == {'inserted': 1, 'updated': 1, 'deleted': 1}
+    assert db.get_match_percentage(1, 2) == 100.0
+    assert db.get_match_percentage(1, 3) == 50.0
+    assert db.get_match_percentage(1, 99) is None
+    
+    # Повторная сверка ничего не пишет
+    assert matching_system.reconcile() == {'inserted': 0, 'updated': 0, 'deleted': 0}
+
+
+def test_reconcile_in_chunks(db, matching_system):
+    """Тест сверки порциями: строки пациентов без теста удаляются, пересчитанные во время сверки не трогаются"""
+    create_users(db, [
+        (1, 'patient', [1.0, 0.0]),
+        (2, 'patient', [0.0, 1.0]),
+        (3, 'patient', [1.0, 1.0]),
+        (10, 'psychologist', [1.0, 0.0]),
+    ])
+    db.create_user(4, 'user4', 'patient')
+    db.save_match(4, 10, 70.0)   # пациент без теста
+    db.save_match(2, 10, 10.0)   # устаревшее значение
+    
+    assert matching_system.reconcile(chunk_size=1) == {'inserted': 2, 'updated': 1, 'deleted': 1}
+    assert db.get_match_percentage(4, 10) is None
+    assert db.get_match_percentage(2, 10) == 50.0
+    
+    # Пациент пересчитан update_user между расчетом порции и ее записью: запись плана пропускается
+    db.save_match(1, 10, 10.0)
+    plan = matching_system.prepare_reconcile()
+    diff = matching_system.reconcile_diff(plan, [1])
+    assert diff.updated == 1
+    matching_system.update_user(1)
+    assert matching_system.apply_reconcile_diff(diff) == 0
+    assert diff.upserts == []
+    matching_system.finish_reconcile({})
+    assert matching_system.pending_updates() == 1
+
+
+def test_top_k_matches_full_sort(db, matching_system):
+    """Тест: top-K через argpartition совпадает с началом полной сортировки (с учетом равных)"""
+    rng = np.random.default_rng(7)
+    users = [(1, 'patient', rng.uniform(-1, 1, 5).round(1).tolist())]
+    users += [(user_id, 'psychologist', rng.uniform(-1, 1, 5).round(1).tolist()) for user_id in range(10, 60)]
+    users += [(60, 'psychologist', users[1][2]), (61, 'psychologist', users[1][2])]
+    create_users(db, users)
+    
+    psychologist_ids, scores = matching_system.calculate_scores_for_patient(1)
+    full = sorted(zip(scores.tolist(), psychologist_ids.tolist()), reverse=True)
+    
+    for k in (1, 5, 20, 52, 100):
+        top_ids, top_scores = matching_system.top_k_for_patient(1, k)
+        assert list(zip(top_scores.tolist(), top_ids.tolist())) == full[:k]
+
+
+def test_topk_ranking_mode(db):
+    """Тест режима topk: в matches хранится только top-K на пациента"""
+    matching_system = MatchingSystem(db, ranking_mode='topk', top_k=2)
+    create_users(db, [
+        (1, 'patient', [1.0, 0.0]),
+        (2, 'psychologist', [1.0, 0.0]),
+        (3, 'psychologist', [0.0, 1.0]),
+        (4, 'psychologist', [1.0, 1.0]),
+    ])
+    
+    # Завершение теста психологом не пишет строк
+    assert matching_system.update_user(2) == 0
+    assert db.get_all_matches() == []
+    
+    assert matching_system.refresh_top_k(1) == 2
+    assert sorted(db.get_all_matches()) == [(1, 2, 100.0), (1, 4, 85.4)]
+    
+    # Новый вектор психолога виден после сброса матрицы
+    db.save_test_result(3, json.dumps([1.0, 0.0]))
+    matching_system.update_user(3)
+    matching_system.refresh_top_k(1)
+    assert sorted(db.get_all_matches()) == [(1, 2, 100.0), (1, 3, 100.0)]
+    
+    assert matching_system.recalculate_all_matches() == 2
+    assert matching_system.reconcile() == {'inserted': 0, 'updated': 0, 'deleted': 0}
+    
+    with pytest.raises(ValueError):
+        MatchingSystem(db, ranking_mode='unknown')
@@ -0,0 +1,134 @@
+"""
+Тесты для metrics.py
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import Database
+from metrics import MetricsRegistry, instrument_database, load_snapshot, quantile, summary, to_prometheus
+
+
+@pytest.fixture
+def db():
+    """Создает временную БД для тестов"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as f:
+        db_path = f.name
+    
+    database = Database(db_path)
+    yield database
+    database.close()
+    
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def test_instrument_sync_async_and_errors():
+    """Тест замера функций, корутин, ошибок и числа строк"""
+    registry = MetricsRegistry()
+    rows = registry.instrument(lambda: [1, 2, 3], 'rows')
+    
+    @registry.instrument
+    async def handler():
+        return None
+    
+    def fail():
+        raise ValueError('boom')
+    failing = registry.instrument(fail, 'fail')
+    
+    rows()
+    rows()
+    asyncio.run(handler())
+    with pytest.raises(ValueError):
+        failing()
+    
+    snapshot = registry.snapshot()
+    assert snapshot['rows']['count'] == 2
+    assert snapshot['rows']['rows'] == 6
+    assert snapshot['fail']['errors'] == 1
+    assert snapshot[handler.__qualname__]['count'] == 1
+
+
+def test_threads_are_merged():
+    """Тест: счетчики разных потоков суммируются в снимке"""
+    registry = MetricsRegistry()
+    
+    def work():
+        for _ in range(1000):
+            registry.observe('call', 0.001)
+    
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    assert registry.snapshot()['call']['count'] == 4000
+
+
+def test_finished_threads_are_retired():
+    """Тест: счетчики завершившихся потоков (запросы Flask) вливаются в итог, список потоков не растет"""
+    registry = MetricsRegistry()
+    registry.observe('call', 0.001)
+    
+    for _ in range(100):
+        thread = threading.Thread(target=lambda: registry.observe('call', 0.002, error=True, rows=3))
+        thread.start()
+        thread.join()
+    
+    assert len(registry._stores) == 1
+    snapshot = registry.snapshot()['call']
+    assert (snapshot['count'], snapshot['errors'], snapshot['rows']) == (101, 100, 300)
+    assert snapshot['sum'] == pytest.approx(0.201)
+
+
+def test_quantiles_and_prometheus():
+    """Тест оценки квантилей и текстового формата Prometheus"""
+    registry = MetricsRegistry()
+    for _ in range(90):
+        registry.observe('db.get_user', 0.0002)
+    for _ in range(10):
+        registry.observe('db.get_user', 0.5)
+    
+    series = registry.snapshot()['db.get_user']
+    assert 0.0001 < quantile(series, 0.5) <= 0.0002
+    assert 0.2 < quantile(series, 0.99) <= 0.82
+    assert summary({'db.get_user': series})[0]['count'] == 100
+    
+    text = to_prometheus({'bot': registry.snapshot()})
+    assert '# TYPE psymatch_call_duration_seconds histogram' in text
+    assert 'psymatch_call_duration_seconds_count{process="bot",name="db.get_user"} 100' in text
+    assert 'psymatch_call_duration_seconds_bucket{process="bot",name="db.get_user",le="+Inf"} 100' in text
+
+
+def test_instrument_database_and_dump(db):
+    """Тест обертки методов Database и записи снимка в файл"""
+    registry = MetricsRegistry()
+    instrument_database(db, registry)
+    db.create_user(1, 'user', 'patient')
+    assert db.get_user(1)['username'] == 'user'
+    db.get_all_users_with_stats()
+    
+    snapshot = registry.snapshot()
+    assert snapshot['db.get_user']['rows'] == 1
+    assert snapshot['db.get_all_users_with_stats']['rows'] == 1
+    assert 'db.get_connection' not in snapshot
+    
+    path = db.db_path + '.metrics.json'
+    try:
+        registry.dump(path, 'bot')
+        loaded = load_snapshot(path)
+        assert loaded['process'] == 'bot'
+        assert loaded['metrics']['db.create_user']['count'] == 1
+    finally:
+        os.unlink(path)
+    assert load_snapshot(path) is None
@@ -0,0 +1,251 @@
+"""
+Тесты для outbound.py (очередь исходящих сообщений) на фейковом боте
+"""
+
+import sys
+import time
+import asyncio
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from metrics import MetricsRegistry
+from outbound import INTERACTIVE, NOTIFICATION, OutboundQueue, RenderCoalescer, TokenBucket
+
+
+class FakeBot:
+    """Записывает отправки (время, чат, текст); errors — исключения для первых попыток по тексту"""
+
+    def __init__(self, errors: dict = None, delay: float = 0.0):
+        self.sent = []
+        self.calls = 0
+        self.errors = errors or {}
+        self.delay = delay
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        pending = self.errors.get(text)
+        if pending:
+            raise pending.pop(0)
+        self.sent.append((time.monotonic(), chat_id, text))
+        return {'chat_id': chat_id, 'text': text}
+
+
+def run(queue: OutboundQueue, bot: FakeBot, scenario):
+    """Выполнить scenario(queue) с запущенной очередью и дождаться доставки"""
+    async def main():
+        queue.start(bot)
+        result = await scenario(queue)
+        await queue.stop()
+        return result
+    return asyncio.run(main())
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=2.0, capacity=2, now=0.0)
+    bucket.consume(0.0)
+    bucket.consume(0.0)
+    assert bucket.delay(0.0) == pytest.approx(0.5)
+    assert bucket.delay(0.5) == 0.0
+    assert not bucket.is_full(0.5)
+    assert bucket.is_full(1.0)
+
+
+def test_handlers_return_before_delivery():
+    """Тест: постановка в очередь не ждет отправки, Future получает результат бота"""
+    bot = FakeBot(delay=0.05)
+
+    async def scenario(queue):
+        started = time.monotonic()
+        future = queue.send_message(1, 'hello')
+        assert time.monotonic() - started < 0.01
+        assert not future.done()
+        return await future
+
+    assert run(OutboundQueue(), bot, scenario) == {'chat_id': 1, 'text': 'hello'}
+
+
+def test_interactive_lane_goes_first():
+    """Тест: интерактивные ответы уходят раньше уведомлений, поставленных до них"""
+    bot = FakeBot()
+
+    async def scenario(queue):
+        for chat_id in (1, 2, 3):
+            queue.send_message(chat_id, f'notify {chat_id}', lane=NOTIFICATION)
+        queue.send_message(4, 'reply', lane=INTERACTIVE)
+
+    # Очередь наполняется до старта доставки, отправки идут по одной
+    queue = OutboundQueue(max_in_flight=1)
+
+    async def main():
+        await scenario(queue)
+        queue.start(bot)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert [text for _, _, text in bot.sent] == ['reply', 'notify 1', 'notify 2', 'notify 3']
+
+
+def test_per_chat_rate_limit_keeps_order_and_other_chats_flowing():
+    """Тест лимита на чат: сообщения чата по порядку с интервалом, другие чаты не ждут"""
+    bot = FakeBot()
+
+    async def scenario(queue):
+        futures = [queue.send_message(1, f'chat1 #{i}') for i in range(3)]
+        futures.append(queue.send_message(2, 'chat2'))
+        await asyncio.gather(*futures)
+
+    run(OutboundQueue(chat_rate=20.0, chat_burst=1), bot, scenario)
+    chat1 = [(sent_at, text) for sent_at, chat_id, text in bot.sent if chat_id == 1]
+    assert [text for _, text in chat1] == ['chat1 #0', 'chat1 #1', 'chat1 #2']
+    # 20 сообщений в секунду на чат — не чаще раза в 50 мс (с допуском на таймер)
+    assert chat1[1][0] - chat1[0][0] >= 0.04
+    assert chat1[2][0] - chat1[1][0] >= 0.04
+    assert [text for _, _, text in bot.sent].index('chat2') < 2
+
+
+def test_global_rate_limit():
+    """Тест общего лимита бота"""
+    bot = FakeBot()
+
+    async def scenario(queue):
+        await asyncio.gather(*(queue.send_message(chat_id, 'hi') for chat_id in range(5)))
+
+    run(OutboundQueue(global_rate=50.0, global_burst=2), bot, scenario)
+    times = [sent_at for sent_at, _, _ in bot.sent]
+    # Два сообщения всплеском, остальные три — не быстрее 50 в секунду
+    assert times[-1] - times[0] >= 3 * 0.02 * 0.8
+
+
+def test_retry_after_pauses_and_retries():
+    """Тест: RetryAfter приостанавливает отправки на указанное время, сообщение повторяется"""
+    flood = RetryAfter(1)
+    flood.retry_after = 0.1
+    bot = FakeBot(errors={'first': [flood]})
+    queue = OutboundQueue()
+
+    async def scenario(queue):
+        started = time.monotonic()
+        first = queue.send_message(1, 'first')
+        await asyncio.sleep(0.01)
+        second = queue.send_message(2, 'second')
+        await asyncio.gather(first, second)
+        return started
+
+    started = run(queue, bot, scenario)
+    assert [text for _, _, text in bot.sent] == ['first', 'second']
+    # Второй чат тоже ждал окончания паузы
+    assert bot.sent[1][0] - started >= 0.09
+    assert queue.counters()['retried'] == 1
+    assert queue.counters()['sent'] == 2
+
+
+def test_network_error_backoff_and_permanent_errors():
+    """Тест: сетевые ошибки повторяются; BadRequest, превышение попыток и TimedOut отправки — нет"""
+    bot = FakeBot(errors={
+        'flaky': [NetworkError('Connection reset'), NetworkError('Connection reset')],
+        'bad': [BadRequest('Chat not found')],
+        'blocked': [Forbidden('bot was blocked by the user')],
+        'down': [NetworkError('Connection reset') for _ in range(5)],
+        'timeout': [TimedOut()],
+    })
+    queue = OutboundQueue(backoff_base=0.01, max_retries=2)
+
+    async def scenario(queue):
+        return await asyncio.gather(*(queue.send_message(chat_id, text) for chat_id, text in
+                                      enumerate(('flaky', 'bad', 'blocked', 'down', 'timeout'))))
+
+    results = run(queue, bot, scenario)
+    assert results[0] == {'chat_id': 0, 'text': 'flaky'}
+    assert results[1:] == [None, None, None, None]
+    counters = queue.counters()
+    # Заблокировавший бота пользователь не считается ошибкой доставки
+    assert (counters['sent'], counters['failed'], counters['blocked'], counters['retried']) == (1, 3, 1, 4)
+    # 'down': первая попытка и два повтора
+    assert len(bot.errors['down']) == 2
+    # TimedOut send_message не повторяется: сообщение могло дойти, повтор прислал бы дубль
+    assert bot.errors['timeout'] == []
+
+
+def test_timeout_retry_is_configurable_per_method():
+    """Тест: TimedOut повторяется для методов вне no_retry_on_timeout"""
+    bot = FakeBot(errors={'slow': [TimedOut()]})
+    queue = OutboundQueue(backoff_base=0.01, no_retry_on_timeout=())
+
+    async def scenario(queue):
+        return await queue.send_message(1, 'slow')
+
+    assert run(queue, bot, scenario) == {'chat_id': 1, 'text': 'slow'}
+    assert queue.counters()['retried'] == 1
+
+
+def test_overflow_drops_notifications_only():
+    bot = FakeBot()
+    queue = OutboundQueue(max_queue=1)
+
+    async def main():
+        queue.send_message(1, 'notify 1', lane=NOTIFICATION)
+        dropped = queue.send_message(2, 'notify 2', lane=NOTIFICATION)
+        queue.send_message(3, 'reply', lane=INTERACTIVE)
+        assert dropped.done() and dropped.result() is None
+        queue.start(bot)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert sorted(text for _, _, text in bot.sent) == ['notify 1', 'reply']
+    assert queue.counters()['dropped'] == 1
+
+
+def test_metrics_and_stop_timeout():
+    """Тест метрик задержки доставки и остановки с недоставленными сообщениями"""
+    registry = MetricsRegistry()
+    bot = FakeBot(delay=1.0)
+    queue = OutboundQueue(metrics_registry=registry, chat_rate=1.0, chat_burst=1)
+
+    async def main():
+        fast = OutboundQueue(metrics_registry=registry)
+        fast.start(FakeBot())
+        await fast.send_message(1, 'hi', lane=NOTIFICATION)
+        await fast.stop()
+
+        queue.start(bot)
+        futures = [queue.send_message(1, 'slow'), queue.send_message(1, 'never')]
+        await asyncio.sleep(0.01)
+        await queue.stop(timeout=0.05)
+        return [future.result() for future in futures]
+
+    assert asyncio.run(main()) == [None, None]
+    snapshot = registry.snapshot()
+    assert snapshot['outbound.notification']['count'] == 1
+    assert queue.counters()['pending'] == 0
+    # Одно сообщение прервано посреди отправки, второе не начато
+    assert queue.counters()['dropped'] == 2
+
+
+def test_render_coalescer_runs_latest_only():
+    """Тест: пока идет отрисовка, из новых вызовов выполняется только последний; ключи независимы"""
+    rendered = []
+
+    async def render(key, value):
+        await asyncio.sleep(0.02)
+        rendered.append((key, value))
+
+    async def main():
+        coalescer = RenderCoalescer()
+        for value in range(4):
+            coalescer.submit('a', render, 'a', value)
+        coalescer.submit('b', render, 'b', 0)
+        await coalescer.drain()
+        # После завершения новый вызов снова выполняется сразу
+        coalescer.submit('a', render, 'a', 4)
+        await coalescer.drain()
+        return coalescer.counters()
+
+    counters = asyncio.run(main())
+    assert sorted(rendered) == [('a', 0), ('a', 3), ('a', 4), ('b', 0)]
+    assert counters == {'running': 0, 'rendered': 4, 'coalesced': 2}
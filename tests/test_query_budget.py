@@ -0,0 +1,467 @@
+"""
+Тесты для query_budget.py и бюджетов обращений к БД обработчиков бота
+"""
+
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+import query_budget
+from database import Database
+from query_budget import QueryBudgetExceeded
+
+PATIENT_ID = 1000
+ADMIN_ID = 1001
+PSYCHOLOGIST_IDS = (1, 2, 3)
+# Размер пула читателей AsyncDatabase по умолчанию
+READER_THREADS = 4
+
+
+# --- Фейковые объекты Telegram: записывают вызовы вместо сетевых запросов ---
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.username = f'user{user_id}'
+
+
+class FakeMessage:
+    message_ids = itertools.count(100)
+
+    def __init__(self, sent: list, text: str = None, message_id: int = None):
+        self.sent = sent
+        self.text = text
+        self.message_id = next(self.message_ids) if message_id is None else message_id
+
+    async def reply_text(self, text, **kwargs):
+        self.sent.append(('reply_text', text))
+        return FakeMessage(self.sent)
+
+    async def edit_text(self, text, **kwargs):
+        self.sent.append(('edit_text', text))
+
+    async def reply_photo(self, photo=None, caption=None, **kwargs):
+        self.sent.append(('reply_photo', caption))
+        return FakeMessage(self.sent)
+
+    async def delete(self):
+        self.sent.append(('delete', None))
+
+
+class FakeCallbackQuery:
+    def __init__(self, user: FakeUser, data: str, message: FakeMessage, edit_delay: float = 0.0):
+        self.from_user = user
+        self.data = data
+        self.message = message
+        self.edit_delay = edit_delay
+
+    async def answer(self, text=None, **kwargs):
+        self.message.sent.append(('answer', text))
+
+    async def edit_message_media(self, media, **kwargs):
+        await asyncio.sleep(self.edit_delay)
+        self.message.sent.append(('edit_message_media', media.caption))
+
+    async def edit_message_caption(self, caption=None, **kwargs):
+        await asyncio.sleep(self.edit_delay)
+        self.message.sent.append(('edit_message_caption', caption))
+
+
+class FakeUpdate:
+    def __init__(self, user_id: int, text: str = None, callback_data: str = None, sent: list = None,
+                 message_id: int = None):
+        self.sent = [] if sent is None else sent
+        self.effective_user = FakeUser(user_id)
+        self.message = FakeMessage(self.sent, text, message_id)
+        self.callback_query = (FakeCallbackQuery(self.effective_user, callback_data, self.message)
+                               if callback_data else None)
+        if self.callback_query:
+            self.message = None
+
+    @property
+    def effective_message(self):
+        return self.callback_query.message if self.callback_query else self.message
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+class FakeContext:
+    def __init__(self, user_data: dict = None):
+        self.bot = FakeBot()
+        self.user_data = user_data if user_data is not None else {}
+
+
+def last_card_message(context):
+    """id последнего отправленного ботом сообщения с карточкой"""
+    return list(context.user_data['card_messages'])[-1]
+
+
+# --- Фикстуры ---
+
+@pytest.fixture(scope='module')
+def bot():
+    """Модуль bot поверх временной БД (настройки читаются из окружения при импорте)"""
+    directory = tempfile.mkdtemp(prefix='psymatch-budget-')
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(ROOT)
+        mp.setenv('BOT_TOKEN', 'test')
+        mp.setenv('ADMIN_IDS', str(ADMIN_ID))
+        mp.setenv('DATABASE_PATH', os.path.join(directory, 'bot.db'))
+        mp.setenv('LOG_FILE', os.path.join(directory, 'bot.log'))
+        mp.setenv('METRICS_PATH', os.path.join(directory, 'metrics.json'))
+        mp.setenv('SLOW_QUERY_LOG', os.path.join(directory, 'slow.log'))
+        mp.setenv('MATCH_RANKING_MODE', 'materialized')
+        mp.setenv('VECTOR_STORE_PATH', '')
+        module = importlib.import_module('bot')
+    yield module
+    module.adb.close()
+    module.db.close()
+    for name in os.listdir(directory):
+        os.unlink(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+@pytest.fixture
+def seeded(bot):
+    """Пациент, админ и три психолога с профилями и совместимостью; включен подбор"""
+    db = bot.db
+    with db.transaction() as cursor:
+        for table in ('likes', 'matches', 'test_results', 'patient_profiles',
+                      'psychologist_profiles', 'user_actions', 'users'):
+            cursor.execute(f'DELETE FROM {table}')
+    bot.action_log._queue.clear()
+
+    for user_id in PSYCHOLOGIST_IDS:
+        db.create_user(user_id, f'psych{user_id}', 'psychologist')
+        db.save_psychologist_profile(user_id, f'Психолог {user_id}', f'photo_{user_id}',
+                                     'МГУ', '5 лет', f'@psych{user_id}')
+        db.save_test_result(user_id, [1.0, 0.5 * user_id, 0.0])
+    for user_id in (PATIENT_ID, ADMIN_ID):
+        db.create_user(user_id, f'patient{user_id}', 'patient')
+        db.save_patient_profile(user_id, 'Тревога', f'@patient{user_id}')
+        db.save_test_result(user_id, [1.0, 1.0, 0.0])
+    db.set_feature_flag('psychological_test_and_matching', True)
+    bot.matching_system.recalculate_all_matches()
+
+    # Прогрев: у писателя и у каждого читателя уже есть постоянное соединение, как в работающем боте
+    barrier = threading.Barrier(READER_THREADS)
+
+    def connect_reader():
+        db.get_connection()
+        barrier.wait(timeout=5)
+
+    async def warm_up():
+        await bot.adb.run_write(db.get_connection)
+        await asyncio.gather(*(bot.adb.run_read(connect_reader) for _ in range(READER_THREADS)))
+
+    asyncio.run(warm_up())
+    return bot
+
+
+@pytest.fixture
+def run_within_budget(seeded):
+    """
+    Выполнить обработчик бота на фейковом апдейте и проверить его бюджет из
+    bot.QUERY_BUDGETS; новых соединений апдейт открывать не должен.
+    Сообщения из очереди отправки доставляются в context.bot, а фоновые
+    перерисовки карточек завершаются до возврата.
+    Возвращает QueryBudget с фактическими счетчиками.
+    """
+    def run(name: str, update: FakeUpdate, context: FakeContext = None):
+        handler = getattr(seeded, name)
+        context = context or FakeContext()
+
+        async def scenario():
+            seeded.outbound.start(context.bot)
+            with query_budget.track(name, seeded.QUERY_BUDGETS[name], max_opened=0) as budget:
+                await handler(update, context)
+            await seeded.card_renders.drain()
+            await seeded.outbound.stop()
+            return budget
+
+        budget = asyncio.run(scenario())
+        budget.check()
+        return budget
+    return run
+
+
+# --- Счетчик ---
+
+def test_track_counts_queries_and_connections():
+    """Тест подсчета запросов, соединений и отчета о превышении"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as f:
+        db_path = f.name
+    try:
+        with query_budget.track('init', max_opened=0) as budget:
+            db = Database(db_path)
+        assert budget.opened == 1
+        assert budget.connections == 1
+        # Настройка соединения (PRAGMA) не считается запросами
+        assert not any(sql.startswith('PRAGMA busy_timeout') for sql in budget.statements)
+        assert budget.violations() == ['1 opened connections > 0']
+
+        with query_budget.track('reads', max_queries=1) as budget:
+            db.get_user(1)
+            db.get_user(2)
+            db.get_connection().execute('SELECT 1').fetchone()
+        assert budget.queries == 3
+        assert budget.opened == 0
+        assert budget.violations() == ['3 queries > 1']
+        with pytest.raises(QueryBudgetExceeded, match=r'2 × SELECT \* FROM users WHERE user_id = \?'):
+            budget.check()
+
+        # Вне блока запросы не учитываются
+        db.get_user(3)
+        assert budget.queries == 3
+        assert query_budget.current() is None
+        db.close()
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.unlink(db_path + suffix)
+
+
+def test_budget_follows_database_threads(seeded):
+    """Тест: запросы из потоков AsyncDatabase попадают в бюджет апдейта"""
+    async def scenario():
+        with query_budget.track('threads') as budget:
+            await asyncio.gather(seeded.adb.get_user(PATIENT_ID), seeded.adb.get_user(ADMIN_ID))
+            await seeded.adb.update_card_index(PATIENT_ID, 0)
+        return budget
+
+    budget = asyncio.run(scenario())
+    assert budget.queries >= 3
+    assert 1 <= budget.connections <= 3
+
+
+# --- Бюджеты обработчиков ---
+
+def test_handler_budgets_cover_every_handler(bot):
+    """Тест: у каждого бюджета есть обработчик"""
+    for name in bot.QUERY_BUDGETS:
+        assert callable(getattr(bot, name))
+
+
+def test_start_budget(run_within_budget):
+    update = FakeUpdate(PATIENT_ID, text='/start')
+    budget = run_within_budget('start', update)
+    assert update.sent[-1][0] == 'reply_text'
+    assert budget.opened == 0
+
+
+def test_handle_text_budget(run_within_budget, seeded):
+    """Тест: вложенный обработчик считается в бюджет внешнего"""
+    update = FakeUpdate(PATIENT_ID, text=seeded.MESSAGES['button_browse'])
+    budget = run_within_budget('handle_text', update)
+    assert update.sent[-1][0] == 'reply_photo'
+    assert budget.name == 'handle_text'
+
+
+def test_browse_and_navigation_budget(run_within_budget):
+    update = FakeUpdate(PATIENT_ID, text='browse')
+    context = FakeContext()
+    run_within_budget('browse_psychologists', update, context)
+    assert update.sent[-1][0] == 'reply_photo'
+    card_message = last_card_message(context)
+
+    # Листание редактирует сообщение с карточкой, а не удаляет его и не шлет новое
+    update = FakeUpdate(PATIENT_ID, callback_data='card_next', message_id=card_message)
+    run_within_budget('card_navigation', update, context)
+    assert [kind for kind, _ in update.sent] == ['answer', 'edit_message_media']
+    assert context.user_data['card_messages'][card_message]['cursor']['index'] == 1
+
+
+def test_each_card_message_keeps_its_cursor(run_within_budget, seeded):
+    """Тест: кнопки старого сообщения с карточкой листают от его карточки, а не от последней показанной"""
+    context = FakeContext()
+
+    def tap(message_id, data):
+        update = FakeUpdate(PATIENT_ID, callback_data=data, message_id=message_id)
+        run_within_budget('card_navigation', update, context)
+        return context.user_data['card_messages'][message_id]['cursor']['index']
+
+    run_within_budget('browse_psychologists', FakeUpdate(PATIENT_ID, text='browse'), context)
+    first = last_card_message(context)
+    assert tap(first, 'card_next') == 1
+    run_within_budget('browse_psychologists', FakeUpdate(PATIENT_ID, text='browse'), context)
+    second = last_card_message(context)
+
+    assert tap(first, 'card_next') == 2
+    assert tap(second, 'card_next') == 1
+    assert tap(first, 'card_prev_2') == 1
+
+
+def test_rapid_card_taps_are_coalesced(seeded):
+    """Тест: из серии быстрых нажатий рисуется текущая и только последняя карточка"""
+    context = FakeContext()
+    asyncio.run(seeded.browse_psychologists(FakeUpdate(PATIENT_ID, text='browse'), context))
+    card_message = last_card_message(context)
+    sent = []
+
+    async def scenario():
+        for data in ('card_next_0', 'card_next_1', 'card_prev_2', 'card_next_1'):
+            update = FakeUpdate(PATIENT_ID, callback_data=data, sent=sent, message_id=card_message)
+            update.callback_query.edit_delay = 0.05
+            await seeded.card_navigation(update, context)
+        await seeded.card_renders.drain()
+
+    coalesced = seeded.card_renders.coalesced
+    asyncio.run(scenario())
+    edits = [caption for kind, caption in sent if kind.startswith('edit_message')]
+    # Первое нажатие рисуется сразу, промежуточные (2 и 1) пропускаются, последнее рисуется
+    assert context.user_data['card_messages'][card_message]['cursor']['index'] == 2
+    assert len(edits) == 2
+    assert seeded.card_renders.coalesced - coalesced == 2
+    last_card = asyncio.run(seeded.adb.get_psychologists_page(PATIENT_ID, limit=3))[2]
+    assert last_card['name'] in edits[-1]
+    assert [kind for kind, _ in sent].count('answer') == 4
+
+
+def test_card_edit_follows_photo_of_tapped_message(seeded):
+    """Тест: выбор между заменой подписи и фото зависит от сообщения, в котором нажата кнопка"""
+    context = FakeContext()
+    seeded.card_message_state(context, 1)['photo'] = 'photo_1'
+    seeded.card_message_state(context, 2)['photo'] = 'photo_2'
+
+    def render(message_id, photo):
+        update = FakeUpdate(PATIENT_ID, callback_data='card_next', message_id=message_id)
+        asyncio.run(seeded.render_psychologist_card(update, context, photo, photo, None))
+        return update.sent[-1][0]
+
+    # Последнее показанное пользователю фото (photo_2) не относится к сообщению 1
+    assert render(1, 'photo_2') == 'edit_message_media'
+    assert render(1, 'photo_2') == 'edit_message_caption'
+    # Неизвестное сообщение (например, после перезапуска бота) — всегда замена фото
+    assert render(3, 'photo_2') == 'edit_message_media'
+
+
+def test_card_edit_falls_back_to_new_message(run_within_budget, seeded):
+    """Тест: если карточку нельзя отредактировать, она отправляется заново; «не изменено» — не ошибка"""
+    from telegram.error import BadRequest
+
+    context = FakeContext()
+    run_within_budget('browse_psychologists', FakeUpdate(PATIENT_ID, text='browse'), context)
+
+    async def cannot_edit(*args, **kwargs):
+        raise BadRequest("Message can't be edited")
+
+    update = FakeUpdate(PATIENT_ID, callback_data='card_next_0')
+    update.callback_query.edit_message_media = cannot_edit
+    run_within_budget('card_navigation', update, context)
+    assert [kind for kind, _ in update.sent] == ['answer', 'delete', 'reply_photo']
+
+    async def not_modified(*args, **kwargs):
+        raise BadRequest('Message is not modified: specified new message content is the same')
+
+    update = FakeUpdate(PATIENT_ID, callback_data='card_prev_1')
+    update.callback_query.edit_message_media = not_modified
+    run_within_budget('card_navigation', update, context)
+    assert [kind for kind, _ in update.sent] == ['answer']
+
+
+def test_like_budget(run_within_budget):
+    context = FakeContext()
+    run_within_budget('like_psychologist', FakeUpdate(PATIENT_ID, callback_data='like_1'), context)
+    assert context.bot.sent[-1][0] == 1
+
+    # Ответный лайк психолога — взаимный, уведомления обоим
+    context = FakeContext()
+    budget = run_within_budget('like_psychologist', FakeUpdate(1, callback_data=f'like_{PATIENT_ID}'), context)
+    assert {chat_id for chat_id, _ in context.bot.sent} == {1, PATIENT_ID}
+    # Лайк целиком — одна транзакция: вставка, отметка встречного лайка и чтение профилей
+    assert budget.statements.count('BEGIN IMMEDIATE') == 1
+    
+    # Повторный лайк отсекается самой вставкой
+    update = FakeUpdate(1, callback_data=f'like_{PATIENT_ID}')
+    budget = run_within_budget('like_psychologist', update)
+    assert update.sent[-1] == ('reply_text', 'Вы уже лайкнули этого пользователя')
+    assert budget.queries == 2
+
+
+def test_my_likes_budget(run_within_budget, seeded):
+    seeded.db.create_like(PATIENT_ID, 1)
+    seeded.db.create_like(ADMIN_ID, 1)
+    update = FakeUpdate(1, text='likes')
+    context = FakeContext()
+    run_within_budget('show_my_likes', update, context)
+    assert update.sent
+
+    likes_message = last_card_message(context)
+    update = FakeUpdate(1, callback_data='patient_next_0', message_id=likes_message)
+    run_within_budget('patient_card_navigation', update, context)
+    assert update.sent[-1][0] == 'edit_text'
+    assert context.user_data['card_messages'][likes_message]['likes_cursor']['index'] == 1
+
+
+def test_statistics_budget(run_within_budget):
+    update = FakeUpdate(ADMIN_ID, text='stats')
+    run_within_budget('show_statistics', update)
+    assert update.sent[-1][0] == 'reply_text'
+
+
+def test_reload_messages(run_within_budget, seeded, monkeypatch, tmp_path):
+    """Тест: /reload_messages (только админ) обновляет тексты и сбрасывает кэш подписей карточек"""
+    messages = dict(seeded.MESSAGES)
+    messages['card_psychologist_template'] = 'Новая карточка: ' + messages['card_psychologist_template']
+    path = tmp_path / 'messages.json'
+    path.write_text(json.dumps(messages, ensure_ascii=False), encoding='utf-8')
+    monkeypatch.setattr(seeded, 'MESSAGES_PATH', str(path))
+    
+    def browse():
+        update = FakeUpdate(PATIENT_ID, text='browse')
+        run_within_budget('browse_psychologists', update, FakeContext())
+        return update.sent[-1][1]
+    
+    try:
+        assert not browse().startswith('Новая карточка')
+        asyncio.run(seeded.reload_messages_command(FakeUpdate(PATIENT_ID, text='/reload_messages'), FakeContext()))
+        assert not browse().startswith('Новая карточка')
+        
+        update = FakeUpdate(ADMIN_ID, text='/reload_messages')
+        asyncio.run(seeded.reload_messages_command(update, FakeContext()))
+        assert update.sent[-1] == ('reply_text', '✅ Тексты перечитаны')
+        assert browse().startswith('Новая карточка')
+        
+        # Файл без нужного ключа отклоняется целиком: тексты и кэш остаются прежними
+        del messages['button_prev']
+        path.write_text(json.dumps(messages, ensure_ascii=False), encoding='utf-8')
+        update = FakeUpdate(ADMIN_ID, text='/reload_messages')
+        asyncio.run(seeded.reload_messages_command(update, FakeContext()))
+        assert update.sent[-1][1].startswith('❌')
+        assert 'button_prev' in seeded.MESSAGES
+        assert browse().startswith('Новая карточка')
+    finally:
+        monkeypatch.undo()
+        seeded.reload_messages()
+    assert not browse().startswith('Новая карточка')
+
+
+def test_budget_regression_fails(run_within_budget, seeded, monkeypatch):
+    """Тест: лишние запросы в обработчике валят проверку бюджета"""
+    get_user = seeded.adb.get_user
+
+    async def get_user_twice(user_id):
+        await get_user(user_id)
+        return await get_user(user_id)
+
+    monkeypatch.setattr(seeded.adb, 'get_user', get_user_twice)
+    budget = seeded.QUERY_BUDGETS['start']
+    with pytest.raises(QueryBudgetExceeded, match=f'queries > {budget}'):
+        run_within_budget('start', FakeUpdate(PATIENT_ID, text='/start'))
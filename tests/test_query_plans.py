@@ -0,0 +1,143 @@
+"""
+Регрессионный тест планов запросов: горячие запросы не должны сканировать таблицы целиком.
+
+Запросы перехватываются через set_trace_callback во время вызова методов Database,
+поэтому проверяется ровно тот SQL, который выполняет код.
+"""
+
+import os
+import re
+import sys
+import json
+import tempfile
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import Database
+
+
+# Полный проход допустим только по этим таблицам (маленькие справочники);
+# CONSTANT — строка SELECT без FROM, а не таблица
+ALLOWED_SCANS = {'feature_flags', 'CONSTANT'}
+
+
+@pytest.fixture
+def db():
+    """Создает временную БД с небольшим набором данных"""
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as f:
+        db_path = f.name
+    
+    database = Database(db_path)
+    database.create_user(1, 'patient1', 'patient')
+    database.save_patient_profile(1, 'Тревога', '@patient1')
+    database.save_test_result(1, json.dumps([1.0, 0.0]))
+    for user_id in (2, 3):
+        database.create_user(user_id, f'psych{user_id}', 'psychologist')
+        database.save_psychologist_profile(user_id, 'Психолог', 'photo', 'МГУ', '5 лет', '@p')
+        database.save_test_result(user_id, json.dumps([1.0, 0.0]))
+        database.save_match(1, user_id, 50.0 + user_id)
+    database.create_like(1, 2)
+    database.log_action(1, 'command_start')
+    yield database
+    database.close()
+    
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def capture_statements(db, call):
+    """Выполняет call() и возвращает выполненные SELECT/INSERT/UPDATE/DELETE"""
+    statements = []
+    conn = db.get_connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        conn.set_trace_callback(None)
+    return [
+        statement for statement in statements
+        if re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', statement, re.IGNORECASE)
+    ]
+
+
+def query_plan(db, statement):
+    return [row['detail'] for row in db.get_connection().execute('EXPLAIN QUERY PLAN ' + statement)]
+
+
+def full_scans(db, statement):
+    """Таблицы, которые план запроса читает полным проходом (проход по результату CTE не в счет)"""
+    ctes = set(re.findall(r'(\w+)\s+AS\s*\(', statement, re.IGNORECASE))
+    scans = set()
+    for detail in query_plan(db, statement):
+        match = re.match(r'SCAN (\w+)', detail)
+        if match and match.group(1) not in ctes:
+            scans.add(match.group(1))
+    return scans
+
+
+def table_name(db, alias_or_table, statement):
+    """Имя таблицы по алиасу из запроса (SCAN в плане показывает алиас)"""
+    match = re.search(rf'(\w+)\s+(?:AS\s+)?{alias_or_table}\b', statement)
+    if match and match.group(1).upper() not in ('FROM', 'JOIN', 'AS'):
+        return match.group(1)
+    return alias_or_table
+
+
+HOT_CALLS = {
+    'get_user': lambda db: db.get_user(1),
+    'get_test_result': lambda db: db.get_test_result(1),
+    'get_test_results': lambda db: db.get_test_results('psychologist'),
+    'get_test_vector': lambda db: db.get_test_vector(1),
+    'get_test_vectors': lambda db: db.get_test_vectors('psychologist'),
+    'get_match_percentage': lambda db: db.get_match_percentage(1, 2),
+    'get_psychologists_for_patient': lambda db: db.get_psychologists_for_patient(1),
+    'get_psychologists_page': lambda db: db.get_psychologists_page(1, (52.0, 2), 'next'),
+    'get_psychologists_page_prev': lambda db: db.get_psychologists_page(1, (52.0, 2), 'prev'),
+    'get_likes_for_psychologist': lambda db: db.get_likes_for_psychologist(2),
+    'get_likes_page': lambda db: db.get_likes_page(2, ('2000-01-01 00:00:00', 1), 'next'),
+    'count_likes_for_psychologist': lambda db: db.count_likes_for_psychologist(2),
+    'get_patient_info': lambda db: db.get_patient_info(1),
+    'get_psychologist_info': lambda db: db.get_psychologist_info(2),
+    'get_card_index': lambda db: db.get_card_index(1),
+    'update_card_index': lambda db: db.update_card_index(1, 3),
+    'update_last_active_bulk': lambda db: db.update_last_active_bulk([(1, '2999-01-01 00:00:00')]),
+    'create_like': lambda db: db.create_like(3, 1),
+    'create_like_enriched': lambda db: db.create_like_enriched(2, 1),
+    'get_all_psychologists': lambda db: db.get_all_psychologists(),
+    'delete_user_profile': lambda db: db.delete_user_profile(3),
+    'get_statistics': lambda db: db.get_statistics(),
+    'get_users_page': lambda db: db.get_users_page(('2999-01-01 00:00:00', 9), user_type='patient'),
+    'get_user_activity_summary': lambda db: db.get_user_activity_summary(1),
+}
+
+
+@pytest.mark.parametrize('matching_enabled', [True, False])
+@pytest.mark.parametrize('name', sorted(HOT_CALLS))
+def test_hot_query_has_no_full_scan(db, name, matching_enabled):
+    """Тест что горячий запрос использует индексы"""
+    db.set_feature_flag('psychological_test_and_matching', matching_enabled)
+    statements = capture_statements(db, lambda: HOT_CALLS[name](db))
+    assert statements, f"{name}: no statements captured"
+    
+    for statement in statements:
+        scanned = {table_name(db, alias, statement) for alias in full_scans(db, statement)}
+        assert not scanned - ALLOWED_SCANS, f"{name}: full scan of {scanned} in\n{statement}"
+
+
+# Постраничные запросы должны отдавать строки в порядке индекса, без сортировки всего набора
+KEYSET_CALLS = ['get_psychologists_page', 'get_psychologists_page_prev', 'get_likes_page', 'get_users_page']
+
+
+@pytest.mark.parametrize('matching_enabled', [True, False])
+@pytest.mark.parametrize('name', KEYSET_CALLS)
+def test_keyset_page_uses_index_order(db, name, matching_enabled):
+    """Тест что keyset-страницы не сортируются через временное B-дерево"""
+    db.set_feature_flag('psychological_test_and_matching', matching_enabled)
+    for statement in capture_statements(db, lambda: HOT_CALLS[name](db)):
+        if 'LIMIT' not in statement:
+            continue
+        plan = query_plan(db, statement)
+        assert not any('TEMP B-TREE' in detail for detail in plan), f"{name}: {plan}"
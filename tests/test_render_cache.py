@@ -0,0 +1,122 @@
+"""
+Тесты для render_cache.py (подписи карточек и готовые клавиатуры)
+"""
+
+import sys
+import json
+import pytest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from render_cache import RenderCache
+
+ROOT = Path(__file__).parent.parent
+MESSAGES = json.loads((ROOT / 'messages.json').read_text(encoding='utf-8'))
+QUESTIONS = json.loads((ROOT / 'test_questions.json').read_text(encoding='utf-8'))
+
+
+def make_psychologist(**overrides):
+    psychologist = {
+        'user_id': 7, 'profile_version': 1, 'name': 'Анна {не поле}', 'gender': 'Женский',
+        'age': 30, 'education': 'МГУ', 'about_me': None, 'approach': 'КПТ',
+        'work_requests': 'Тревога', 'price': '2000', 'experience': '5 лет',
+    }
+    psychologist.update(overrides)
+    return psychologist
+
+
+def plain_caption(psychologist, template, **fields):
+    """Подпись так, как ее собирал бот без кэша"""
+    return MESSAGES[template].format(
+        name=psychologist['name'],
+        gender=psychologist.get('gender', 'Не указано'),
+        age=psychologist.get('age', 'Не указано'),
+        education=psychologist['education'],
+        about_me=psychologist.get('about_me', 'Не указано'),
+        approach=psychologist.get('approach', 'Не указано'),
+        work_requests=psychologist.get('work_requests', 'Не указано'),
+        price=psychologist.get('price', 'Не указано'),
+        experience=psychologist['experience'],
+        **fields
+    )
+
+
+def test_caption_matches_template_and_is_cached():
+    """Тест: подпись совпадает с прямым форматированием шаблона, совместимость подставляется при показе"""
+    cache = RenderCache(MESSAGES, QUESTIONS)
+    psychologist = make_psychologist()
+    
+    for match in (87, 42):
+        assert cache.caption(psychologist, 'match', match=match) == \
+            plain_caption(psychologist, 'card_psychologist_template', match=match)
+    assert cache.caption(psychologist, 'no_match') == \
+        plain_caption(psychologist, 'card_psychologist_template_no_match')
+    assert cache.counters()['misses'] == 2
+    assert cache.counters()['hits'] == 1
+
+
+def test_caption_follows_profile_version_and_invalidate():
+    cache = RenderCache(MESSAGES, QUESTIONS)
+    cache.caption(make_psychologist(), 'no_match')
+    
+    # Новая версия профиля — новая подпись, даже без явного сброса
+    updated = make_psychologist(profile_version=2, experience='6 лет')
+    assert '6 лет' in cache.caption(updated, 'no_match')
+    assert cache.counters()['captions'] == 2
+    
+    cache.card_keyboard(7, False, False, True)
+    cache.caption(make_psychologist(user_id=8), 'no_match')
+    cache.invalidate(7)
+    assert cache.counters()['captions'] == 1
+    assert cache.counters()['keyboards'] == 0
+
+
+def test_card_keyboards_are_shared():
+    cache = RenderCache(MESSAGES, QUESTIONS)
+    keyboard = cache.card_keyboard(7, False, True, True)
+    assert cache.card_keyboard(7, False, True, True) is keyboard
+    
+    nav, like = keyboard.inline_keyboard
+    assert [button.callback_data for button in nav] == ['card_prev', 'card_next']
+    assert like[0].callback_data == 'like_7'
+    
+    liked = cache.card_keyboard(7, True, False, False)
+    assert [[button.callback_data for button in row] for row in liked.inline_keyboard] == [['already_liked']]
+
+
+def test_questions_prebuilt_and_reload():
+    """Тест готовых вопросов теста и перезагрузки текстов"""
+    cache = RenderCache(MESSAGES, QUESTIONS)
+    text, keyboard = cache.question(0)
+    assert text == MESSAGES['test_question_template'].format(
+        current=1, total=len(QUESTIONS), question=QUESTIONS[0]['question'])
+    assert [row[0].callback_data for row in keyboard.inline_keyboard] == \
+        [f'test_answer_0_{i}' for i in range(len(QUESTIONS[0]['options']))]
+    assert cache.question(len(QUESTIONS)) is None
+    
+    psychologist = make_psychologist()
+    cache.caption(psychologist, 'no_match')
+    messages = dict(MESSAGES, test_question_template='{current} из {total}: {question}',
+                    card_psychologist_template_no_match='{name} — {experience}',
+                    button_like='Нравится')
+    cache.reload(messages)
+    
+    assert cache.question(0)[0] == f"1 из {len(QUESTIONS)}: {QUESTIONS[0]['question']}"
+    assert cache.caption(psychologist, 'no_match') == 'Анна {не поле} — 5 лет'
+    assert cache.card_keyboard(7, False, False, False).inline_keyboard[0][0].text == 'Нравится'
+
+
+def test_invalid_reload_keeps_previous_texts():
+    """Тест: шаблон с ошибкой не заменяет тексты кэша"""
+    cache = RenderCache(MESSAGES, QUESTIONS)
+    psychologist = make_psychologist()
+    before = cache.caption(psychologist, 'no_match')
+    
+    for messages in ({k: v for k, v in MESSAGES.items() if k != 'button_prev'},
+                     dict(MESSAGES, card_psychologist_template_no_match='{name} {unknown}')):
+        with pytest.raises(ValueError):
+            cache.reload(messages)
+    
+    assert cache.caption(psychologist, 'no_match') == before
+    assert cache.card_keyboard(7, False, True, False).inline_keyboard[0][0].text == MESSAGES['button_prev']
@@ -0,0 +1,100 @@
+"""
+Тесты для sql_tracer.py
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import Database
+from sql_tracer import SQLTracer, describe_params, fingerprint, read_slow_log
+
+
+@pytest.fixture
+def db_path():
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as f:
+        path = f.name
+    yield path
+    for suffix in ('', '-wal', '-shm', '.slow.log'):
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+
+
+def test_fingerprint():
+    """Тест нормализации запросов"""
+    assert fingerprint("SELECT * FROM users\n   WHERE user_id = 42 AND name = 'O''Neil'") == \
+        'SELECT * FROM users WHERE user_id = ? AND name = ?'
+    assert fingerprint('DELETE FROM matches WHERE patient_id IN (?, ?, ?)') == \
+        'DELETE FROM matches WHERE patient_id IN (...)'
+    assert fingerprint("SELECT datetime('now', '-1 day') FROM user_actions") == \
+        'SELECT datetime(?, ?) FROM user_actions'
+
+
+def test_stats_and_slow_log(db_path):
+    """Тест агрегатов по отпечаткам, журнала медленных запросов и EXPLAIN"""
+    tracer = SQLTracer(slow_threshold_ms=0, log_path=db_path + '.slow.log')
+    db = Database(db_path, tracer=tracer)
+    try:
+        tracer.reset()
+        db.create_user(1, 'user1', 'patient')
+        db.create_user(2, 'user2', 'patient')
+        db.get_user(1)
+        db.get_user(2)
+        db.get_all_users_with_stats()
+        db.save_matches([(1, 2, 50.0)])
+        
+        stats = {row['fingerprint']: row for row in tracer.stats()}
+        assert stats['SELECT * FROM users WHERE user_id = ?']['count'] == 2
+        
+        slow = tracer.slow_queries()
+        assert slow and slow[0]['plan'] is not None
+        users_query = next(entry for entry in slow if 'likes_sent' in entry['sql'])
+        assert any('likes' in step for step in users_query['plan'])
+        insert = next(entry for entry in slow if entry['sql'].startswith('INSERT OR REPLACE INTO matches'))
+        assert insert['plan'] is not None
+        assert not any(step.startswith('EXPLAIN failed') for step in insert['plan'])
+        
+        # Соединение общее для execute на Connection и курсоров
+        db.get_connection().execute('SELECT COUNT(*) FROM likes').fetchone()
+        assert 'SELECT COUNT(*) FROM likes' in {row['fingerprint'] for row in tracer.stats()}
+        
+        logged = read_slow_log(db_path + '.slow.log', limit=5)
+        assert len(logged) == 5
+        assert logged[0]['fingerprint'] == tracer.slow_queries()[0]['fingerprint'] == 'SELECT COUNT(*) FROM likes'
+        
+        # Значения параметров (имена, контакты) в журнал не попадают — только число и типы
+        log_text = open(db_path + '.slow.log', encoding='utf-8').read()
+        assert 'user1' not in log_text
+        create = next(entry for entry in slow if entry['sql'].startswith('INSERT INTO users'))
+        assert create['params'].startswith(f"{create['sql'].count('?')}: int, str")
+    finally:
+        db.close()
+
+
+def test_threshold(db_path):
+    """Тест: быстрые запросы не попадают в журнал"""
+    tracer = SQLTracer(slow_threshold_ms=10_000)
+    db = Database(db_path, tracer=tracer)
+    try:
+        db.get_user(1)
+        assert tracer.slow_queries() == []
+        assert tracer.stats()
+    finally:
+        db.close()
+    assert read_slow_log(db_path + '.missing') == []
+
+
+def test_describe_params():
+    """Тест: параметры описываются без значений, сами значения — только с log_params"""
+    assert describe_params((1, 'secret@example.com', None)) == '3: int, str, NoneType'
+    assert describe_params({'since': '2024-01-01'}) == '1: since=str'
+    assert describe_params(()) is None
+    
+    tracer = SQLTracer(slow_threshold_ms=0, explain=False, log_params=True)
+    tracer.record('SELECT ?', ('secret',), 0.001, None)
+    assert tracer.slow_queries()[0]['params'] == "('secret',)"
@@ -0,0 +1,139 @@
+"""
+Тесты для vector_store.py
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from database import Database
+from matching import MatchingSystem
+from vector_store import VectorStore
+
+
+@pytest.fixture
+def store_path():
+    """Путь к временному файлу векторов"""
+    directory = tempfile.mkdtemp()
+    yield os.path.join(directory, 'test.vectors')
+    for name in os.listdir(directory):
+        os.unlink(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+@pytest.fixture
+def db(store_path):
+    """Создает временную БД рядом с файлом векторов"""
+    database = Database(store_path.replace('.vectors', '.db'))
+    yield database
+    database.close()
+
+
+def test_upsert_get_delete(store_path):
+    """Тест записи, замены и удаления векторов"""
+    store = VectorStore(store_path)
+    assert store.get(1) is None
+    assert len(store) == 0
+    
+    # Без файла upsert ничего не создает: файл со всеми пользователями пишет только rebuild()
+    assert not store.upsert(1, 'patient', [1.0, 0.0, 0.5])
+    assert store.header()['count'] == 0
+    assert store.score([1.0, 0.0, 0.5], 'patient')[0].tolist() == []
+    
+    assert store.rebuild([]) == 0
+    assert store.upsert(1, 'patient', [1.0, 0.0, 0.5])
+    assert store.upsert(2, 'psychologist', [0.0, 1.0, 0.0])
+    assert store.upsert(1, 'patient', [0.5, 0.5, 0.5])
+    
+    assert store.get(1).tolist() == [0.5, 0.5, 0.5]
+    assert len(store) == 2
+    assert store.header()['count'] == 3
+    
+    # Другая размерность хранится нулевой строкой: get() ее не отдает, score() дает 0%
+    assert not store.upsert(2, 'psychologist', [1.0])
+    assert store.get(2) is None
+    ids, scores = store.score([0.0, 1.0, 0.0], 'psychologist')
+    assert ids.tolist() == [2] and scores.tolist() == [0.0]
+    assert store.delete(1)
+    assert not store.delete(1)
+    assert len(store) == 1
+
+
+def test_growth_and_readers_see_replacement(store_path):
+    """Тест роста файла через compact и переоткрытия файла читателем"""
+    writer = VectorStore(store_path, initial_capacity=4)
+    reader = VectorStore(store_path)
+    writer.rebuild([(1, 'psychologist', [1.0, 0.0])])
+    
+    assert reader.get(1).tolist() == [1.0, 0.0]
+    generation = reader.header()['generation']
+    
+    for user_id in range(2, 20):
+        writer.upsert(user_id, 'psychologist', [float(user_id), 1.0])
+        writer.delete(user_id - 1)
+    
+    header = reader.header()
+    assert header['generation'] > generation
+    assert header['capacity'] >= 4
+    assert len(reader) == 1
+    assert reader.get(19).tolist() == [19.0, 1.0]
+    
+    assert writer.compact() == 1
+    assert reader.header()['count'] == 1
+
+
+def test_matching_scores_from_store(db, store_path):
+    """Тест: расчет по vector_store совпадает с расчетом по SQLite"""
+    rng = np.random.default_rng(5)
+    for user_id in range(1, 31):
+        db.create_user(user_id, f'user{user_id}', 'patient' if user_id <= 5 else 'psychologist')
+        db.save_test_result(user_id, rng.uniform(-1, 1, 6).round(2))
+    
+    exact = MatchingSystem(db)
+    matching_system = MatchingSystem(db, vector_store=VectorStore(store_path))
+    assert matching_system.sync_vector_store() == 30
+    
+    for patient_id in range(1, 6):
+        expected_ids, expected_scores = exact.calculate_scores_for_patient(patient_id)
+        ids, scores = matching_system.calculate_scores_for_patient(patient_id)
+        assert ids.tolist() == expected_ids.tolist()
+        assert np.allclose(scores, expected_scores, atol=0.1)
+    
+    # Новый вектор и блокировка попадают в файл через update_user
+    db.save_test_result(6, [1.0] * 6)
+    matching_system.update_user(6)
+    assert matching_system.vector_store.get(6).tolist() == [1.0] * 6
+    db.block_user(7)
+    matching_system.update_user(7)
+    assert matching_system.vector_store.get(7) is None
+    assert 7 not in matching_system.calculate_scores_for_patient(1)[0].tolist()
+
+
+def test_mismatched_dimensions_score_zero(db, store_path):
+    """Тест: векторы другой размерности получают 0%, как в точном расчете, а не пропадают"""
+    vectors = {1: [1.0, 0.0, 1.0], 2: [1.0, 0.0], 3: [1.0, 1.0, 0.0], 4: [0.0, 1.0, 1.0], 5: [2.0, 1.0]}
+    for user_id, vector in vectors.items():
+        db.create_user(user_id, f'user{user_id}', 'patient' if user_id <= 2 else 'psychologist')
+        db.save_test_result(user_id, vector)
+    
+    exact = MatchingSystem(db)
+    matching_system = MatchingSystem(db, vector_store=VectorStore(store_path))
+    matching_system.sync_vector_store()
+    
+    for patient_id in (1, 2):
+        expected_ids, expected_scores = exact.calculate_scores_for_patient(patient_id)
+        ids, scores = matching_system.calculate_scores_for_patient(patient_id)
+        assert ids.tolist() == expected_ids.tolist() == [3, 4, 5]
+        assert np.allclose(scores, expected_scores, atol=0.1)
+    assert matching_system.calculate_scores_for_patient(1)[1][2] == 0.0
+    
+    # Сам файл на запрос другой размерности отвечает нулями по всем психологам,
+    # MatchingSystem для такого запроса считает по SQLite
+    ids, scores = matching_system.vector_store.score([2.0, 1.0], 'psychologist')
+    assert ids.tolist() == [3, 4, 5] and scores.tolist() == [0.0, 0.0, 0.0]
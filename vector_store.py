@@ -0,0 +1,289 @@
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+from matching import cosine_to_percentage
+
+logger = logging.getLogger(__name__)
+
+# Заголовок файла: magic, версия, размерность, резерв, емкость, число строк, поколение
+MAGIC = b'PSVS'
+VERSION = 1
+HEADER = struct.Struct('<4sIIIQQQ')
+HEADER_SIZE = 64
+COUNT_OFFSET = struct.calcsize('<4sIIIQ')
+
+# Тип строки: 0 — удалена (tombstone)
+TOMBSTONE = 0
+KINDS = {'patient': 1, 'psychologist': 2}
+
+
+def _align(offset: int, alignment: int) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _layout(capacity: int, dim: int) -> Tuple[int, int, int, int, int]:
+    """Смещения секций (ids, kinds, norms, matrix) и полный размер файла"""
+    ids = HEADER_SIZE
+    kinds = ids + 8 * capacity
+    norms = _align(kinds + capacity, 4)
+    matrix = _align(norms + 4 * capacity, 64)
+    return ids, kinds, norms, matrix, matrix + 4 * capacity * dim
+
+
+class VectorStore:
+    """
+    Файл векторов пользователей рядом с БД, общий для процессов бота и админки.
+
+    Формат (little-endian): заголовок на 64 байта, затем ids int64[capacity],
+    kinds uint8[capacity], norms float32[capacity] и матрица float32[capacity × dim].
+    Файл открывается через mmap, поэтому все процессы читают одну копию из page cache.
+
+    Запись только дописывает строки в конец: новая версия вектора пользователя
+    добавляется строкой, старая помечается tombstone, и лишь затем увеличивается
+    счетчик строк в заголовке. Когда емкость кончается, живые строки переписываются
+    (compact) во временный файл с запасом емкости, который атомарно подменяет
+    старый через os.replace, а поколение в заголовке увеличивается. Читатели
+    замечают подмену по inode и переоткрывают файл. Писатели (бот и админка)
+    сериализуются блокировкой fcntl на файле path + '.lock'.
+
+    Размерность у файла одна. Пользователь с вектором другой размерности хранится
+    нулевой строкой с нулевой нормой: как и в точном расчете, он получает 0%
+    совместимости, но не пропадает из результатов score(); get() для него
+    возвращает None, и вектор читается из SQLite.
+    """
+
+    def __init__(self, path: str, initial_capacity: int = 1024):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.initial_capacity = initial_capacity
+        self._lock = threading.RLock()
+        self._mm: Optional[mmap.mmap] = None
+        self._inode: Optional[int] = None
+        self._index: Dict[int, int] = {}
+        self._indexed_rows = 0
+
+    # --- Открытие и заголовок ---
+
+    def _refresh(self) -> bool:
+        """Переоткрыть файл, если он появился или был подменен. False — файла нет"""
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            self._mm = None
+            self._inode = None
+            return False
+        if self._mm is not None and inode == self._inode:
+            return True
+
+        with open(self.path, 'r+b') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            # Старый mmap не закрываем явно: на него могут ссылаться выданные view
+            self._mm = mmap.mmap(f.fileno(), 0)
+        magic, version, dim, _, capacity, _, generation = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Not a vector store file: {self.path}")
+
+        ids, kinds, norms, matrix, _ = _layout(capacity, dim)
+        self._inode = inode
+        self.dim = dim
+        self.capacity = capacity
+        self.generation = generation
+        self._ids = np.frombuffer(self._mm, dtype='<i8', count=capacity, offset=ids)
+        self._kinds = np.frombuffer(self._mm, dtype=np.uint8, count=capacity, offset=kinds)
+        self._norms = np.frombuffer(self._mm, dtype='<f4', count=capacity, offset=norms)
+        self._matrix = np.frombuffer(
+            self._mm, dtype='<f4', count=capacity * dim, offset=matrix
+        ).reshape(capacity, dim)
+        self._index = {}
+        self._indexed_rows = 0
+        return True
+
+    def _count(self) -> int:
+        return struct.unpack_from('<Q', self._mm, COUNT_OFFSET)[0]
+
+    def _row_of(self, user_id: int) -> Optional[int]:
+        """Строка живой версии вектора пользователя (индекс дополняется только новыми строками)"""
+        count = self._count()
+        if self._indexed_rows < count:
+            new_ids = self._ids[self._indexed_rows:count].tolist()
+            for row, row_user_id in enumerate(new_ids, start=self._indexed_rows):
+                self._index[row_user_id] = row
+            self._indexed_rows = count
+        row = self._index.get(user_id)
+        if row is None or self._kinds[row] == TOMBSTONE:
+            return None
+        return row
+
+    def header(self) -> Dict[str, int]:
+        with self._lock:
+            if not self._refresh():
+                return {'dim': 0, 'capacity': 0, 'count': 0, 'generation': 0}
+            return {'dim': self.dim, 'capacity': self.capacity,
+                    'count': self._count(), 'generation': self.generation}
+
+    # --- Запись ---
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        with self._lock, open(self.lock_path, 'a+b') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _write_file(self, rows: Sequence[Tuple[int, int, np.ndarray]], dim: int,
+                    capacity: int, generation: int):
+        """Записать файл целиком во временный файл и атомарно подменить им текущий"""
+        capacity = max(capacity, len(rows), 1)
+        ids, kinds, norms, matrix, size = _layout(capacity, dim)
+        tmp_path = f'{self.path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w+b') as f:
+            f.truncate(size)
+            with mmap.mmap(f.fileno(), size) as mm:
+                HEADER.pack_into(mm, 0, MAGIC, VERSION, dim, 0, capacity, len(rows), generation)
+                if rows:
+                    np.frombuffer(mm, dtype='<i8', count=len(rows), offset=ids)[:] = [row[0] for row in rows]
+                    np.frombuffer(mm, dtype=np.uint8, count=len(rows), offset=kinds)[:] = [row[1] for row in rows]
+                    vectors = np.stack([row[2] for row in rows]).astype('<f4')
+                    np.frombuffer(mm, dtype='<f4', count=len(rows), offset=norms)[:] = np.linalg.norm(
+                        vectors.astype(np.float64), axis=1
+                    )
+                    np.frombuffer(mm, dtype='<f4', count=len(rows) * dim, offset=matrix)[:] = vectors.reshape(-1)
+                mm.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._refresh()
+
+    def _live_rows(self) -> list:
+        count = self._count()
+        alive = np.flatnonzero(self._kinds[:count] != TOMBSTONE)
+        return [(int(self._ids[row]), int(self._kinds[row]), self._matrix[row].copy()) for row in alive]
+
+    def rebuild(self, rows: Iterable[Tuple[int, str, Sequence[float]]]) -> int:
+        """
+        Полностью пересобрать файл из (user_id, 'patient'|'psychologist', вектор).
+        Берется самая частая размерность, векторы другой размерности записываются нулевыми строками.
+        """
+        rows = [(int(user_id), KINDS[kind], np.asarray(vector, dtype='<f4').reshape(-1))
+                for user_id, kind, vector in rows]
+        if rows:
+            dims = [len(row[2]) for row in rows]
+            dim = max(set(dims), key=dims.count)
+        else:
+            dim = 0
+        mismatched = sum(1 for row in rows if len(row[2]) != dim)
+        rows = [row if len(row[2]) == dim else (row[0], row[1], np.zeros(dim, dtype='<f4')) for row in rows]
+
+        with self._write_lock():
+            generation = self.generation + 1 if self._refresh() else 1
+            self._write_file(rows, dim, max(self.initial_capacity, 2 * len(rows)), generation)
+        logger.info(f"Vector store rebuilt: {len(rows)} vectors, dim {dim} ({mismatched} of other dims)")
+        return len(rows)
+
+    def compact(self) -> int:
+        """Переписать файл без удаленных строк. Возвращает число живых строк"""
+        with self._write_lock():
+            if not self._refresh():
+                return 0
+            rows = self._live_rows()
+            self._write_file(rows, self.dim, max(self.initial_capacity, 2 * len(rows)), self.generation + 1)
+            return len(rows)
+
+    def upsert(self, user_id: int, kind: str, vector: Sequence[float]) -> bool:
+        """
+        Записать новую версию вектора. False — файла еще нет (его создает только rebuild(),
+        иначе score() принял бы одну строку за всех пользователей) или размерность
+        не совпала с файлом (записана нулевая строка)
+        """
+        vector = np.asarray(vector, dtype='<f4').reshape(-1)
+        with self._write_lock():
+            if not self._refresh():
+                return False
+            if self.dim == 0:
+                # Пустой файл после rebuild(): первый вектор задает размерность
+                self._write_file([(user_id, KINDS[kind], vector)], len(vector),
+                                 self.initial_capacity, self.generation + 1)
+                return True
+            matched = len(vector) == self.dim
+            if not matched:
+                vector = np.zeros(self.dim, dtype='<f4')
+
+            if self._count() >= self.capacity:
+                rows = [row for row in self._live_rows() if row[0] != user_id]
+                self._write_file(rows, self.dim, max(self.initial_capacity, 2 * (len(rows) + 1)),
+                                 self.generation + 1)
+
+            count = self._count()
+            self._ids[count] = user_id
+            self._kinds[count] = KINDS[kind]
+            self._norms[count] = np.linalg.norm(vector.astype(np.float64))
+            self._matrix[count] = vector
+            self._delete_locked(user_id)
+            # Счетчик публикуется последним: читатели видят строку только целиком
+            struct.pack_into('<Q', self._mm, COUNT_OFFSET, count + 1)
+            return matched
+
+    def _delete_locked(self, user_id: int) -> bool:
+        row = self._row_of(user_id)
+        if row is None:
+            return False
+        self._kinds[row] = TOMBSTONE
+        return True
+
+    def delete(self, user_id: int) -> bool:
+        with self._write_lock():
+            if not self._refresh():
+                return False
+            return self._delete_locked(user_id)
+
+    # --- Чтение ---
+
+    def get(self, user_id: int) -> Optional[np.ndarray]:
+        """Вектор пользователя (view поверх mmap) или None (в том числе для нулевой строки)"""
+        with self._lock:
+            if not self._refresh():
+                return None
+            row = self._row_of(user_id)
+            return None if row is None or self._norms[row] == 0 else self._matrix[row]
+
+    def __len__(self) -> int:
+        with self._lock:
+            if not self._refresh():
+                return 0
+            return int(np.count_nonzero(self._kinds[:self._count()]))
+
+    def vectors(self, kind: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(id, матрица, нормы) живых векторов типа (копии выбранных строк)"""
+        with self._lock:
+            if not self._refresh():
+                return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32), np.empty(0)
+            rows = np.flatnonzero(self._kinds[:self._count()] == KINDS[kind])
+            return self._ids[rows].copy(), self._matrix[rows], self._norms[rows].astype(np.float64)
+
+    def score(self, query: Sequence[float], kind: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (id, проценты совместимости) запроса со всеми векторами типа: одно
+        матрично-векторное произведение прямо по mmap, без обращения к SQLite.
+        Запрос другой размерности получает 0% со всеми, как в calculate_match_percentage.
+        """
+        query = np.asarray(query, dtype=np.float64).reshape(-1)
+        with self._lock:
+            if not self._refresh():
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+            count = self._count()
+            rows = np.flatnonzero(self._kinds[:count] == KINDS[kind])
+            if query.shape[0] != self.dim:
+                return self._ids[rows].copy(), np.zeros(len(rows), dtype=np.float64)
+            dot = self._matrix[:count] @ query
+            return self._ids[rows].copy(), cosine_to_percentage(
+                dot[rows], self._norms[rows].astype(np.float64), np.linalg.norm(query)
+            )
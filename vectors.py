@@ -0,0 +1,27 @@
+import json
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+
+# Формат хранения векторов ценностей в test_results.vector_blob: float32, little-endian
+VECTOR_DTYPE = np.dtype('<f4')
+
+VectorLike = Union[str, Sequence[float], np.ndarray]
+
+
+def to_array(vector: VectorLike) -> np.ndarray:
+    """Вектор из JSON-строки, списка или массива"""
+    if isinstance(vector, str):
+        vector = json.loads(vector)
+    return np.asarray(vector, dtype=VECTOR_DTYPE).reshape(-1)
+
+
+def pack_vector(vector: VectorLike) -> Tuple[bytes, float, int]:
+    """Упаковать вектор: (float32 BLOB, L2-норма, размерность)"""
+    array = to_array(vector)
+    return array.tobytes(), float(np.linalg.norm(array.astype(np.float64))), int(array.shape[0])
+
+
+def unpack_vector(blob: Union[bytes, memoryview]) -> np.ndarray:
+    """Вектор из BLOB без копирования (read-only view поверх буфера)"""
+    return np.frombuffer(blob, dtype=VECTOR_DTYPE)